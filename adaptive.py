@@ -0,0 +1,196 @@
+import logging
+import os
+import threading
+import time
+
+from metrics import appmetrics
+
+applog = logging.getLogger('applog')
+
+
+class AdaptiveLimiter:
+    '''
+    Limit the number of requests in flight to each endpoint, adjusting the limit from the latency and errors seen.
+
+    The limit grows by one for every limit's worth of quick, successful requests and is halved when a request
+    fails or is slow (at most once per round trip).  A request is slow when it takes longer than latencytarget
+    seconds or, if latencytarget is 0, longer than tolerance times the fastest recent request.  Each change is
+    logged and recorded as the concurrency_limit metric.  Created with a multiprocessing context the limiter is
+    shared by the processes forked after it (--batch with --workers); the slots of a process that died holding
+    them are given back with reclaim.  A request that waits more than maxwait seconds for a slot raises
+    AdaptiveLimiterError.
+
+    Usage:
+        limiter = AdaptiveLimiter(maximum=16)
+        with limiter.slot('create_share') as slot:
+            resp = nxc.create_share(path, share_type=ShareType.PUBLIC_LINK)
+            if not resp.is_ok:
+                slot.failed()
+    '''
+
+    class AdaptiveLimiterError(Exception):
+        pass
+
+    ENDPOINTS = ('get_shares', 'create_share', 'vapiql')
+
+    def __init__(self, maximum=16, minimum=1, initial=None, latencytarget=0, tolerance=2.0, context=None,
+                 maxwait=300):
+        """
+        :param maximum: The most requests in flight to any one endpoint
+        :param minimum: The least the limit is reduced to
+        :param initial: The limit to start with (default: half way between minimum and maximum)
+        :param latencytarget: Seconds.  Requests taking longer are slow.  0 uses tolerance instead.
+        :param tolerance: With no latencytarget, requests taking this many times the fastest recent request are slow
+        :param context: Optional multiprocessing context (fork) to share the limits between processes
+        :param maxwait: The most seconds a request waits for a slot
+        """
+        if minimum < 1 or maximum < minimum:
+            raise self.AdaptiveLimiterError('The limits must satisfy 1 <= minimum <= maximum')
+        if latencytarget < 0 or tolerance <= 1:
+            raise self.AdaptiveLimiterError('latencytarget must not be negative and tolerance must be more than 1')
+        if initial is None:
+            initial = (minimum + maximum) / 2.0
+        self.__maximum = float(maximum)
+        self.__minimum = float(minimum)
+        self.__latencytarget = latencytarget
+        self.__tolerance = tolerance
+        self.__maxwait = maxwait
+        count = len(self.ENDPOINTS)
+        # the pid holding each slot (0 free), maximum slots per endpoint, so reclaim knows whose slots they were
+        self.__slots = int(maximum)
+        if context is None:
+            self.__changed = threading.Condition()
+            self.__limit = [float(min(max(initial, minimum), maximum))] * count
+            self.__inflight = [0] * count
+            self.__fastest = [0.0] * count
+            self.__decreased = [0.0] * count
+            self.__holders = [0] * (count * self.__slots)
+        else:
+            self.__changed = context.Condition()
+            self.__limit = context.Array('d', [float(min(max(initial, minimum), maximum))] * count, lock=False)
+            self.__inflight = context.Array('i', [0] * count, lock=False)
+            self.__fastest = context.Array('d', [0.0] * count, lock=False)
+            self.__decreased = context.Array('d', [0.0] * count, lock=False)
+            self.__holders = context.Array('i', [0] * (count * self.__slots), lock=False)
+
+    @property
+    def limits(self):
+        """ dict of endpoint -> the current limit """
+        with self.__changed:
+            return {e: int(self.__limit[i]) for i, e in enumerate(self.ENDPOINTS)}
+
+    def slot(self, endpoint):
+        """
+        A context manager holding one in flight request to the endpoint.  The request is counted as failed if
+        an exception is raised in the with block or failed() is called.
+        """
+        return _Slot(self, endpoint)
+
+    def acquire(self, endpoint):
+        """
+        Wait until the endpoint has fewer requests in flight than its limit.
+        :return: The time (time.monotonic) the request started
+        """
+        i = self.__index(endpoint)
+        deadline = time.monotonic() + self.__maxwait
+        with self.__changed:
+            while self.__inflight[i] >= int(self.__limit[i]):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self.AdaptiveLimiterError("Timed out waiting for a {} slot ({} in flight)".format(
+                        endpoint, self.__inflight[i]))
+                self.__changed.wait(remaining)
+            self.__inflight[i] += 1
+            self.__hold(i, 0, os.getpid())
+        return time.monotonic()
+
+    def release(self, endpoint, started, failed=False):
+        """
+        Record the outcome of a request and adjust the limit
+        :param endpoint: One of ENDPOINTS
+        :param started: The time returned by acquire
+        :param failed: True if the request failed
+        """
+        i = self.__index(endpoint)
+        now = time.monotonic()
+        latency = now - started
+        with self.__changed:
+            self.__inflight[i] -= 1
+            self.__hold(i, os.getpid(), 0)
+            before = int(self.__limit[i])
+            if self.__latencytarget > 0:
+                target = self.__latencytarget
+            elif self.__fastest[i] > 0:
+                target = self.__tolerance * self.__fastest[i]
+            else:
+                target = None
+            if not failed:
+                if self.__fastest[i] == 0 or latency < self.__fastest[i]:
+                    self.__fastest[i] = latency
+                else:
+                    self.__fastest[i] += (latency - self.__fastest[i]) * 0.01
+            if failed or (target is not None and latency > target):
+                if started >= self.__decreased[i]:
+                    self.__limit[i] = max(self.__minimum, self.__limit[i] / 2.0)
+                    self.__decreased[i] = now
+            else:
+                self.__limit[i] = min(self.__maximum, self.__limit[i] + 1.0 / self.__limit[i])
+            after = int(self.__limit[i])
+            self.__changed.notify_all()
+        if after != before:
+            applog.info("Concurrency limit for {} now {} (latency {:.3f}{})".format(
+                endpoint, after, latency, ", failed" if failed else ""))
+            appmetrics.record('concurrency_limit', after, endpoint=endpoint)
+
+    def reclaim(self, pid):
+        """
+        Give back the slots held by a process that has died (e.g. a --workers process killed mid request)
+        :param pid: The process id
+        :return: The number of slots given back
+        """
+        reclaimed = 0
+        with self.__changed:
+            for cell in range(len(self.__holders)):
+                if self.__holders[cell] == pid:
+                    self.__holders[cell] = 0
+                    self.__inflight[cell // self.__slots] -= 1
+                    reclaimed += 1
+            self.__changed.notify_all()
+        if reclaimed > 0:
+            applog.warning("{} concurrency slots of process {} given back".format(reclaimed, pid))
+        return reclaimed
+
+    # ---------------------------- Private Methods ---------------------------------------
+
+    def __hold(self, i, frompid, topid):
+        # the first of the endpoint's slots held by frompid (0 for a free one) is now held by topid
+        for cell in range(i * self.__slots, (i + 1) * self.__slots):
+            if self.__holders[cell] == frompid:
+                self.__holders[cell] = topid
+                return
+
+    def __index(self, endpoint):
+        try:
+            return self.ENDPOINTS.index(endpoint)
+        except ValueError:
+            raise self.AdaptiveLimiterError("Unknown endpoint {}".format(endpoint))
+
+
+class _Slot:
+    """ One request in flight (see AdaptiveLimiter.slot) """
+
+    def __init__(self, limiter, endpoint):
+        self.__limiter = limiter
+        self.__endpoint = endpoint
+        self.__started = None
+        self.__failed = False
+
+    def failed(self):
+        self.__failed = True
+
+    def __enter__(self):
+        self.__started = self.__limiter.acquire(self.__endpoint)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__limiter.release(self.__endpoint, self.__started, self.__failed or exc_type is not None)
@@ -0,0 +1,162 @@
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import time
+
+from metrics import appmetrics
+
+applog = logging.getLogger('applog')
+
+
+class CircuitBreaker:
+    '''
+    A circuit breaker for one endpoint (nextcloud or pronto), shared by every process on the host.
+
+    After failures consecutive failures the breaker opens and events are deferred (see main.py replay) until
+    reset seconds have passed.  Then it is half open: the next event is the probe and the others are still
+    deferred.  If the probe succeeds the breaker closes, otherwise it opens again.  A probe that never reports
+    is replaced after reset seconds.  Only outages count as failures (no connection, a timeout or a 5xx); a
+    rejected password or a pronto api error is an answer from a working server.
+
+    The state is kept in <breakerdir>/<name>.json, locked with flock.  Each change is logged and recorded as
+    the breaker_state metric (0 closed, 1 half open, 2 open).
+
+    Usage:
+        breaker = CircuitBreaker('/home/velocity/vnextcloud/breakers', 'pronto', failures=5, reset=60)
+        if not breaker.allow():
+            # defer the event
+        try:
+            # call pronto
+            breaker.success()
+        except requests.RequestException as e:
+            breaker.failure(str(e))
+    '''
+
+    class CircuitBreakerError(Exception):
+        pass
+
+    CLOSED = 'closed'
+    HALFOPEN = 'halfopen'
+    OPEN = 'open'
+    STATES = (CLOSED, HALFOPEN, OPEN)
+
+    def __init__(self, breakerdir, name, failures=5, reset=60):
+        """
+        :param breakerdir: The directory holding the state files.  Created if it does not exist.
+        :param name: The endpoint (nextcloud or pronto)
+        :param failures: Consecutive failures that open the breaker
+        :param reset: Seconds the breaker stays open before a probe is let through
+        """
+        if not isinstance(breakerdir, str) or len(breakerdir) == 0:
+            raise self.CircuitBreakerError('A breaker directory is required')
+        if failures < 1 or reset <= 0:
+            raise self.CircuitBreakerError('failures must be at least 1 and reset more than 0')
+        os.makedirs(breakerdir, exist_ok=True)
+        self.__statefile = os.path.join(breakerdir, name + '.json')
+        self.__name = name
+        self.__failures = failures
+        self.__reset = reset
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def state(self):
+        """ dict of state, failures (consecutive), opened (time), probe (time) and reason """
+        with self.__locked() as state:
+            return dict(state)
+
+    def allow(self):
+        """
+        May an event use the endpoint now?  When half open only the probe is allowed.
+        :return: True if the event may go ahead
+        """
+        with self.__locked() as state:
+            now = time.time()
+            if state['state'] == self.CLOSED:
+                return True
+            if not self.__ready(state, now):
+                return False
+            self.__change(state, self.HALFOPEN)
+            state['probe'] = now
+            return True
+
+    def ready(self):
+        """
+        Would allow let an event through now?  Unlike allow, a probe is not taken.
+        :return: True if the event may go ahead
+        """
+        with self.__locked() as state:
+            return state['state'] == self.CLOSED or self.__ready(state, time.time())
+
+    def release(self):
+        """ Give back a probe taken by allow that was not used (the event was stopped by another breaker) """
+        with self.__locked() as state:
+            if state['state'] == self.HALFOPEN:
+                state['probe'] = 0.0
+
+    def success(self):
+        """ The endpoint answered """
+        with self.__locked() as state:
+            if state['state'] != self.CLOSED:
+                self.__change(state, self.CLOSED)
+            state['failures'] = 0
+
+    def failure(self, reason):
+        """
+        The endpoint could not be reached (or answered with a server error)
+        :param reason: The error message
+        """
+        with self.__locked() as state:
+            state['failures'] += 1
+            state['reason'] = str(reason)[:500]
+            if state['state'] == self.HALFOPEN or \
+                    (state['state'] == self.CLOSED and state['failures'] >= self.__failures):
+                state['opened'] = time.time()
+                self.__change(state, self.OPEN)
+
+    # ---------------------------- Private Methods ---------------------------------------
+
+    @contextlib.contextmanager
+    def __locked(self):
+        """ The state, read and written back under an exclusive lock """
+        try:
+            fd = os.open(self.__statefile, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as e:
+            raise self.CircuitBreakerError("Unable to open breaker {} ({})".format(self.__statefile, str(e)))
+        with os.fdopen(fd, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            text = f.read()
+            try:
+                state = json.loads(text) if len(text) > 0 else {}
+            except ValueError:
+                applog.warning("Breaker state {} unreadable - reset".format(self.__statefile))
+                state = {}
+            if state.get('state') not in self.STATES:
+                state = {'state': self.CLOSED, 'failures': 0, 'opened': 0.0, 'probe': 0.0, 'reason': None}
+            before = dict(state)
+            yield state
+            if state != before:
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+
+    def __ready(self, state, now):
+        """ An open breaker whose reset has passed, or a half open breaker whose probe is not in flight """
+        if state['state'] == self.OPEN:
+            return now - state['opened'] >= self.__reset
+        return now - state['probe'] >= self.__reset
+
+    def __change(self, state, newstate):
+        if newstate == self.OPEN:
+            applog.warning("Circuit breaker {} open after {} failures ({}).  Events are deferred for {} seconds".format(
+                self.__name, state['failures'], state['reason'], self.__reset))
+        else:
+            applog.info("Circuit breaker {} {}".format(self.__name, 'closed' if newstate == self.CLOSED
+                                                       else 'half open - probing'))
+        state['state'] = newstate
+        appmetrics.record('breaker_state', self.STATES.index(newstate), breaker=self.__name)
@@ -0,0 +1,242 @@
+import argparse
+import hashlib
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipapp
+
+applog = logging.getLogger('applog')
+
+# modules that are not part of the application
+EXCLUDE = ('testcases.py', 'bundle.py')
+NATIVE_SUFFIXES = ('.so', '.pyd', '.dylib')
+
+# The __main__ of the bundle.  Packages with native code (e.g. pycryptodome) cannot be imported from a zip so
+# they are extracted once, beside the bundle, into a folder named after the build.
+MAIN_TEMPLATE = '''import os
+import sys
+
+BUNDLE_ID = {bundleid!r}
+
+
+def native_path(archive):
+    """ Extract the packages with native code (once per build) and return where they are """
+    import zipfile
+    cache = os.environ.get('VNEXTCLOUD_BUNDLE_CACHE') or \\
+        os.path.join(os.path.dirname(os.path.abspath(archive)), '.' + os.path.basename(archive) + '.cache')
+    target = os.path.join(cache, BUNDLE_ID)
+    if not os.path.isdir(target):
+        partial = '{{}}.{{}}'.format(target, os.getpid())
+        with zipfile.ZipFile(archive) as bundle:
+            bundle.extractall(partial, [n for n in bundle.namelist() if n.startswith('_native/')])
+        try:
+            os.rename(partial, target)
+        except OSError:
+            # another process extracted it first
+            import shutil
+            shutil.rmtree(partial, ignore_errors=True)
+    return os.path.join(target, '_native')
+
+
+archive = os.path.dirname(os.path.abspath(__file__))
+sys.path[1:1] = ([native_path(archive)] if {native!r} else []) + [os.path.join(archive, '_vendor')]
+import runpy
+runpy.run_module('main', run_name='__main__', alter_sys=True)
+'''
+
+
+class BundleBuilder:
+    '''
+    Build the application into a single file (a zipapp) with its dependencies and precompiled bytecode.
+
+    The bundle holds unchecked bytecode compiled by the interpreter that will run it (--python), so nothing is
+    compiled or looked up on slow storage at start up.  Requirements go in _vendor; packages with native code go
+    in _native and are extracted beside the bundle on first run (.vnextcloud.pyz.cache, or
+    $VNEXTCLOUD_BUNDLE_CACHE).  It is run just as main.py is, and vnextcloud.ini is looked for beside it.
+    coldstart compares the start up time of the bundle with the loose files.
+
+    Usage:
+        with BundleBuilder('/root/PycharmProjects/vnextcloud', '/tmp/vnextcloud.pyz', 'REQUIREMENTS.txt') as builder:
+            builder.build()
+            print(builder.coldstart(runs=5))
+    '''
+
+    class BundleBuilderError(Exception):
+        pass
+
+    def __init__(self, srcdir, output, requirements=None, python=None):
+        """
+        :param srcdir: The folder holding the application (main.py)
+        :param output: The bundle to create
+        :param requirements: Optional requirements file installed into the bundle.  Without it the packages
+                             must be installed where the bundle runs.
+        :param python: The interpreter that will run the bundle (default: this one)
+        """
+        if not os.path.isfile(os.path.join(srcdir, 'main.py')):
+            raise self.BundleBuilderError("main.py not found in {}".format(srcdir))
+        if requirements is not None and not os.path.isfile(requirements):
+            raise self.BundleBuilderError("Requirements file {} not found".format(requirements))
+        self.__srcdir = srcdir
+        self.__output = output
+        self.__requirements = requirements
+        self.__python = python or sys.executable
+        self.__staging = None
+        self.__native = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def native(self):
+        """ The packages with native code (extracted when the bundle first runs) """
+        return list(self.__native)
+
+    def build(self):
+        """
+        Build the bundle
+        :return: dict of the bundle's file name, size and number of modules
+        """
+        self.close()
+        self.__staging = tempfile.mkdtemp(prefix='vnextcloud-bundle-')
+        appdir = os.path.join(self.__staging, 'app')
+        os.makedirs(os.path.join(appdir, '_vendor'))
+        os.makedirs(os.path.join(appdir, '_native'))
+        modules = [f for f in sorted(os.listdir(self.__srcdir)) if f.endswith('.py') and f not in EXCLUDE]
+        for module in modules:
+            shutil.copy2(os.path.join(self.__srcdir, module), appdir)
+        if self.__requirements is not None:
+            self.__run([self.__python, '-m', 'pip', 'install', '--quiet', '--no-compile', '--disable-pip-version-check',
+                        '--target', os.path.join(self.__staging, 'deps'), '-r', self.__requirements])
+            self.__split_native(os.path.join(self.__staging, 'deps'), appdir)
+        # a clean copy of the loose layout for coldstart (before any bytecode is written)
+        shutil.copytree(appdir, os.path.join(self.__staging, 'loose'))
+        # bytecode beside the source (zipimport does not use __pycache__), compiled by the interpreter that runs it
+        self.__run([self.__python, '-m', 'compileall', '-q', '-b', '--invalidation-mode', 'unchecked-hash', appdir],
+                   check=False)
+        digest = hashlib.sha256()
+        for root, dirs, files in sorted(os.walk(os.path.join(appdir, '_native'))):
+            dirs.sort()
+            for name in sorted(files):
+                with open(os.path.join(root, name), 'rb') as f:
+                    digest.update(name.encode('UTF-8') + f.read())
+        with open(os.path.join(appdir, '__main__.py'), 'w') as f:
+            f.write(MAIN_TEMPLATE.format(bundleid=digest.hexdigest()[:16], native=len(self.__native) > 0))
+        interpreter = '/usr/bin/env ' + os.path.basename(self.__python)
+        zipapp.create_archive(appdir, self.__output, interpreter=interpreter, compressed=True)
+        result = {'bundle': self.__output, 'bytes': os.path.getsize(self.__output), 'modules': len(modules),
+                  'native': self.native}
+        applog.info("Bundle {} built ({} bytes, native packages: {})".format(
+            self.__output, result['bytes'], ", ".join(self.__native) or "none"))
+        return result
+
+    def coldstart(self, runs=5, workdir=None):
+        """
+        Time starting the program from the bundle and from loose files.  Each is run with --help, which imports
+        every module and then exits.
+        :param runs: The number of times each is started (the median is reported)
+        :param workdir: Where the loose files are copied to (default: beside the bundle, so on the same storage)
+        :return: dict of layout -> median seconds (loose: compiling every module each time, loosecached: with
+                 __pycache__, bundle: the bundle)
+        """
+        if self.__staging is None:
+            raise self.BundleBuilderError("The bundle must be built first")
+        workdir = tempfile.mkdtemp(prefix='.coldstart-', dir=workdir or os.path.dirname(os.path.abspath(self.__output)))
+        try:
+            loose = os.path.join(workdir, 'loose')
+            shutil.copytree(os.path.join(self.__staging, 'loose'), loose)
+            env = dict(os.environ)
+            env.pop('PYTHONDONTWRITEBYTECODE', None)
+            env['PYTHONPATH'] = os.pathsep.join([os.path.join(loose, '_native'), os.path.join(loose, '_vendor')])
+            timings = {'loose': self.__time([self.__python, '-B', os.path.join(loose, 'main.py'), '--help'], runs,
+                                            env)}
+            self.__run([self.__python, '-m', 'compileall', '-q', loose], check=False)
+            timings['loosecached'] = self.__time([self.__python, os.path.join(loose, 'main.py'), '--help'], runs, env)
+            env.pop('PYTHONPATH')
+            bundle = os.path.abspath(self.__output)
+            # the first run extracts the native packages
+            self.__run([self.__python, bundle, '--help'], env=env)
+            timings['bundle'] = self.__time([self.__python, bundle, '--help'], runs, env)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        return timings
+
+    def close(self):
+        """ Remove the staging folder """
+        if self.__staging is not None:
+            shutil.rmtree(self.__staging, ignore_errors=True)
+            self.__staging = None
+
+    # ---------------------------- Private Methods ---------------------------------------
+
+    def __split_native(self, depsdir, appdir):
+        """ Move the installed packages into _vendor, or _native if they have native code """
+        self.__native = []
+        for entry in sorted(os.listdir(depsdir)):
+            if entry == 'bin' or entry == '__pycache__':
+                continue
+            path = os.path.join(depsdir, entry)
+            native = path.endswith(NATIVE_SUFFIXES) or \
+                any(f.endswith(NATIVE_SUFFIXES) for _, _, files in os.walk(path) for f in files)
+            if native and not entry.endswith('.dist-info'):
+                self.__native.append(entry)
+            shutil.move(path, os.path.join(appdir, '_native' if native else '_vendor', entry))
+
+    def __run(self, command, check=True, env=None):
+        applog.debug("Running {}".format(" ".join(command)))
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+        if result.returncode != 0:
+            output = result.stdout.decode('UTF-8', 'replace').strip()
+            if check:
+                raise self.BundleBuilderError("{} failed ({})".format(" ".join(command[:4]), output[-500:]))
+            applog.warning("{} returned {} ({})".format(" ".join(command[:4]), result.returncode, output[-500:]))
+        return result
+
+    def __time(self, command, runs, env):
+        seconds = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            self.__run(command, env=env)
+            seconds.append(time.perf_counter() - started)
+        return round(statistics.median(seconds), 3)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="bundle.py",
+                                     description="Build vnextcloud into a single file with precompiled bytecode")
+    parser.add_argument('--output', action='store', default='/tmp/vnextcloud.pyz', help="The bundle to create")
+    parser.add_argument('--requirements', action='store', default=None,
+                        help="Requirements installed into the bundle (e.g. REQUIREMENTS.txt)")
+    parser.add_argument('--python', action='store', default=None,
+                        help="The interpreter that will run the bundle (default: this one)")
+    parser.add_argument('--srcdir', action='store', default=os.path.dirname(os.path.abspath(__file__)),
+                        help="The folder holding the application")
+    parser.add_argument('--coldstart', action='store', type=int, default=0, metavar='RUNS',
+                        help="Compare the start up time of the bundle with loose files over RUNS runs")
+    args = parser.parse_args(argv)
+    with BundleBuilder(args.srcdir, args.output, args.requirements, args.python) as builder:
+        result = builder.build()
+        print("{} created ({} bytes, {} modules, native packages: {})".format(
+            result['bundle'], result['bytes'], result['modules'], ", ".join(result['native']) or "none"))
+        if args.coldstart > 0:
+            timings = builder.coldstart(args.coldstart)
+            print("Cold start (median of {} runs):".format(args.coldstart))
+            print("    loose files, no bytecode cache  {:8.3f}s".format(timings['loose']))
+            print("    loose files, __pycache__        {:8.3f}s".format(timings['loosecached']))
+            print("    bundle                          {:8.3f}s".format(timings['bundle']))
+    return 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except BundleBuilder.BundleBuilderError as e:
+        print(str(e))
+        sys.exit(1)
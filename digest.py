@@ -0,0 +1,196 @@
+import contextlib
+import datetime
+import logging
+import smtplib
+import socket
+import sqlite3
+import time
+from email.message import EmailMessage
+
+applog = logging.getLogger('applog')
+
+
+class DigestNotifier:
+    '''
+    One email summarising many files, in place of an email per file.
+
+    The result of each file (see main.result_record) is added to a sqlite store shared by every process.  A
+    digest is sent every interval minutes, or at once when errors files have failed (at most once every
+    MINIMUM_GAP seconds), by whichever process adds the result that makes it due, or by the digest command.
+    Results are removed only once their digest has been sent.  The email is sent over SMTP (smtphost).
+
+    Usage:
+        notifier = DigestNotifier('/home/velocity/vnextcloud/digest.db', ['support@velocityglobal.co.nz'])
+        notifier.add(main.result_record(owner, event, elapsed, error))     # sends the digest if it is due
+    '''
+
+    class DigestNotifierError(Exception):
+        pass
+
+    # seconds between digests sent because of failures
+    MINIMUM_GAP = 300
+    # the most failures and slow files listed in a digest
+    LISTED = 50
+
+    def __init__(self, dbfile, recipients, interval=60, errors=5, slow=30, smtphost='localhost', sender=None,
+                 mailer=None):
+        """
+        :param dbfile: The sqlite store.  Created if it does not exist.
+        :param recipients: list of email addresses
+        :param interval: Minutes between digests
+        :param errors: The number of failures that sends a digest at once (0: never)
+        :param slow: Seconds.  Files taking longer are listed as slow.
+        :param smtphost: The mail server (host or host:port)
+        :param sender: The from address (default vnextcloud@<hostname>)
+        :param mailer: Optional callable(EmailMessage) that sends the email (default: SMTP to smtphost)
+        """
+        if not isinstance(dbfile, str) or len(dbfile) == 0:
+            raise self.DigestNotifierError('Invalid digest store')
+        if len(recipients) == 0:
+            raise self.DigestNotifierError('A digest needs at least one recipient')
+        if interval <= 0 or errors < 0 or slow < 0:
+            raise self.DigestNotifierError('interval must be more than 0 and errors and slow must not be negative')
+        self.__dbfile = dbfile
+        self.__recipients = list(recipients)
+        self.__interval = interval
+        self.__errors = errors
+        self.__slow = slow
+        self.__smtphost = smtphost
+        self.__sender = sender or 'vnextcloud@{}'.format(socket.getfqdn())
+        self.__mailer = mailer or self.__smtp
+        with self.__transaction() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS results (
+                            id INTEGER PRIMARY KEY,
+                            recorded REAL NOT NULL,
+                            owner TEXT,
+                            path TEXT,
+                            status TEXT,
+                            error TEXT,
+                            seconds REAL,
+                            digest REAL)""")
+            db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value REAL)")
+            # the first digest is one interval from when the store is created
+            db.execute("INSERT OR IGNORE INTO state VALUES ('lastsent', ?)", (time.time(),))
+
+    @property
+    def dbfile(self):
+        return self.__dbfile
+
+    def add(self, record):
+        """
+        Add the result of a file, and send the digest if it is due
+        :param record: dict (see main.result_record)
+        :return: True if a digest was sent
+        """
+        with self.__transaction() as db:
+            db.execute("INSERT INTO results (recorded, owner, path, status, error, seconds) VALUES (?,?,?,?,?,?)",
+                       (time.time(), record.get('owner'), record.get('path'), record.get('status'),
+                        record.get('error'), (record.get('timings') or {}).get('total')))
+            digest = self.__claim(db, force=False)
+        return self.__send(digest) if digest is not None else False
+
+    def flush(self, force=False):
+        """
+        Send the digest if it is due (e.g. from cron when no files are arriving)
+        :param force: Send it now whether it is due or not
+        :return: True if a digest was sent
+        """
+        with self.__transaction() as db:
+            digest = self.__claim(db, force)
+        return self.__send(digest) if digest is not None else False
+
+    def pending(self):
+        """ dict of status -> the number of results waiting for the next digest """
+        with self.__transaction() as db:
+            rows = db.execute("SELECT status, COUNT(*) FROM results WHERE digest IS NULL GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    # ---------------------------- Private Methods ---------------------------------------
+
+    @contextlib.contextmanager
+    def __transaction(self):
+        """ Open the store and take the write lock, so only one process claims a digest """
+        try:
+            db = sqlite3.connect(self.__dbfile, timeout=30, isolation_level=None)
+        except sqlite3.Error as e:
+            raise self.DigestNotifierError("Unable to open digest store {} ({})".format(self.__dbfile, str(e)))
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            raise self.DigestNotifierError("Digest store error {} ({})".format(self.__dbfile, str(e)))
+        finally:
+            db.close()
+
+    def __claim(self, db, force):
+        """
+        If a digest is due mark the waiting results as belonging to it
+        :return: The digest (the time it was claimed) or None
+        """
+        now = time.time()
+        lastsent = db.execute("SELECT value FROM state WHERE key='lastsent'").fetchone()[0]
+        waiting, failed = db.execute("SELECT COUNT(*), COALESCE(SUM(status='error'), 0) FROM results "
+                                     "WHERE digest IS NULL").fetchone()
+        if waiting == 0:
+            return None
+        if not force and now - lastsent < self.__interval * 60 \
+                and not (0 < self.__errors <= failed and now - lastsent >= self.MINIMUM_GAP):
+            return None
+        db.execute("UPDATE results SET digest=? WHERE digest IS NULL", (now,))
+        db.execute("UPDATE state SET value=? WHERE key='lastsent'", (now,))
+        return now
+
+    def __send(self, digest):
+        with self.__transaction() as db:
+            rows = db.execute("SELECT recorded, owner, path, status, error, seconds FROM results WHERE digest=? "
+                              "ORDER BY id", (digest,)).fetchall()
+        try:
+            self.__mailer(self.__message(rows))
+        except Exception as e:
+            # the results go in the next digest
+            applog.error("Unable to send the digest ({})".format(str(e)))
+            with self.__transaction() as db:
+                db.execute("UPDATE results SET digest=NULL WHERE digest=?", (digest,))
+            return False
+        with self.__transaction() as db:
+            db.execute("DELETE FROM results WHERE digest=?", (digest,))
+        applog.info("Digest of {} files sent to {}".format(len(rows), ", ".join(self.__recipients)))
+        return True
+
+    def __message(self, rows):
+        counts = {}
+        owners = {}
+        for recorded, owner, path, status, error, seconds in rows:
+            counts[status] = counts.get(status, 0) + 1
+            owners[owner] = owners.get(owner, 0) + 1
+        failures = [r for r in rows if r[3] == 'error']
+        slow = sorted([r for r in rows if r[5] is not None and r[5] > self.__slow], key=lambda r: -r[5])
+        stamp = lambda t: datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S")
+        lines = ["Files from {} to {}".format(stamp(rows[0][0]), stamp(rows[-1][0])), ""]
+        lines += ["{:<12}{:>8}".format(status, counts[status]) for status in sorted(counts)]
+        lines += ["", "By owner:"] + ["    {:<20}{:>8}".format(str(o), owners[o]) for o in sorted(owners, key=str)]
+        if len(failures) > 0:
+            lines += ["", "Failures ({}):".format(len(failures))]
+            lines += ["    {} {} {}: {}".format(stamp(r[0]), r[1], r[2], r[4]) for r in failures[:self.LISTED]]
+            if len(failures) > self.LISTED:
+                lines.append("    ... and {} more".format(len(failures) - self.LISTED))
+        if len(slow) > 0:
+            lines += ["", "Slow files (more than {} seconds, {}):".format(self.__slow, len(slow))]
+            lines += ["    {:8.1f}s {} {}".format(r[5], r[1], r[2]) for r in slow[:self.LISTED]]
+        message = EmailMessage()
+        message['Subject'] = "Nextcloud quicklinks: {} files, {} errors ({})".format(
+            len(rows), len(failures), socket.gethostname())
+        message['From'] = self.__sender
+        message['To'] = ", ".join(self.__recipients)
+        message.set_content("\n".join(lines) + "\n")
+        return message
+
+    def __smtp(self, message):
+        host, _, port = self.__smtphost.partition(":")
+        with smtplib.SMTP(host, int(port) if port else 25, timeout=30) as smtp:
+            smtp.send_message(message)
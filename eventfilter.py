@@ -0,0 +1,169 @@
+import fnmatch
+import logging
+import re
+
+applog = logging.getLogger('applog')
+
+
+class EventFilter:
+    '''
+    Decide what to do with a file event before any connection is made to nextcloud.
+
+    The filter is built once from the [FILTER] section and the [RULE ...] sections of the configuration file
+    (see the README) and compiled into regular expressions.  It only looks at the owner and the relative path.
+    Rules are checked in order and the first match wins; its actions are:
+
+        process      Process the file normally
+        skip         Do nothing with the file
+        privateonly  Use the private link only (no public share is looked up or created)
+        publicshare  Create a public share if one does not exist
+        skippronto   Do not call the pronto api
+
+    Usage:
+        thisfilter = EventFilter.from_config(config)
+        rule, actions = thisfilter.evaluate('quicklinks', 'Documents/Stock/EQ100.jpg')
+        if 'skip' in actions:
+            ...
+    '''
+
+    class EventFilterError(Exception):
+        pass
+
+    ACTIONS = ('process', 'skip', 'privateonly', 'publicshare', 'skippronto')
+
+    def __init__(self, ignorehidden=True, ignoresuffixes=None, ignoreprefixes=None, allowextensions=None,
+                 default='process'):
+        """
+        :param ignorehidden: Skip any file where the file or one of its folders starts with "."
+        :param ignoresuffixes: list of filename endings to skip (e.g. .part)
+        :param ignoreprefixes: list of filename beginnings to skip (e.g. ~$)
+        :param allowextensions: list of extensions to process.  None means all extensions.
+        :param default: The action(s) to take when no rule matches (string or list)
+        """
+        self.__ignorehidden = ignorehidden
+        self.__ignoresuffixes = tuple(ignoresuffixes or ())
+        self.__ignoreprefixes = tuple(ignoreprefixes or ())
+        self.__allowextensions = None
+        if allowextensions:
+            self.__allowextensions = frozenset([self.__normalise_extension(e) for e in allowextensions])
+        self.__default = self.__parse_actions(default)
+        self.__rules = []
+
+    @property
+    def rules(self):
+        return [r['name'] for r in self.__rules]
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build the filter from a configparser object.
+        :param config: configparser.ConfigParser
+        :return: EventFilter
+        """
+        settings = config['FILTER'] if 'FILTER' in config.sections() else {}
+        try:
+            thisfilter = cls(
+                ignorehidden=config.getboolean('FILTER', 'ignorehidden', fallback=True),
+                ignoresuffixes=cls.__split(settings.get('ignoresuffixes', '.part')),
+                ignoreprefixes=cls.__split(settings.get('ignoreprefixes', '')),
+                allowextensions=cls.__split(settings.get('allowextensions', '')),
+                default=settings.get('default', 'process'))
+        except ValueError as e:
+            raise cls.EventFilterError("Invalid FILTER section ({})".format(str(e)))
+        for section in config.sections():
+            if section.upper().startswith('RULE'):
+                rule = config[section]
+                thisfilter.add_rule(section[4:].strip() or section,
+                                    owner=rule.get('owner'),
+                                    folder=rule.get('folder'),
+                                    extensions=cls.__split(rule.get('extensions', '')),
+                                    action=rule.get('action', 'process'))
+        return thisfilter
+
+    def add_rule(self, name, owner=None, folder=None, extensions=None, action='process'):
+        """
+        Add a rule to the end of the rule list.
+        :param name: The name of the rule (used in logging)
+        :param owner: glob or re:regex for the owner.  None matches any owner.
+        :param folder: glob or re:regex for the folder part of the relative path.  None matches any folder.
+        :param extensions: list of extensions.  None or empty matches any extension.
+        :param action: string (comma separated) or list of actions
+        :return:
+        """
+        self.__rules.append({
+            'name': name,
+            'owner': self.__compile(owner, name),
+            'folder': self.__compile(folder, name),
+            'extensions': frozenset([self.__normalise_extension(e) for e in extensions]) if extensions else None,
+            'actions': self.__parse_actions(action)
+        })
+
+    def evaluate(self, owner, path):
+        """
+        Decide what to do with a file.
+        :param owner: The owner of the file
+        :param path: The path of the file relative to the owners files folder e.g. Documents/Stock/EQ100.jpg
+        :return: tuple of (name of the rule that decided, frozenset of actions)
+        """
+        path = path.strip("/")
+        if "/" in path:
+            folder, filename = path.rsplit("/", 1)
+        else:
+            folder, filename = "", path
+        if self.__ignorehidden and any(p.startswith(".") for p in path.split("/")):
+            return 'ignorehidden', frozenset(['skip'])
+        if self.__ignoresuffixes and filename.endswith(self.__ignoresuffixes):
+            return 'ignoresuffixes', frozenset(['skip'])
+        if self.__ignoreprefixes and filename.startswith(self.__ignoreprefixes):
+            return 'ignoreprefixes', frozenset(['skip'])
+        extension = self.__normalise_extension(filename.rsplit(".", 1)[1]) if "." in filename else ""
+        if self.__allowextensions is not None and extension not in self.__allowextensions:
+            return 'allowextensions', frozenset(['skip'])
+        for rule in self.__rules:
+            if rule['owner'] is not None and not rule['owner'].match(owner):
+                continue
+            if rule['folder'] is not None and not rule['folder'].match(folder):
+                continue
+            if rule['extensions'] is not None and extension not in rule['extensions']:
+                continue
+            return rule['name'], rule['actions']
+        return 'default', self.__default
+
+    # ---------------------------- Private Methods ---------------------------------------
+
+    @staticmethod
+    def __split(text):
+        return [t.strip() for t in text.split(",") if len(t.strip()) > 0]
+
+    @staticmethod
+    def __normalise_extension(extension):
+        return extension.strip().lstrip(".").lower()
+
+    def __parse_actions(self, action):
+        if isinstance(action, str):
+            action = self.__split(action)
+        actions = frozenset([a.lower() for a in action])
+        if len(actions) == 0:
+            raise self.EventFilterError("No action specified")
+        for a in actions:
+            if a not in self.ACTIONS:
+                raise self.EventFilterError("Invalid filter action {} (must be one of {})".format(
+                    a, ", ".join(self.ACTIONS)))
+        if 'skip' in actions and len(actions) > 1:
+            raise self.EventFilterError("The skip action cannot be combined with other actions")
+        return actions
+
+    def __compile(self, pattern, rulename):
+        """
+        Patterns starting with re: are regular expressions, anything else is a glob.
+        Both must match the whole value.
+        """
+        if pattern is None or len(pattern.strip()) == 0:
+            return None
+        pattern = pattern.strip()
+        try:
+            if pattern.startswith("re:"):
+                return re.compile("(?:" + pattern[3:] + r")\Z")
+            return re.compile(fnmatch.translate(pattern.strip("/")))
+        except re.error as e:
+            raise self.EventFilterError("Invalid pattern {} in rule {} ({})".format(pattern, rulename, str(e)))
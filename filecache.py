@@ -0,0 +1,117 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+from urllib.parse import urlsplit, unquote
+
+applog = logging.getLogger('applog')
+
+
+class FileCacheResolver:
+    '''
+    File ids read straight from nextcloud's own database (oc_storages and oc_filecache) instead of a PROPFIND.
+
+    The connection is read only and should use a database user that can only read those two tables.  Anything
+    not found, or any database error, returns None and the caller asks nextcloud as before.  The database is a url:
+        sqlite:////var/www/html/nextcloud/data/owncloud.db
+        mysql://nextcloudro@localhost:3306/nextcloud         (needs pymysql)
+        postgresql://nextcloudro@localhost:5432/nextcloud    (needs psycopg2)
+
+    Usage:
+        resolver = FileCacheResolver('mysql://nextcloudro@localhost/nextcloud', password='...')
+        fileid = resolver.fileid('quicklinks', '/Documents/EQ100.pdf')
+        if fileid is None:
+            # ask nextcloud
+    '''
+
+    class FileCacheResolverError(Exception):
+        pass
+
+    def __init__(self, dburl, password=None, prefix='oc_'):
+        """
+        :param dburl: The database url (sqlite, mysql or postgresql)
+        :param password: The database password (if it is not in the url)
+        :param prefix: The nextcloud table prefix (dbtableprefix in nextcloud's config.php)
+        """
+        parts = urlsplit(dburl)
+        if parts.scheme not in ('sqlite', 'mysql', 'postgresql'):
+            raise self.FileCacheResolverError("Unsupported database {} (sqlite, mysql or postgresql)".format(dburl))
+        if not prefix.replace('_', '').isalnum():
+            raise self.FileCacheResolverError("Invalid table prefix {}".format(prefix))
+        self.__scheme = parts.scheme
+        self.__parts = parts
+        self.__password = password if password is not None else (unquote(parts.password) if parts.password else None)
+        self.__prefix = prefix
+        self.__db = None
+        self.__guard = threading.Lock()
+        self.__stats = {'hits': 0, 'misses': 0, 'errors': 0}
+
+    @property
+    def stats(self):
+        """ dict of hits, misses (not in the database) and errors """
+        with self.__guard:
+            return dict(self.__stats)
+
+    def fileid(self, owner, path):
+        """
+        The file id of a file from nextcloud's database
+        :param owner: The owner of the file
+        :param path: The path of the file relative to the owners files
+        :return: The file id or None if it is not found (or the database cannot be read)
+        """
+        storagepath = "files/" + path.strip("/")
+        placeholder = '?' if self.__scheme == 'sqlite' else '%s'
+        sql = ("SELECT f.fileid FROM {0}filecache f JOIN {0}storages s ON s.numeric_id = f.storage "
+               "WHERE s.id IN ({1}, {1}) AND f.path_hash = {1}").format(self.__prefix, placeholder)
+        values = ('home::' + owner, 'object::user:' + owner, hashlib.md5(storagepath.encode('UTF-8')).hexdigest())
+        with self.__guard:
+            try:
+                if self.__db is None:
+                    self.__db = self.__connect()
+                cursor = self.__db.cursor()
+                try:
+                    cursor.execute(sql, values)
+                    row = cursor.fetchone()
+                finally:
+                    cursor.close()
+            except Exception as e:
+                # the caller asks nextcloud instead.  Reconnect next time.
+                applog.warning("Unable to read the nextcloud file cache ({})".format(str(e)))
+                self.__stats['errors'] += 1
+                self.close()
+                return None
+            self.__stats['hits' if row is not None else 'misses'] += 1
+        return int(row[0]) if row is not None else None
+
+    def close(self):
+        if self.__db is not None:
+            try:
+                self.__db.close()
+            except Exception:
+                pass
+            self.__db = None
+
+    # ---------------------------- Private Methods ---------------------------------------
+
+    def __connect(self):
+        """ A read only connection (the driver is only imported when it is needed) """
+        parts = self.__parts
+        if self.__scheme == 'sqlite':
+            # sqlite:////abs/path.db or sqlite:///relative/path.db
+            db = sqlite3.connect("file:{}?mode=ro".format(unquote(parts.path[1:])), uri=True,
+                                 check_same_thread=False)
+        elif self.__scheme == 'mysql':
+            import pymysql
+            db = pymysql.connect(host=parts.hostname or 'localhost', port=parts.port or 3306,
+                                 user=unquote(parts.username or ''), password=self.__password or '',
+                                 database=parts.path.strip("/"), autocommit=True, connect_timeout=5)
+            with db.cursor() as cursor:
+                cursor.execute("SET SESSION TRANSACTION READ ONLY")
+        else:
+            import psycopg2
+            db = psycopg2.connect(host=parts.hostname or 'localhost', port=parts.port or 5432,
+                                  user=unquote(parts.username or ''), password=self.__password,
+                                  dbname=parts.path.strip("/"), connect_timeout=5)
+            db.set_session(readonly=True, autocommit=True)
+        applog.debug("Connected to the nextcloud file cache ({})".format(self.__scheme))
+        return db
@@ -0,0 +1,135 @@
+import collections
+import logging
+import threading
+import time
+
+applog = logging.getLogger('applog')
+
+
+class FolderCache:
+    '''
+    File ids for every file in a folder, fetched with one Depth:1 PROPFIND.
+
+    A file not in the cached listing is not an error: the caller asks for the file itself.  Only the most
+    recently used maxfolders folders are kept, and with a ttl a folder read more than ttl seconds ago is read
+    again (so a file uploaded again with a new file id is seen).
+
+    The public shares of the folders above a file (see NxtCld.reuse_folder_share) are kept the same way, so
+    the files of a folder ask nextcloud for the folder's shares once.
+
+    Usage:
+        cache = FolderCache()
+        fileid = cache.fileid(nxc, 'quicklinks', 'Documents/EQ100.pdf')   # nxc is a nextcloud.NextCloud
+        if fileid is None:
+            # ask nextcloud for the file
+        shares = cache.shares('quicklinks', 'Documents', lookup)   # lookup() asks nextcloud for the shares
+    '''
+
+    class FolderCacheError(Exception):
+        pass
+
+    def __init__(self, maxfolders=50, ttl=None):
+        """
+        :param maxfolders: The number of folders to keep
+        :param ttl: Optional seconds a folder listing is used for (default: until it is evicted)
+        """
+        if maxfolders < 1:
+            raise self.FolderCacheError('maxfolders must be at least 1')
+        if ttl is not None and ttl <= 0:
+            raise self.FolderCacheError('ttl must be more than 0')
+        self.__maxfolders = maxfolders
+        self.__ttl = ttl
+        self.__folders = collections.OrderedDict()
+        self.__shares = collections.OrderedDict()
+        self.__guard = threading.Lock()
+        self.__stats = {'hits': 0, 'misses': 0, 'requests': 0, 'sharerequests': 0}
+
+    @property
+    def stats(self):
+        """ dict of hits, misses (not in the folder listing), requests (folders read) and sharerequests """
+        with self.__guard:
+            return dict(self.__stats)
+
+    def fileid(self, nxc, owner, path):
+        """
+        The file id of a file, reading the folder that holds it if it hasn't already been read.
+        :param nxc: nextcloud.NextCloud connected as the owner
+        :param owner: The owner of the file
+        :param path: The path of the file relative to the owners files
+        :return: The file id or None if the file is not in the folder listing
+        """
+        path = path.strip("/")
+        folder, _, filename = path.rpartition("/")
+        key = (owner, folder)
+        with self.__guard:
+            entries = None
+            if key in self.__folders:
+                read, entries = self.__folders[key]
+                if self.__ttl is not None and time.monotonic() - read > self.__ttl:
+                    del self.__folders[key]
+                    entries = None
+                else:
+                    self.__folders.move_to_end(key)
+        if entries is None:
+            entries = self.__read_folder(nxc, folder)
+            with self.__guard:
+                self.__stats['requests'] += 1
+                self.__folders[key] = (time.monotonic(), entries)
+                while len(self.__folders) > self.__maxfolders:
+                    self.__folders.popitem(last=False)
+        fileid = entries.get(filename)
+        with self.__guard:
+            self.__stats['hits' if fileid is not None else 'misses'] += 1
+        return fileid
+
+    def shares(self, owner, folder, lookup):
+        """
+        The public shares of a folder, asking lookup for them if they haven't already been read.
+        :param owner: The owner of the folder
+        :param folder: The path of the folder relative to the owners files
+        :param lookup: Called with no arguments to ask nextcloud for the shares.  Only a list is kept.
+        :return: What lookup returned
+        """
+        key = (owner, folder.strip("/"))
+        with self.__guard:
+            if key in self.__shares:
+                read, shares = self.__shares[key]
+                if self.__ttl is None or time.monotonic() - read <= self.__ttl:
+                    self.__shares.move_to_end(key)
+                    return shares
+                del self.__shares[key]
+        shares = lookup()
+        with self.__guard:
+            self.__stats['sharerequests'] += 1
+            if isinstance(shares, list):
+                self.__shares[key] = (time.monotonic(), shares)
+                while len(self.__shares) > self.__maxfolders:
+                    self.__shares.popitem(last=False)
+        return shares
+
+    def invalidate(self, owner, folder=None):
+        """
+        Forget the folder (or every folder for the owner if no folder is given), its listing and its shares
+        """
+        with self.__guard:
+            for cached in (self.__folders, self.__shares):
+                for key in list(cached):
+                    if key[0] == owner and (folder is None or key[1] == folder.strip("/")):
+                        del cached[key]
+
+    # ---------------------------- Private Methods ---------------------------------------
+
+    @staticmethod
+    def __read_folder(nxc, folder):
+        """ One Depth:1 PROPFIND on the folder asking only for the file id and type of each child """
+        applog.debug("Reading file ids for folder {}".format(folder or "/"))
+        try:
+            resp = nxc.list_folders(folder or None, depth=1, fields=['file_id', 'resource_type'])
+        except Exception as e:
+            # the caller asks for the file itself instead
+            applog.warning("Unable to read folder {} ({})".format(folder, str(e)))
+            return {}
+        if not resp.is_ok or resp.data is None:
+            applog.warning("Unable to read folder {} ({})".format(folder, resp.status_code))
+            return {}
+        return {item.basename(): item.file_id for item in resp.data if item.isfile()}
@@ -0,0 +1,141 @@
+import fcntl
+import logging
+import os
+import time
+
+from metrics import appmetrics
+
+applog = logging.getLogger('applog')
+
+
+class HostLimiter:
+    '''
+    Limit the number of copies of the program doing network work at the same time on this host.
+
+    A process may only proceed once it holds an flock on one of the slot files (slot.0 .. slot.N-1).  The
+    kernel drops the flock when the process exits, so a crashed process never leaks a slot.  Waiters take a
+    ticket in the queue directory and only the first maxconcurrent tickets compete for a slot, so events are
+    admitted in roughly the order they arrived.  A waiter gives up after maxwait seconds and raises
+    HostLimiterError.  If maxconcurrent is zero the limiter is disabled.
+
+    Usage:
+        with HostLimiter('/tmp/vnextcloud', 4, 300) as limiter:
+            # do network work
+            print(limiter.wait_time)
+    '''
+
+    class HostLimiterError(Exception):
+        pass
+
+    def __init__(self, lockdir, maxconcurrent, maxwait=300, pollinterval=0.25):
+        """
+        :param lockdir: The directory holding the slot and queue files.  Created if it does not exist.
+        :param maxconcurrent: The number of processes allowed to proceed at once. 0 disables the limiter.
+        :param maxwait: The maximum number of seconds to wait for a slot.
+        :param pollinterval: The number of seconds between attempts to get a slot.
+        """
+        if not isinstance(maxconcurrent, int) or maxconcurrent < 0:
+            raise self.HostLimiterError('maxconcurrent must be zero or a positive integer')
+        if maxconcurrent > 0 and (not isinstance(lockdir, str) or len(lockdir) == 0):
+            raise self.HostLimiterError('A lock directory is required')
+        self.__lockdir = lockdir
+        self.__maxconcurrent = maxconcurrent
+        self.__maxwait = maxwait
+        self.__pollinterval = pollinterval
+        self.__slotfd = None
+        self.__slot = None
+        self.__wait_time = 0.0
+
+    @property
+    def wait_time(self):
+        """ The number of seconds spent waiting for a slot """
+        return self.__wait_time
+
+    @property
+    def slot(self):
+        return self.__slot
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def acquire(self):
+        if self.__maxconcurrent == 0 or self.__slotfd is not None:
+            return
+        queuedir = os.path.join(self.__lockdir, 'queue')
+        os.makedirs(queuedir, exist_ok=True)
+        ticket = "{:020d}.{}".format(time.time_ns(), os.getpid())
+        ticketpath = os.path.join(queuedir, ticket)
+        open(ticketpath, 'w').close()
+        start = time.monotonic()
+        try:
+            while True:
+                if self.__queue_position(queuedir, ticket) < self.__maxconcurrent:
+                    if self.__try_slots():
+                        break
+                if time.monotonic() - start > self.__maxwait:
+                    self.__wait_time = time.monotonic() - start
+                    appmetrics.record('limiter_timeout', round(self.__wait_time, 3))
+                    applog.error("Gave up waiting for a processing slot after {:.1f} seconds".format(self.__wait_time))
+                    raise self.HostLimiterError(
+                        "Gave up waiting for a processing slot after {:.1f} seconds".format(self.__wait_time))
+                time.sleep(self.__pollinterval)
+        finally:
+            try:
+                os.remove(ticketpath)
+            except FileNotFoundError:
+                pass
+        self.__wait_time = time.monotonic() - start
+        applog.info("Processing slot {} acquired after {:.3f} seconds".format(self.__slot, self.__wait_time))
+        appmetrics.record('limiter_wait', round(self.__wait_time, 3), slot=self.__slot)
+
+    def release(self):
+        if self.__slotfd is None:
+            return
+        fcntl.flock(self.__slotfd, fcntl.LOCK_UN)
+        os.close(self.__slotfd)
+        applog.debug("Processing slot {} released".format(self.__slot))
+        self.__slotfd = None
+        self.__slot = None
+
+    def __try_slots(self):
+        for i in range(self.__maxconcurrent):
+            fd = os.open(os.path.join(self.__lockdir, "slot.{}".format(i)), os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue
+            self.__slotfd = fd
+            self.__slot = i
+            return True
+        return False
+
+    @staticmethod
+    def __queue_position(queuedir, ticket):
+        """
+        Return the number of live tickets ahead of this one.  Tickets for processes that have died
+        are removed.
+        """
+        position = 0
+        for t in sorted(os.listdir(queuedir)):
+            if t >= ticket:
+                break
+            try:
+                os.kill(int(t.split(".")[1]), 0)
+            except (IndexError, ValueError):
+                continue
+            except ProcessLookupError:
+                try:
+                    os.remove(os.path.join(queuedir, t))
+                except FileNotFoundError:
+                    pass
+                continue
+            except PermissionError:
+                # the process exists but belongs to someone else.
+                pass
+            position += 1
+        return position
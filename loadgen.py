@@ -0,0 +1,625 @@
+import argparse
+import base64
+import concurrent.futures
+import csv
+import datetime
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+import onxtcld
+from metrics import Metrics
+
+applog = logging.getLogger('applog')
+
+
+class StandInServer:
+    '''
+    A local stand-in for nextcloud and the pronto api, used by the load generator and the tests.
+
+    It answers just the requests NxtCld makes:
+        GET      /ocs/v1.php/cloud/users/<user>                      (connection check)
+        PROPFIND /remote.php/dav/files/<user>/<path>                 (file id, Depth 0 or 1)
+        GET      /ocs/v2.php/apps/files_sharing/api/v1/shares        (shares for a path)
+        POST     /ocs/v2.php/apps/files_sharing/api/v1/shares        (create a public share)
+        POST     /pronto/rest/<webresource>/login                    (pronto token)
+        POST     /pronto/rest/<webresource>/api/vapi-ql              (add or update the quicklink)
+
+    Files are created the first time they are asked for (or with add_file) and public shares when asked for
+    (or with add_share).  Requests can be delayed
+    (nclatency, prontolatency) and a fraction (errorrate) failed with a 503.  requests counts them per endpoint.
+
+    Usage:
+        with StandInServer(nclatency=0.05, prontolatency=0.2) as server:
+            thiscloud = onxtcld.NxtCld(server.url, 'quicklinks', 'anything')
+    '''
+
+    class StandInServerError(Exception):
+        pass
+
+    def __init__(self, nclatency=0.0, prontolatency=0.0, errorrate=0.0, seed=None, port=0):
+        """
+        :param nclatency: Seconds added to each nextcloud request
+        :param prontolatency: Seconds added to each pronto request
+        :param errorrate: Fraction (0 to 1) of requests answered with a 503
+        :param seed: Random seed for the errors (so a run can be repeated)
+        :param port: Port to listen on (0 picks a free port)
+        """
+        if errorrate < 0 or errorrate > 1:
+            raise self.StandInServerError('The error rate must be between 0 and 1')
+        self.nclatency = nclatency
+        self.prontolatency = prontolatency
+        self.errorrate = errorrate
+        self.__random = random.Random(seed)
+        # owner -> password.  Owners listed here must log in with that password.  Others may use any password.
+        self.passwords = {}
+        # False: a file that has not been added is not found (rather than added as it is asked for)
+        self.autocreate = True
+        # False: the pronto api ignores previousseq and registers a moved file again (a new seq)
+        self.prontoupdates = True
+        self.__port = port
+        self.__guard = threading.Lock()
+        self.__files = {}
+        self.__modified = {}
+        self.__shares = {}
+        self.__requests = {}
+        self.__nextid = 1000
+        self.__httpd = None
+        self.__thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def url(self):
+        if self.__httpd is None:
+            raise self.StandInServerError('The server has not been started')
+        return "http://127.0.0.1:{}".format(self.__httpd.server_address[1])
+
+    @property
+    def requests(self):
+        """ dict of the number of requests made to each endpoint """
+        with self.__guard:
+            return dict(self.__requests)
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server._handle(self)
+
+            def do_POST(self):
+                server._handle(self)
+
+            def do_PROPFIND(self):
+                server._handle(self)
+
+            def do_SEARCH(self):
+                server._handle(self)
+
+            def log_message(self, fmt, *args):
+                applog.debug("Stand-in server: " + fmt % args)
+
+        self.__httpd = ThreadingHTTPServer(('127.0.0.1', self.__port), Handler)
+        self.__httpd.daemon_threads = True
+        self.__thread = threading.Thread(target=self.__httpd.serve_forever, name='standinserver', daemon=True)
+        self.__thread.start()
+        applog.info("Stand-in server listening on {}".format(self.url))
+
+    def stop(self):
+        if self.__httpd is None:
+            return
+        self.__httpd.shutdown()
+        self.__httpd.server_close()
+        self.__thread.join()
+        self.__httpd = None
+
+    def add_file(self, owner, path, modified=None):
+        """
+        Add a file (if it is not already there)
+        :param modified: The modification time (seconds since the epoch).  Default: now.
+        :return: The file id
+        """
+        key = (owner, path.strip("/"))
+        with self.__guard:
+            if key not in self.__files:
+                self.__files[key] = self.__nextid
+                self.__nextid += 1
+            if modified is not None or key not in self.__modified:
+                self.__modified[key] = int(modified if modified is not None else time.time())
+            return self.__files[key]
+
+    def move_file(self, owner, path, newpath):
+        """
+        Move or rename a file.  As in nextcloud it keeps its file id and its share.
+        :return: The file id
+        """
+        key, newkey = (owner, path.strip("/")), (owner, newpath.strip("/"))
+        with self.__guard:
+            if key not in self.__files:
+                raise self.StandInServerError("No file {} for {}".format(path, owner))
+            self.__files[newkey] = self.__files.pop(key)
+            self.__modified[newkey] = self.__modified.pop(key, int(time.time()))
+            share = self.__shares.pop(key, None)
+            if share is not None:
+                share['path'] = "/" + newkey[1]
+                self.__shares[newkey] = share
+            return self.__files[newkey]
+
+    def add_share(self, owner, path, permissions=17):
+        """
+        Add a public share of a file or folder (if it has none)
+        :param permissions: The nextcloud permissions of the share.  17 (read and share) is nextcloud's default
+                            and 4 (create only) is a file drop.
+        :return: The share id
+        """
+        with self.__guard:
+            share = self.__shares.get((owner, path.strip("/")))
+            if share is None:
+                share = self.__new_share(owner, path.strip("/"), permissions)
+            return share['id']
+
+    def remove_share(self, owner, path):
+        """ Remove the public share of a file (as a user can in nextcloud) """
+        with self.__guard:
+            self.__shares.pop((owner, path.strip("/")), None)
+
+    # ---------------------------- Private Methods ---------------------------------------
+
+    def _handle(self, request):
+        """ Called by the request handler (on its own thread) for every request """
+        parts = urlsplit(request.path)
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length > 0 else b''
+        path = unquote(parts.path)
+        if path.startswith('/pronto/rest/'):
+            endpoint = 'pronto_token' if path.endswith('/login') else 'pronto_vapiql'
+            latency = self.prontolatency
+        elif request.command == 'SEARCH':
+            endpoint = 'nc_search'
+            latency = self.nclatency
+        elif path.startswith('/remote.php/dav/files/'):
+            endpoint = 'nc_propfind'
+            latency = self.nclatency
+        elif path.startswith('/ocs/v2.php/apps/files_sharing/api/v1/shares'):
+            endpoint = 'nc_create_share' if request.command == 'POST' else 'nc_get_shares'
+            latency = self.nclatency
+        elif path.startswith('/ocs/v1.php/cloud/users/'):
+            endpoint = 'nc_user'
+            latency = self.nclatency
+        else:
+            endpoint = 'unknown'
+            latency = 0
+        with self.__guard:
+            self.__requests[endpoint] = self.__requests.get(endpoint, 0) + 1
+            fail = self.__random.random() < self.errorrate
+        if latency > 0:
+            time.sleep(latency)
+        if fail:
+            self.__respond(request, 503, 'text/plain', 'Service Unavailable (stand-in error)')
+        elif endpoint.startswith('nc_') and not self.__authorised(request):
+            # what nextcloud answers for a wrong password
+            self.__respond(request, 401, 'application/json', json.dumps(
+                {'ocs': {'meta': {'status': 'failure', 'statuscode': 997, 'message': 'Current user is not logged in'},
+                         'data': []}}))
+        elif endpoint == 'nc_user':
+            user = path.rsplit('/', 1)[1]
+            self.__respond_ocs(request, 100, {'id': user, 'enabled': True})
+        elif endpoint == 'nc_propfind':
+            self.__propfind(request, path, request.headers.get('Depth', '1'))
+        elif endpoint == 'nc_search':
+            self.__search(request, body)
+        elif endpoint == 'nc_get_shares':
+            owner = self.__owner(request)
+            sharepath = parse_qs(parts.query).get('path', [''])[0].strip("/")
+            with self.__guard:
+                share = self.__shares.get((owner, sharepath))
+            self.__respond_ocs(request, 200, [share] if share is not None else [])
+        elif endpoint == 'nc_create_share':
+            owner = self.__owner(request)
+            sharepath = parse_qs(body.decode('UTF-8')).get('path', [''])[0].strip("/")
+            with self.__guard:
+                share = self.__shares.get((owner, sharepath))
+                if share is None:
+                    share = self.__new_share(owner, sharepath)
+            self.__respond_ocs(request, 200, share)
+        elif endpoint == 'pronto_token':
+            self.__respond(request, 200, 'application/xml',
+                           '<?xml version="1.0" encoding="UTF-8"?><LoginResponse><token>standin</token></LoginResponse>')
+        elif endpoint == 'pronto_vapiql':
+            try:
+                data = ET.fromstring(body)
+            except ET.ParseError:
+                data = ET.Element('Data')
+            filename = data.findtext('filename') or ''
+            # a moved file keeps its quicklink (previousseq)
+            seq = data.findtext('previousseq') if self.prontoupdates else None
+            if seq is None:
+                with self.__guard:
+                    self.__nextid += 1
+                    seq = self.__nextid
+            self.__respond(request, 200, 'application/xml',
+                           '<?xml version="1.0" encoding="UTF-8"?><vapi-qlResponse><APIResponseStatus>'
+                           '<Code>0</Code><Message>OK</Message></APIResponseStatus><ResponseFields>'
+                           '<company>1</company><object>stand-in</object><keys>{}</keys><seq>{}</seq>'
+                           '</ResponseFields></vapi-qlResponse>'.format(filename.replace('<', ''), seq))
+        else:
+            self.__respond(request, 404, 'text/plain', 'Not Found')
+
+    def __propfind(self, request, path, depth):
+        owner, _, filepath = path[len('/remote.php/dav/files/'):].partition('/')
+        filepath = filepath.strip("/")
+        with self.__guard:
+            isfile = (owner, filepath) in self.__files
+            children = sorted(p for (o, p) in self.__files if o == owner and
+                              (filepath == '' or p.startswith(filepath + "/")))
+        if not isfile and len(children) == 0:
+            if not self.autocreate:
+                self.__respond(request, 404, 'application/xml; charset=utf-8',
+                               '<?xml version="1.0" encoding="utf-8"?><d:error xmlns:d="DAV:" '
+                               'xmlns:s="http://sabredav.org/ns"><s:exception>Sabre\\DAV\\Exception\\NotFound'
+                               '</s:exception></d:error>')
+                return
+            isfile = True
+            self.add_file(owner, filepath)
+        responses = []
+        if isfile:
+            responses.append(self.__propfind_entry(owner, filepath, self.add_file(owner, filepath),
+                                                   self.__modified[(owner, filepath)]))
+        else:
+            responses.append(self.__propfind_entry(owner, filepath, None))
+            if depth == '1':
+                prefix = filepath + "/" if filepath else ''
+                folders = set()
+                for child in children:
+                    rest = child[len(prefix):]
+                    if "/" in rest:
+                        folders.add(prefix + rest.split("/", 1)[0])
+                    else:
+                        responses.append(self.__propfind_entry(owner, child, self.add_file(owner, child),
+                                                               self.__modified[(owner, child)]))
+                for folder in sorted(folders):
+                    responses.append(self.__propfind_entry(owner, folder, None))
+        self.__respond(request, 207, 'application/xml; charset=utf-8',
+                       '<?xml version="1.0"?><d:multistatus xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns" '
+                       'xmlns:nc="http://nextcloud.org/ns">' + "".join(responses) + '</d:multistatus>')
+
+    def __search(self, request, body):
+        # only what modified_since asks: files under the scope modified at or after the literal, oldest first
+        ns = {'d': 'DAV:'}
+        search = ET.fromstring(body)
+        scope = search.findtext('.//d:scope/d:href', '', ns)
+        since = int(search.findtext('.//d:where//d:literal', '0', ns))
+        limit = int(search.findtext('.//d:limit/d:nresults', '100', ns))
+        owner, _, folder = scope[len('/files/'):].partition('/')
+        folder = folder.strip("/")
+        with self.__guard:
+            found = sorted((self.__modified[(o, p)], p, fileid) for (o, p), fileid in self.__files.items()
+                           if o == owner and (folder == '' or p.startswith(folder + "/"))
+                           and self.__modified[(o, p)] >= since)[:limit]
+        responses = [self.__propfind_entry(owner, p, fileid, modified) for modified, p, fileid in found]
+        self.__respond(request, 207, 'application/xml; charset=utf-8',
+                       '<?xml version="1.0"?><d:multistatus xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns" '
+                       'xmlns:nc="http://nextcloud.org/ns">' + "".join(responses) + '</d:multistatus>')
+
+    def __propfind_entry(self, owner, path, fileid, modified=None):
+        # folders have no fileid of their own here; give them a stable one from the path
+        isfolder = fileid is None
+        if isfolder:
+            fileid = 1 + sum(ord(c) for c in owner + path)
+        href = quote('/remote.php/dav/files/{}/{}'.format(owner, path)) + ('/' if isfolder else '')
+        return ('<d:response><d:href>{}</d:href><d:propstat><d:prop><d:getlastmodified>{}</d:getlastmodified>'
+                '<d:resourcetype>{}</d:resourcetype><oc:fileid>{}</oc:fileid></d:prop>'
+                '<d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>').format(
+            href, formatdate(modified, usegmt=True), '<d:collection/>' if isfolder else '', fileid)
+
+    def __new_share(self, owner, sharepath, permissions=17):
+        # the caller holds the guard
+        self.__nextid += 1
+        share = {'id': str(self.__nextid), 'share_type': 3, 'path': "/" + sharepath, 'permissions': permissions,
+                 'url': "{}/index.php/s/standin{}".format(self.url, self.__nextid)}
+        self.__shares[(owner, sharepath)] = share
+        return share
+
+    def __authorised(self, request):
+        auth = request.headers.get('Authorization', '')
+        if not auth.startswith('Basic '):
+            return True
+        owner, _, password = base64.b64decode(auth[6:]).decode('UTF-8').partition(':')
+        return owner not in self.passwords or self.passwords[owner] == password
+
+    @staticmethod
+    def __owner(request):
+        # the user is only known from the basic authentication header
+        auth = request.headers.get('Authorization', '')
+        if auth.startswith('Basic '):
+            return base64.b64decode(auth[6:]).decode('UTF-8').split(':', 1)[0]
+        return ''
+
+    def __respond_ocs(self, request, statuscode, data):
+        self.__respond(request, 200, 'application/json', json.dumps(
+            {'ocs': {'meta': {'status': 'ok', 'statuscode': statuscode, 'message': 'OK'}, 'data': data}}))
+
+    @staticmethod
+    def __respond(request, status, contenttype, text):
+        body = text.encode('UTF-8')
+        request.send_response(status)
+        request.send_header('Content-Type', contenttype)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+
+class LoadGenerator:
+    '''
+    Replay a history of file events against the stand-in servers and report how the program copes.
+
+    The events come from the datalog or the applog (the Parameter File and Parameter Owner lines) and are
+    processed as main.py does.  speed is original (the logged spacing), max, or a number to divide the spacing
+    by.  concurrency is the number of events processed at once; the time events spend queued is reported apart
+    from the time taken to process them.
+
+    Usage:
+        events = LoadGenerator.read_datalog('/home/velocity/vnextcloud/datalog.txt')
+        with StandInServer(nclatency=0.05) as server:
+            report = LoadGenerator(events, speed='10', concurrency=4).run(server)
+        print(LoadGenerator.format_report(report))
+    '''
+
+    class LoadGeneratorError(Exception):
+        pass
+
+    def __init__(self, events, speed='max', concurrency=4, createshare=True, pronto=True, maxgap=None):
+        """
+        :param events: list of dicts with when (datetime), owner and path (see read_datalog)
+        :param speed: original, max or a speed up factor
+        :param concurrency: The number of events processed at once
+        :param createshare: Create a public share for each file (as --create-public-share)
+        :param pronto: Call the pronto api for each file
+        :param maxgap: Seconds.  Longer gaps between events (e.g. overnight) are shortened to this.
+        """
+        if len(events) == 0:
+            raise self.LoadGeneratorError('There are no events to replay')
+        if concurrency < 1:
+            raise self.LoadGeneratorError('The concurrency must be at least 1')
+        if speed == 'original':
+            self.__factor = 1.0
+        elif speed == 'max':
+            self.__factor = None
+        else:
+            try:
+                self.__factor = float(speed)
+            except ValueError:
+                raise self.LoadGeneratorError('Invalid speed {} (must be original, max or a number)'.format(speed))
+            if self.__factor <= 0:
+                raise self.LoadGeneratorError('The speed must be more than 0')
+        self.__events = sorted(events, key=lambda e: e['when'])
+        self.__concurrency = concurrency
+        self.__createshare = createshare
+        self.__pronto = pronto
+        self.__maxgap = maxgap
+
+    @staticmethod
+    def read_datalog(filename):
+        """
+        Read the events from a datalog (date|time|file|owner|url|shareid|fileid)
+        :return: list of dicts with when, owner and path
+        """
+        events = []
+        with open(filename, 'r', newline='') as f:
+            for row in csv.DictReader(f, delimiter="|"):
+                try:
+                    when = datetime.datetime.strptime(row['date'] + " " + row['time'], "%Y-%m-%d %H:%M:%S")
+                except (ValueError, TypeError):
+                    continue
+                if row.get('file') and row.get('owner'):
+                    events.append({'when': when, 'owner': row['owner'], 'path': row['file']})
+        return events
+
+    @staticmethod
+    def read_applog(filename, nextcloudroot):
+        """
+        Read the events from an applog.  Each event is a Parameter File line followed by its Parameter Owner line.
+        :param nextcloudroot: The nextcloud data root, removed from the logged file name
+        :return: list of dicts with when, owner and path
+        """
+        events = []
+        pending = None
+        with open(filename, 'r', errors='replace') as f:
+            for line in f:
+                flds = line.rstrip("\n").split("|", 5)
+                if len(flds) != 6:
+                    continue
+                if flds[5].startswith('Parameter File:'):
+                    try:
+                        when = datetime.datetime.strptime(flds[0] + " " + flds[1], "%Y-%m-%d %H:%M:%S")
+                    except ValueError:
+                        continue
+                    pending = {'when': when, 'file': flds[5][len('Parameter File:'):]}
+                elif flds[5].startswith('Parameter Owner:') and pending is not None:
+                    owner = flds[5][len('Parameter Owner:'):]
+                    # same as main.py: <root>/<owner>/files/<path>
+                    path = pending['file'][len(nextcloudroot) + len(owner) + 1 + 6:]
+                    if len(path) > 0:
+                        events.append({'when': pending['when'], 'owner': owner, 'path': path})
+                    pending = None
+        return events
+
+    def schedule(self):
+        """
+        The offset in seconds from the start of the run at which each event is released
+        :return: list of (offset, event)
+        """
+        offsets = []
+        offset = 0.0
+        previous = self.__events[0]['when']
+        for event in self.__events:
+            gap = (event['when'] - previous).total_seconds()
+            if self.__maxgap is not None:
+                gap = min(gap, self.__maxgap)
+            if self.__factor is not None:
+                offset += gap / self.__factor
+            offsets.append((offset, event))
+            previous = event['when']
+        return offsets
+
+    def run(self, server):
+        """
+        Replay the events against the server
+        :param server: A started StandInServer
+        :return: dict report (see format_report)
+        """
+        results = []
+        started = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.__concurrency) as pool:
+            futures = []
+            for offset, event in self.schedule():
+                delay = started + offset - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(pool.submit(self.__replay_one, server, event, started + offset))
+            for future in futures:
+                results.append(future.result())
+        duration = time.monotonic() - started
+        return self.__report(results, duration, server.requests)
+
+    @staticmethod
+    def format_report(report):
+        """ The report as printable text """
+        lines = ["Events      : {}".format(report['events']),
+                 "Duration    : {:.3f} seconds".format(report['duration']),
+                 "Throughput  : {:.2f} events/second".format(report['throughput']),
+                 "Errors      : {} ({:.1%})".format(report['errors'], report['errorrate'])]
+        for name in ('latency', 'queued'):
+            lines.append("{:<12}: ".format(name.capitalize()) + " ".join(
+                ["{}={}".format(k, v) for k, v in report[name].items()]))
+        lines.append("Stage means : " + " ".join(["{}={}".format(k, v) for k, v in report['stages'].items()]))
+        lines.append("Requests    : " + " ".join(["{}={}".format(k, v) for k, v in sorted(report['requests'].items())]))
+        for message, count in sorted(report['errormessages'].items(), key=lambda i: -i[1]):
+            lines.append("  {:>6} x {}".format(count, message))
+        return "\n".join(lines)
+
+    # ---------------------------- Private Methods ---------------------------------------
+
+    def __replay_one(self, server, event, due):
+        begun = time.monotonic()
+        result = {'queued': max(begun - due, 0.0), 'error': None, 'timings': {}}
+        thiscloud = None
+        try:
+            thiscloud = onxtcld.NxtCld(server.url, event['owner'], 'loadtest')
+            thiscloud.file_path = event['path']
+            thiscloud.optionally_create_public_share = self.__createshare
+            if self.__pronto:
+                thiscloud.add_pronto_quicklink(server.url, 'loadtest', 'loadtest', 'loadtest')
+            else:
+                # reading the share url processes the shares
+                thiscloud.share_url
+        except Exception as e:
+            result['error'] = str(e)[:80]
+        result['latency'] = time.monotonic() - begun
+        if thiscloud is not None:
+            result['timings'] = thiscloud.timings
+        return result
+
+    @staticmethod
+    def __report(results, duration, requests):
+        def percentiles(values):
+            values = sorted(values)
+            return {'p50': round(Metrics.percentile(values, 50), 3),
+                    'p95': round(Metrics.percentile(values, 95), 3),
+                    'p99': round(Metrics.percentile(values, 99), 3),
+                    'max': round(values[-1], 3)}
+
+        errormessages = {}
+        stages = {}
+        for r in results:
+            if r['error'] is not None:
+                errormessages[r['error']] = errormessages.get(r['error'], 0) + 1
+            for stage, seconds in r['timings'].items():
+                stages.setdefault(stage, []).append(seconds)
+        errors = sum(errormessages.values())
+        return {'events': len(results),
+                'duration': duration,
+                'throughput': len(results) / duration if duration > 0 else 0.0,
+                'errors': errors,
+                'errorrate': errors / len(results),
+                'latency': percentiles([r['latency'] for r in results]),
+                'queued': percentiles([r['queued'] for r in results]),
+                'stages': {k: round(sum(v) / len(v), 3) for k, v in stages.items()},
+                'requests': requests,
+                'errormessages': errormessages}
+
+
+def process_arguments():
+    parser = argparse.ArgumentParser(description="Replay logged file events against stand-in servers")
+    parser.add_argument('--datalog', action='store', required=False,
+                        help="Datalog to replay")
+    parser.add_argument('--applog', action='store', required=False,
+                        help="Application log to replay (requires --nextcloudroot)")
+    parser.add_argument('--nextcloudroot', action='store', required=False,
+                        help="The nextcloud data root used when the applog was written")
+    parser.add_argument('--speed', action='store', required=False, default='max',
+                        help="original, max or a speed up factor (default max)")
+    parser.add_argument('--concurrency', action='store', type=int, required=False, default=4,
+                        help="Number of events processed at once (default 4)")
+    parser.add_argument('--maxgap', action='store', type=float, required=False,
+                        help="Shorten gaps between events to this many seconds")
+    parser.add_argument('--nc-latency', action='store', type=float, required=False, default=0.0,
+                        help="Seconds added to each nextcloud request")
+    parser.add_argument('--pronto-latency', action='store', type=float, required=False, default=0.0,
+                        help="Seconds added to each pronto request")
+    parser.add_argument('--error-rate', action='store', type=float, required=False, default=0.0,
+                        help="Fraction of requests that fail (0 to 1)")
+    parser.add_argument('--seed', action='store', type=int, required=False,
+                        help="Random seed for the errors")
+    parser.add_argument('--no-share', action='store_true', required=False,
+                        help="Do not create public shares")
+    parser.add_argument('--no-pronto', action='store_true', required=False,
+                        help="Do not call the pronto api")
+    parser.add_argument('--json', action='store_true', required=False,
+                        help="Print the report as json")
+    args = parser.parse_args()
+    if (args.datalog is None) == (args.applog is None):
+        parser.error("One of --datalog or --applog is required")
+    if args.applog is not None and args.nextcloudroot is None:
+        parser.error("--applog requires --nextcloudroot")
+    return args
+
+
+if __name__ == '__main__':
+    try:
+        pgm_args = process_arguments()
+        # failures are counted in the report rather than logged as they happen
+        applog.addHandler(logging.NullHandler())
+        if pgm_args.datalog is not None:
+            replay = LoadGenerator.read_datalog(pgm_args.datalog)
+        else:
+            replay = LoadGenerator.read_applog(pgm_args.applog, pgm_args.nextcloudroot)
+        print("{} events to replay".format(len(replay)))
+        generator = LoadGenerator(replay, speed=pgm_args.speed, concurrency=pgm_args.concurrency,
+                                  createshare=not pgm_args.no_share, pronto=not pgm_args.no_pronto,
+                                  maxgap=pgm_args.maxgap)
+        with StandInServer(pgm_args.nc_latency, pgm_args.pronto_latency, pgm_args.error_rate,
+                           pgm_args.seed) as standin:
+            loadreport = generator.run(standin)
+        if pgm_args.json:
+            print(json.dumps(loadreport, indent=2))
+        else:
+            print(LoadGenerator.format_report(loadreport))
+    except Exception as e:
+        print(str(e))
+        sys.exit(1)
@@ -0,0 +1,211 @@
+import datetime
+import gzip
+import logging
+import os
+
+from metrics import Metrics
+
+applog = logging.getLogger('applog')
+
+
+class LogStats:
+    '''
+    Stage latencies (p50, p95, p99) per stage and per owner from the application logs.
+
+    The logs (current, rotated and gzipped) are read a line at a time.  An event's Timings line gives its exact
+    stage times.  Older logs have no Timings line, so the event is rebuilt from the lines always written; these
+    are only accurate to a second, and events that overlap in the log are counted as incomplete.
+
+    Usage:
+        stats = LogStats(since=datetime.datetime(2024, 7, 1))
+        for logfile in LogStats.log_files('/home/velocity/vnextcloud/vnextcloud.log'):
+            stats.add_file(logfile)
+        print(stats.format_report())
+    '''
+
+    class LogStatsError(Exception):
+        pass
+
+    # message prefix -> the stage that starts at that line
+    MILESTONES = (('App Started', 'connect'),
+                  ('Successful Connection to URL', 'fileid'),
+                  ('Getting First Public Share', 'shares'),
+                  ('Private share only', 'shares'),
+                  ('Adding file to data log', 'datalog'),
+                  ('Create Quicklink via API', 'pronto'),
+                  ('Quicklinks API Successful', None))
+
+    def __init__(self, since=None, until=None, owner=None):
+        """
+        :param since: datetime.  Events starting before this are ignored.
+        :param until: datetime.  Events starting after this are ignored.
+        :param owner: Only report events for this owner
+        """
+        self.__since = since
+        self.__until = until
+        self.__owner = owner
+        self.__durations = {}
+        self.__counts = {'timings': 0, 'rebuilt': 0, 'incomplete': 0, 'errors': 0}
+        self.__current = None
+
+    @property
+    def counts(self):
+        """ dict of the number of events from Timings lines, rebuilt events, incomplete events and errors """
+        return dict(self.__counts)
+
+    @staticmethod
+    def log_files(applog_name, backups=3):
+        """
+        The current and rotated logs (and gzipped copies of them) that exist, oldest first.
+        :param applog_name: The application log from the configuration file
+        :param backups: The number of rotated logs kept
+        :return: list of file names
+        """
+        files = []
+        for i in range(backups, 0, -1):
+            for name in ("{}.{}.gz".format(applog_name, i), "{}.{}".format(applog_name, i)):
+                if os.path.isfile(name):
+                    files.append(name)
+        for name in (applog_name + '.gz', applog_name):
+            if os.path.isfile(name):
+                files.append(name)
+        return files
+
+    def add_file(self, filename):
+        """ Read one log file (gzipped if the name ends in .gz) """
+        applog.debug("Reading log {}".format(filename))
+        opener = gzip.open if filename.endswith('.gz') else open
+        try:
+            with opener(filename, 'rt', errors='replace') as f:
+                for line in f:
+                    self.add_line(line)
+        except OSError as e:
+            raise self.LogStatsError("Unable to read log {} ({})".format(filename, str(e)))
+
+    def add_line(self, line):
+        """ Process one log line (date|time|file|funcName|level|message) """
+        flds = line.rstrip("\n").split("|", 5)
+        if len(flds) != 6:
+            return
+        message = flds[5]
+        if message.startswith('Timings '):
+            self.__add_timings(self.__parse_time(flds), message)
+            return
+        if message.startswith('App Started'):
+            if self.__current is not None:
+                # the previous event never finished in this log (or it overlaps another event)
+                self.__counts['incomplete'] += 1
+            when = self.__parse_time(flds)
+            self.__current = {'start': when, 'owner': None, 'marks': [(when, 'connect')], 'overlap': False}
+            return
+        when = self.__parse_time(flds)
+        if message.startswith('Error occured'):
+            # written after the Timings line, so counted whether or not an event is open
+            if self.__in_window(when):
+                self.__counts['errors'] += 1
+            self.__current = None
+            return
+        if self.__current is None:
+            return
+        if message.startswith('Parameter Owner:'):
+            self.__current['owner'] = message[len('Parameter Owner:'):]
+        else:
+            for prefix, stage in self.MILESTONES[1:]:
+                if message.startswith(prefix):
+                    if stage is not None and stage in [m[1] for m in self.__current['marks']]:
+                        # a second event's lines are mixed in with this one
+                        self.__current['overlap'] = True
+                    self.__current['marks'].append((when, stage))
+                    if stage is None:
+                        self.__finish_rebuilt()
+                    break
+
+    def report(self):
+        """
+        :return: dict of owner ('(all)' for every owner) -> stage -> dict of count, p50, p95, p99 and max
+        """
+        report = {}
+        for owner in sorted(self.__durations, key=lambda o: (o != '(all)', o)):
+            report[owner] = {}
+            # total first, then the stages in the order they were first seen
+            for stage, values in sorted(self.__durations[owner].items(), key=lambda i: i[0] != 'total'):
+                values = sorted(values)
+                report[owner][stage] = {'count': len(values),
+                                        'p50': Metrics.percentile(values, 50),
+                                        'p95': Metrics.percentile(values, 95),
+                                        'p99': Metrics.percentile(values, 99),
+                                        'max': values[-1]}
+        return report
+
+    def format_report(self):
+        """ The report as printable text """
+        lines = ["Events: {} from Timings lines, {} rebuilt (1 second resolution), {} incomplete, {} errors".format(
+            self.__counts['timings'], self.__counts['rebuilt'], self.__counts['incomplete'], self.__counts['errors'])]
+        lines.append("{:<20} {:<10} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+            'owner', 'stage', 'count', 'p50', 'p95', 'p99', 'max'))
+        for owner, stages in self.report().items():
+            for stage, s in stages.items():
+                lines.append("{:<20} {:<10} {:>7} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}".format(
+                    owner, stage, s['count'], s['p50'], s['p95'], s['p99'], s['max']))
+        return "\n".join(lines)
+
+    # ---------------------------- Private Methods ---------------------------------------
+
+    @staticmethod
+    def __parse_time(flds):
+        try:
+            return datetime.datetime.strptime(flds[0] + " " + flds[1], "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            return None
+
+    def __add_timings(self, when, message):
+        # the Timings line is exact so any rebuilt version of the same event is dropped
+        self.__current = None
+        values = {}
+        for pair in message[len('Timings '):].split(" "):
+            if "=" in pair:
+                k, v = pair.split("=", 1)
+                values[k] = v
+        owner = values.pop('owner', '')
+        stages = {}
+        for k, v in values.items():
+            try:
+                stages[k] = float(v)
+            except ValueError:
+                continue
+        if self.__record(when, owner, stages):
+            self.__counts['timings'] += 1
+
+    def __finish_rebuilt(self):
+        event = self.__current
+        self.__current = None
+        if event['overlap'] or None in [m[0] for m in event['marks']]:
+            self.__counts['incomplete'] += 1
+            return
+        stages = {}
+        marks = event['marks']
+        for (started, stage), (ended, nextstage) in zip(marks, marks[1:]):
+            stages[stage] = stages.get(stage, 0.0) + (ended - started).total_seconds()
+        stages['total'] = (marks[-1][0] - marks[0][0]).total_seconds()
+        if self.__record(event['start'], event['owner'] or '', stages):
+            self.__counts['rebuilt'] += 1
+
+    def __in_window(self, when):
+        if when is None:
+            return False
+        if self.__since is not None and when < self.__since:
+            return False
+        if self.__until is not None and when > self.__until:
+            return False
+        return True
+
+    def __record(self, when, owner, stages):
+        if not self.__in_window(when):
+            return False
+        if self.__owner is not None and owner != self.__owner:
+            return False
+        for key in ('(all)', owner):
+            durations = self.__durations.setdefault(key, {})
+            for stage, seconds in stages.items():
+                durations.setdefault(stage, []).append(seconds)
+        return True
@@ -0,0 +1,126 @@
+import collections
+import logging
+import sys
+import threading
+import time
+
+applog = logging.getLogger('applog')
+
+
+class LRUCache:
+    '''
+    A least recently used cache bounded by memory, whose entries also expire after ttl seconds.
+
+    Adding an entry evicts the least recently used entries until the cache fits in maxbytes.  An entry older
+    than ttl seconds is dropped, so a change made outside the process is seen within ttl seconds.  The size of
+    an entry is an estimate (sys.getsizeof of everything in it).  It is safe to share between threads.  stats
+    gives the hits, misses, evictions, expired entries, entries and bytes.
+
+    Usage:
+        cache = LRUCache(maxbytes=16000000, ttl=300)
+        shares = cache.get(('shares', 'quicklinks', 'Documents/EQ100.pdf'))
+        if shares is None:
+            # ask nextcloud then
+            cache.put(('shares', 'quicklinks', 'Documents/EQ100.pdf'), shares)
+    '''
+
+    class LRUCacheError(Exception):
+        pass
+
+    def __init__(self, maxbytes=16000000, ttl=300):
+        """
+        :param maxbytes: The most memory (estimated) the entries may take
+        :param ttl: Seconds an entry is kept
+        """
+        if maxbytes <= 0 or ttl <= 0:
+            raise self.LRUCacheError('maxbytes and ttl must be more than 0')
+        self.__maxbytes = maxbytes
+        self.__ttl = ttl
+        # key -> (expires, bytes, value), least recently used first
+        self.__entries = collections.OrderedDict()
+        self.__bytes = 0
+        self.__guard = threading.Lock()
+        self.__stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0}
+
+    @property
+    def maxbytes(self):
+        return self.__maxbytes
+
+    @property
+    def ttl(self):
+        return self.__ttl
+
+    @property
+    def stats(self):
+        """ dict of hits, misses, evictions, expired, entries and bytes """
+        with self.__guard:
+            return dict(self.__stats, entries=len(self.__entries), bytes=self.__bytes)
+
+    def get(self, key):
+        """
+        :param key: A hashable key e.g. ('shares', owner, path)
+        :return: The value, or None if it is not in the cache (or has expired)
+        """
+        with self.__guard:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                self.__remove(key)
+                self.__stats['expired'] += 1
+                entry = None
+            if entry is None:
+                self.__stats['misses'] += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.__stats['hits'] += 1
+            return entry[2]
+
+    def put(self, key, value):
+        """
+        Add (or replace) an entry, evicting the least recently used entries to make room.  A value bigger than
+        the whole cache is not kept.
+        :param key: A hashable key
+        :param value: The value (not None)
+        """
+        size = self.footprint(key) + self.footprint(value)
+        with self.__guard:
+            if key in self.__entries:
+                self.__remove(key)
+            if size > self.__maxbytes:
+                applog.debug("Cache entry {} ({} bytes) is bigger than the cache".format(key, size))
+                return
+            while self.__bytes + size > self.__maxbytes:
+                self.__remove(next(iter(self.__entries)))
+                self.__stats['evictions'] += 1
+            self.__entries[key] = (time.monotonic() + self.__ttl, size, value)
+            self.__bytes += size
+
+    def invalidate(self, key):
+        """ Remove an entry (if it is there) """
+        with self.__guard:
+            if key in self.__entries:
+                self.__remove(key)
+
+    def clear(self):
+        with self.__guard:
+            self.__entries.clear()
+            self.__bytes = 0
+
+    def __len__(self):
+        with self.__guard:
+            return len(self.__entries)
+
+    @staticmethod
+    def footprint(value):
+        """ The estimated memory (bytes) taken by a value and everything inside it """
+        size = sys.getsizeof(value)
+        if isinstance(value, dict):
+            size += sum(LRUCache.footprint(k) + LRUCache.footprint(v) for k, v in value.items())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            size += sum(LRUCache.footprint(v) for v in value)
+        return size
+
+    # ---------------------------- Private Methods ---------------------------------------
+
+    def __remove(self, key):
+        expires, size, value = self.__entries.pop(key)
+        self.__bytes -= size
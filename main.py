@@ -1,11 +1,35 @@
 import argparse
+import datetime
+import fcntl
+import json
+import multiprocessing
 import os.path
+import queue
+import threading
+import time
+import zlib
 
 import onxtcld
 import sys
 import logging
 from prontoencryption import ProntoEncryption
-from logging.handlers import RotatingFileHandler
+from hostlimiter import HostLimiter
+from eventfilter import EventFilter
+from qlledger import QuicklinkLedger
+from slowprofile import SlowEventProfiler
+from logstats import LogStats
+from foldercache import FolderCache
+from lrucache import LRUCache
+from adaptive import AdaptiveLimiter
+from negcache import NegativeCache
+from filecache import FileCacheResolver
+from spool import Spool
+from digest import DigestNotifier
+from breaker import CircuitBreaker
+from resources import ResourceMeter, ResourceTotals
+from sinks import SinkRunner, DatalogSink, ProntoSink, WebhookSink, JsonlSink
+from metrics import appmetrics
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 import configparser
 
 applog = logging.getLogger('applog')
@@ -19,6 +43,27 @@ global_prontoapiwebresource = None
 global_prontoapiuser = None
 global_prontoapipassword = None
 global_users = []
+global_metricslog = None
+global_lockdir = '/tmp/vnextcloud'
+global_maxconcurrent = 0
+global_maxwait = 300
+global_eventfilter = None
+global_reusefoldershare = False
+global_ledger = None
+global_profilethreshold = 0
+global_profilemode = 'cprofile'
+global_profiledir = None
+global_profilemaxbytes = 10000000
+global_results = None
+global_notifier = None
+global_settings = None
+# a file that fails this many polls running is passed over (see poll_owner)
+POLL_RETRIES = 3
+# seconds each sink is given (sinktimeouts in the ini file)
+SINK_TIMEOUTS = {'datalog': 10, 'pronto': 60, 'webhook': 10, 'jsonl': 10}
+# the exit code of a single event whose failure is not in the digest (e.g. the configuration could not be read),
+# so vnextcloud.sh mails it.  A file that fails once the digest has its result exits 1.
+EXIT_UNREPORTED = 2
 
 
 def process_config(configfilename):
@@ -30,13 +75,8 @@ def process_config(configfilename):
     :param configfilename:
     :return:
     """
-    config = configparser.ConfigParser()
-    config.read(configfilename)
-    sections = config.sections()
-    if 'SETUP' not in sections:
-        raise ValueError("Setup section missing from config file (File : {})".format(configfilename))
-    if 'USERPASSWORDS' not in sections:
-        raise ValueError("User Passwords section missing from config file (File : {})".format(configfilename))
+    settings = read_config(configfilename)
+    global global_settings
     global global_url
     global global_applog
     global global_datalog
@@ -47,43 +87,229 @@ def process_config(configfilename):
     global global_prontoapiwebresource
     global global_prontoapiuser
     global global_prontoapipassword
+    global global_metricslog
+    global global_lockdir
+    global global_maxconcurrent
+    global global_maxwait
+    global global_eventfilter
+    global global_reusefoldershare
+    global global_ledger
+    global global_profilethreshold
+    global global_profilemode
+    global global_profiledir
+    global global_profilemaxbytes
+    global global_notifier
+    global_settings = settings
+    global_url = settings['url']
+    global_nextcloudroot = settings['nextcloudroot']
+    global_applog = settings['applog']
+    global_loglevel = settings['loglevel']
+    global_datalog = settings['datalog']
+    global_prontourl = settings['prontourl']
+    global_prontoapiwebresource = settings['prontoapiwebresource']
+    global_prontoapiuser = settings['prontoapiuser']
+    global_prontoapipassword = settings['prontoapipassword']
+    global_metricslog = settings['metricslog']
+    global_lockdir = settings['lockdir']
+    global_maxconcurrent = settings['maxconcurrent']
+    global_maxwait = settings['maxwait']
+    global_reusefoldershare = settings['reusefoldershare']
+    global_ledger = settings['ledger']
+    global_profilethreshold = settings['profilethreshold']
+    global_profilemode = settings['profilemode']
+    global_profiledir = settings['profiledir']
+    global_profilemaxbytes = settings['profilemaxbytes']
+    global_eventfilter = settings['eventfilter']
+    global_notifier = digest_notifier(settings)
+    global_users = settings['users']
+
+
+def read_config(configfilename):
+    """
+    Read a configuration file into a settings dict (one key per SETUP key, plus users and eventfilter).
+    Used by process_config for the command line and by the service for each tenant.
+
+    ****** Note that logging has not yet been established *********
+
+    :param configfilename:
+    :return: dict of settings
+    """
+    config = configparser.ConfigParser()
+    config.read(configfilename)
+    sections = config.sections()
+    if 'SETUP' not in sections:
+        raise ValueError("Setup section missing from config file (File : {})".format(configfilename))
+    if 'USERPASSWORDS' not in sections:
+        raise ValueError("User Passwords section missing from config file (File : {})".format(configfilename))
+    settings = {'url': None,
+                'nextcloudroot': None,
+                'applog': None,
+                'loglevel': 'DEBUG',
+                'datalog': None,
+                'prontourl': None,
+                'prontoapiwebresource': None,
+                'prontoapiuser': None,
+                'prontoapipassword': None,
+                'metricslog': None,
+                'lockdir': '/tmp/vnextcloud',
+                'maxconcurrent': 0,
+                'maxwait': 300,
+                'reusefoldershare': False,
+                'ledger': None,
+                'profilethreshold': 0,
+                'profilemode': 'cprofile',
+                'profiledir': None,
+                'profilemaxbytes': 10000000,
+                'ratelimit': 0,
+                'adaptivemax': 0,
+                'latencytarget': 0,
+                'negativecache': None,
+                'negativettl': 60,
+                'watermark': None,
+                'filecachedb': None,
+                'filecachepassword': None,
+                'filecacheprefix': 'oc_',
+                'webhook': None,
+                'jsonlog': None,
+                'sinktimeouts': dict(SINK_TIMEOUTS),
+                'digestdb': None,
+                'digestto': [],
+                'digestinterval': 60,
+                'digesterrors': 5,
+                'digestslow': 30,
+                'smtphost': 'localhost',
+                'breakerdir': None,
+                'breakerfailures': 5,
+                'breakerreset': 60,
+                'deferdir': None,
+                'lagslo': {},
+                'lookupcachebytes': 16000000,
+                'lookupcachettl': 300,
+                'eventfilter': None,
+                'users': []}
     try:
         if 'url' in config['SETUP']:
-            global_url = config['SETUP']['url']
+            settings['url'] = config['SETUP']['url']
         else:
             raise ValueError('Nextcloud URL not specified in Configuration File')
         if 'nextcloudroot' in config['SETUP']:
-            global_nextcloudroot = config['SETUP']['nextcloudroot']
+            settings['nextcloudroot'] = config['SETUP']['nextcloudroot']
         else:
             raise ValueError('Nextcloud data root not specified in Configuration File.')
         if 'applog' in config['SETUP']:
-            global_applog = config['SETUP']['applog']
+            settings['applog'] = config['SETUP']['applog']
             # do not set the loglevel unless the logfile has also been set.
             if 'loglevel' in config['SETUP']:
-                global_loglevel = config['SETUP']['loglevel'].upper()
+                settings['loglevel'] = config['SETUP']['loglevel'].upper()
         else:
             print("WARNING:No Application Logging Defined")
         if 'datalog' in config['SETUP']:
-            global_datalog = config['SETUP']['datalog']
+            settings['datalog'] = config['SETUP']['datalog']
         if 'prontourl' in config['SETUP']:
-            global_prontourl = config['SETUP']['prontourl']
+            settings['prontourl'] = config['SETUP']['prontourl']
             if 'prontoapiwebresource' in config['SETUP']:
-                global_prontoapiwebresource = config['SETUP']['prontoapiwebresource']
+                settings['prontoapiwebresource'] = config['SETUP']['prontoapiwebresource']
             if 'prontoapiuser' in config['SETUP']:
-                global_prontoapiuser = config['SETUP']['prontoapiuser']
+                settings['prontoapiuser'] = config['SETUP']['prontoapiuser']
             if 'prontoapipassword' in config['SETUP']:
-                global_prontoapipassword = passworddecrypt(config['SETUP']['prontoapipassword'])
-            if global_prontourl is not None \
-                    and ( global_prontoapipassword is None
-                          or global_prontoapiwebresource is None
-                          or global_prontoapiuser is None):
+                settings['prontoapipassword'] = passworddecrypt(config['SETUP']['prontoapipassword'])
+            if settings['prontourl'] is not None \
+                    and ( settings['prontoapipassword'] is None
+                          or settings['prontoapiwebresource'] is None
+                          or settings['prontoapiuser'] is None):
                 applog.error("Pronto API is not configured correctly")
                 raise ConnectionError("Pronto API is not configured correctly")
+        if 'metricslog' in config['SETUP']:
+            settings['metricslog'] = config['SETUP']['metricslog']
+        if 'lockdir' in config['SETUP']:
+            settings['lockdir'] = config['SETUP']['lockdir']
+        if 'maxconcurrent' in config['SETUP']:
+            settings['maxconcurrent'] = config['SETUP'].getint('maxconcurrent')
+        if 'maxwait' in config['SETUP']:
+            settings['maxwait'] = config['SETUP'].getint('maxwait')
+        if 'reusefoldershare' in config['SETUP']:
+            settings['reusefoldershare'] = config['SETUP'].getboolean('reusefoldershare')
+        if 'ledger' in config['SETUP']:
+            settings['ledger'] = config['SETUP']['ledger']
+        if 'profilethreshold' in config['SETUP']:
+            settings['profilethreshold'] = config['SETUP'].getfloat('profilethreshold')
+        if 'profilemode' in config['SETUP']:
+            settings['profilemode'] = config['SETUP']['profilemode'].lower()
+        if 'profiledir' in config['SETUP']:
+            settings['profiledir'] = config['SETUP']['profiledir']
+        elif settings['applog'] is not None:
+            # profile dumps go alongside the applog
+            settings['profiledir'] = os.path.join(os.path.dirname(settings['applog']), 'profiles')
+        if 'profilemaxbytes' in config['SETUP']:
+            settings['profilemaxbytes'] = config['SETUP'].getint('profilemaxbytes')
+        if 'ratelimit' in config['SETUP']:
+            settings['ratelimit'] = config['SETUP'].getfloat('ratelimit')
+        if 'adaptivemax' in config['SETUP']:
+            settings['adaptivemax'] = config['SETUP'].getint('adaptivemax')
+        if 'latencytarget' in config['SETUP']:
+            settings['latencytarget'] = config['SETUP'].getfloat('latencytarget')
+        if 'negativecache' in config['SETUP']:
+            settings['negativecache'] = config['SETUP']['negativecache']
+        if 'negativettl' in config['SETUP']:
+            settings['negativettl'] = config['SETUP'].getint('negativettl')
+        if 'watermark' in config['SETUP']:
+            settings['watermark'] = config['SETUP']['watermark']
+        if 'filecachedb' in config['SETUP']:
+            settings['filecachedb'] = config['SETUP']['filecachedb']
+            if 'filecachepassword' in config['SETUP']:
+                settings['filecachepassword'] = passworddecrypt(config['SETUP']['filecachepassword'])
+            if 'filecacheprefix' in config['SETUP']:
+                settings['filecacheprefix'] = config['SETUP']['filecacheprefix']
+        if 'webhook' in config['SETUP']:
+            settings['webhook'] = config['SETUP']['webhook']
+        if 'jsonlog' in config['SETUP']:
+            settings['jsonlog'] = config['SETUP']['jsonlog']
+        if 'sinktimeouts' in config['SETUP']:
+            # e.g. pronto=60, webhook=5
+            for item in config['SETUP']['sinktimeouts'].split(","):
+                if len(item.strip()) == 0:
+                    continue
+                sink, seconds = item.split("=", 1)
+                settings['sinktimeouts'][sink.strip().lower()] = float(seconds)
+        if 'digestdb' in config['SETUP']:
+            settings['digestdb'] = config['SETUP']['digestdb']
+        if 'digestto' in config['SETUP']:
+            settings['digestto'] = [a.strip() for a in config['SETUP']['digestto'].split(",") if len(a.strip()) > 0]
+        if 'digestinterval' in config['SETUP']:
+            settings['digestinterval'] = config['SETUP'].getfloat('digestinterval')
+        if 'digesterrors' in config['SETUP']:
+            settings['digesterrors'] = config['SETUP'].getint('digesterrors')
+        if 'digestslow' in config['SETUP']:
+            settings['digestslow'] = config['SETUP'].getfloat('digestslow')
+        if 'smtphost' in config['SETUP']:
+            settings['smtphost'] = config['SETUP']['smtphost']
+        if 'breakerdir' in config['SETUP']:
+            settings['breakerdir'] = config['SETUP']['breakerdir']
+        if 'breakerfailures' in config['SETUP']:
+            settings['breakerfailures'] = config['SETUP'].getint('breakerfailures')
+        if 'breakerreset' in config['SETUP']:
+            settings['breakerreset'] = config['SETUP'].getfloat('breakerreset')
+        if 'deferdir' in config['SETUP']:
+            settings['deferdir'] = config['SETUP']['deferdir']
+        if 'lookupcachebytes' in config['SETUP']:
+            settings['lookupcachebytes'] = config['SETUP'].getint('lookupcachebytes')
+        if 'lookupcachettl' in config['SETUP']:
+            settings['lookupcachettl'] = config['SETUP'].getfloat('lookupcachettl')
+        if 'lagslo' in config['SETUP']:
+            # e.g. 300, quicklinks=60 (every owner, then owners with a target of their own)
+            for item in config['SETUP']['lagslo'].split(","):
+                if len(item.strip()) == 0:
+                    continue
+                owner, _, seconds = item.rpartition("=")
+                settings['lagslo'][owner.strip() or '*'] = float(seconds)
+        # Filter rules are compiled once here so each event is checked without any network calls
+        settings['eventfilter'] = EventFilter.from_config(config)
         # Users
         for user in config['USERPASSWORDS']:
-            global_users.append({'user': user, 'password': config['USERPASSWORDS'][user]})
+            settings['users'].append({'user': user, 'password': config['USERPASSWORDS'][user]})
     except Exception as err:
         raise ValueError("Error Setting Global Value from Config ({})".format(str(err)))
+    return settings
 
 
 def setup_ok():
@@ -92,22 +318,86 @@ def setup_ok():
     Each variable is checked and an error raised if annything looks incorrect
     :return: True (or some error)
     """
-    if not isinstance(global_url, str):
+    return check_settings(global_settings)
+
+
+def check_settings(settings):
+    """
+    Check the settings read by read_config.
+    :param settings: dict of settings
+    :return: True (or some error)
+    """
+    if not isinstance(settings['url'], str):
         raise ValueError("The nextcloud URL is not a string")
-    if len(global_url) == 0:
+    if len(settings['url']) == 0:
         raise ValueError("The nextcloud url is not defined")
-    if len(global_users) == 0:
+    if len(settings['users']) == 0:
         raise ValueError("There are no users defined in the configuration file")
-    if global_prontourl is not None:
-        if global_prontoapiuser is None or global_prontoapipassword is None:
+    if settings['prontourl'] is not None:
+        if settings['prontoapiuser'] is None or settings['prontoapipassword'] is None:
             raise ValueError("The configuration file must contain a user id and password for the pronto api")
-        if len(global_prontoapiuser) == 0:
+        if len(settings['prontoapiuser']) == 0:
             raise ValueError("The pronto api user id is empty")
-        if len(global_prontoapipassword) == 0:
+        if len(settings['prontoapipassword']) == 0:
             raise ValueError("The pronto api password is empty")
+    if settings['maxconcurrent'] < 0:
+        raise ValueError("maxconcurrent must not be negative")
+    if settings['maxwait'] < 0:
+        raise ValueError("maxwait must not be negative")
+    if settings['profilethreshold'] > 0 and settings['profiledir'] is None:
+        raise ValueError("profiledir (or applog) must be set when profilethreshold is set")
+    if settings['ratelimit'] < 0:
+        raise ValueError("ratelimit must not be negative")
+    if settings['adaptivemax'] < 0:
+        raise ValueError("adaptivemax must not be negative")
+    if settings['latencytarget'] < 0:
+        raise ValueError("latencytarget must not be negative")
+    if settings['negativettl'] <= 0:
+        raise ValueError("negativettl must be more than 0")
+    for sink, seconds in settings['sinktimeouts'].items():
+        if sink not in SINK_TIMEOUTS:
+            raise ValueError("Unknown sink {} in sinktimeouts ({})".format(sink, ", ".join(SINK_TIMEOUTS)))
+        if seconds <= 0:
+            raise ValueError("The timeout of sink {} must be more than 0".format(sink))
+    if settings['digestdb'] is not None and len(settings['digestto']) == 0:
+        raise ValueError("digestto must be set when digestdb is set")
+    if settings['digestinterval'] <= 0:
+        raise ValueError("digestinterval must be more than 0")
+    if settings['digesterrors'] < 0 or settings['digestslow'] < 0:
+        raise ValueError("digesterrors and digestslow must not be negative")
+    if settings['breakerdir'] is not None and settings['deferdir'] is None:
+        raise ValueError("deferdir must be set when breakerdir is set")
+    if settings['breakerfailures'] < 1:
+        raise ValueError("breakerfailures must be at least 1")
+    if settings['breakerreset'] <= 0:
+        raise ValueError("breakerreset must be more than 0")
+    if settings['lookupcachebytes'] < 0:
+        raise ValueError("lookupcachebytes must not be negative")
+    if settings['lookupcachettl'] <= 0:
+        raise ValueError("lookupcachettl must be more than 0")
+    for owner, seconds in settings['lagslo'].items():
+        if seconds <= 0:
+            raise ValueError("The lagslo target for {} must be more than 0".format(owner))
     return True
 
 
+def application_dir():
+    """
+    The folder the program is run from.  When run from a bundle (see bundle.py) this is the folder holding the
+    bundle, not the bundle itself.
+    """
+    thispath = os.path.dirname(__file__)
+    if os.path.isfile(thispath):
+        thispath = os.path.dirname(thispath)
+    return thispath
+
+
+def default_configfile():
+    """ vnextcloud.ini in the application folder if there is one, otherwise in the current folder """
+    inifile = os.path.join(application_dir(), "vnextcloud.ini")
+    return inifile if os.path.exists(inifile) else "vnextcloud.ini"
+
+
 def process_arguments():
     """
     Process program arguments.
@@ -116,22 +406,38 @@ def process_arguments():
 
     :return: Arguments object
     """
-    inifile = "vnextcloud.ini"
-    thispath = os.path.dirname(__file__)
-    if os.path.exists(thispath + "/vnextcloud.ini"):
-        inifile = thispath + "/vnextcloud.ini"
     parser = argparse.ArgumentParser(description="Process new vnextcloud file")
-    parser.add_argument('--file', action='store', required=True,
+    parser.add_argument('--file', action='store', required=False,
                         help="The path of the file (owned by the user) e.g. Documents/products/EQ100.jpg)")
-    parser.add_argument('--owner', action='store', required=True,
+    parser.add_argument('--owner', action='store', required=False,
                         help="The user name of the person who owns the file")
-    parser.add_argument('--configfile', action='store', required=False, default=inifile,
+    parser.add_argument('--batch', action='store', required=False,
+                        help="A file of owner|file lines to process together (instead of --file and --owner)")
+    parser.add_argument('--workers', action='store', type=int, required=False, default=1,
+                        help="With --batch, the number of processes to share the files between (by owner)")
+    parser.add_argument('--output', action='store', required=False, default='text', choices=['text', 'jsonl'],
+                        help="jsonl writes one json record per file to stdout (everything else goes to stderr)")
+    parser.add_argument('--configfile', action='store', required=False, default=default_configfile(),
                         help="Configuration file")
     parser.add_argument('--create-public-share', action='store_true', required=False,
                         help='Create a public share for the file')
     parser.add_argument('--public-keyword', action='store', required=False,
                         help='Only create a public share if the public share keyword is found in the path')
+    parser.add_argument('--reuse-folder-share', action='store_true', required=False,
+                        help='Use a public share on a folder above the file rather than creating a new share')
+    parser.add_argument('--force', action='store_true', required=False,
+                        help='Call the pronto api even if the ledger shows the quicklink is already registered')
+    parser.add_argument('--forget', action='store_true', required=False,
+                        help='Remove the file from the quicklink ledger and exit (no other processing is done)')
     args = parser.parse_args()
+    if args.batch is None and (args.file is None or args.owner is None):
+        parser.error("--file and --owner are required (unless --batch is used)")
+    if args.batch is not None and (args.file is not None or args.owner is not None):
+        parser.error("--file and --owner cannot be used with --batch")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.workers > 1 and args.batch is None:
+        parser.error("--workers can only be used with --batch")
     return args
 
 
@@ -195,10 +501,19 @@ def setup_to_log(args):
     applog.info('Parameter File:{}'.format(args.file))
     applog.info('Parameter Owner:{}'.format(args.owner))
     applog.info('Parameter Config:{}'.format(args.configfile))
+    if args.batch is not None:
+        applog.info('Parameter Batch:{}'.format(args.batch))
+        applog.info('Parameter Workers:{}'.format(args.workers))
     if args.create_public_share:
         applog.info('Called with create-public-share')
     if 'public_keyword' in args:
         applog.info('Parameter Public Keyword:{}'.format(args.public_keyword))
+    if args.reuse_folder_share:
+        applog.info('Called with reuse-folder-share')
+    if args.force:
+        applog.info('Called with force')
+    if args.forget:
+        applog.info('Called with forget')
     # Globals
     applog.info('Config Nextcloud URL:{}'.format(global_url))
     applog.info('Config Logfile:{}'.format(global_applog))
@@ -207,13 +522,26 @@ def setup_to_log(args):
     applog.info('Config Pronto URL:{}'.format(global_prontourl))
     applog.info('Config Pronto API User:{}'.format(global_prontoapiuser))
     applog.info('Config Pronto API Password:{}'.format(global_prontoapipassword))
+    applog.info('Config Metrics Log:{}'.format(global_metricslog))
+    applog.info('Config Lock Directory:{}'.format(global_lockdir))
+    applog.info('Config Max Concurrent:{}'.format(global_maxconcurrent))
+    applog.info('Config Max Wait:{}'.format(global_maxwait))
+    applog.info('Config Reuse Folder Share:{}'.format(global_reusefoldershare))
+    applog.info('Config Quicklink Ledger:{}'.format(global_ledger))
+    applog.info('Config Profile Threshold:{}'.format(global_profilethreshold))
+    applog.info('Config Profile Mode:{}'.format(global_profilemode))
+    applog.info('Config Profile Directory:{}'.format(global_profiledir))
+    if global_eventfilter is not None:
+        applog.info('Config Filter Rules:{}'.format(", ".join(global_eventfilter.rules)))
     # Users
     for udict in global_users:
         applog.info('Config User :{}/{}'.format(udict['user'], udict['password']))
 
 
-def ownerpassword(owner):
-    passwordlist = [p['password'] for p in global_users if p['user'] == owner]
+def ownerpassword(owner, users=None):
+    if users is None:
+        users = global_users
+    passwordlist = [p['password'] for p in users if p['user'] == owner]
     if len(passwordlist) == 0:
         raise ConnectionError("No Password for this owner ({})".format(owner))
     try:
@@ -243,10 +571,1114 @@ def passworddecrypt(password):
         raise ConnectionError("Invalid password - More than 2 comma spearated entries")
 
 
+def process_event(args, event=None):
+    """
+    Process a single file event (--owner and --file).
+    :param args: Arguments object
+    :param event: Optional dict.  The NxtCld object ('thiscloud') and file id ('fileid') are added to it as soon
+                  as they are known, so the caller has them even if processing fails part way through.  If it
+                  has replay set (see replay) an event stopped by a breaker is not deferred again: the caller
+                  keeps the deferred event.
+    :return: The NxtCld object used, or None if there was nothing to process
+    """
+    if event is None:
+        event = {}
+    # a replayed event keeps the time it first arrived
+    event.setdefault('received', time.time())
+    relative_path = event_path(args.owner, args.file)
+    event['path'] = relative_path
+    ledger = QuicklinkLedger(global_ledger) if global_ledger is not None else None
+    if args.forget:
+        if ledger is None:
+            raise ValueError("--forget requires a ledger in the configuration file")
+        print("{} ledger entries removed".format(ledger.invalidate(owner=args.owner, filename=relative_path)))
+        event['status'] = 'forgotten'
+        return None
+    # Check the filter rules before doing any network work
+    rule, actions = global_eventfilter.evaluate(args.owner, relative_path)
+    applog.info('Filter rule {} actions {}'.format(rule, ",".join(sorted(actions))))
+    if 'skip' in actions:
+        print("File skipped by filter rule {}".format(rule))
+        event['status'] = 'skipped'
+        return None
+    # Put the event aside (without waiting for a slot) while nextcloud or pronto is down
+    breakers = circuit_breakers(global_settings)
+    blocked = open_breaker(breakers, actions)
+    if blocked is not None:
+        if not event.get('replay'):
+            defer(global_settings, args.owner, args.file, args, blocked, event['received'])
+        print("File deferred ({} is down)".format(blocked))
+        event['status'] = 'deferred'
+        return None
+    # Wait for a processing slot before doing any network work.
+    with HostLimiter(global_lockdir, global_maxconcurrent, global_maxwait) as limiter:
+        event['wait'] = round(limiter.wait_time, 3)
+        thiscloud = onxtcld.NxtCld(global_url, args.owner, ownerpassword(args.owner),
+                                   negative_cache=negative_cache(global_settings), circuit_breakers=breakers)
+        thiscloud.filecache_resolver = filecache_resolver(global_settings)
+        event['thiscloud'] = thiscloud
+        process_file(thiscloud, args, relative_path, actions, ledger, event, global_settings)
+    return thiscloud
+
+
+def process_file(thiscloud, args, relative_path, actions, ledger, event, settings, datalog=None,
+                 sinkinitializer=None):
+    """
+    Process one file with a connected NxtCld object (shared by process_event, process_batch and the service)
+    :param thiscloud: NxtCld connected as the owner of the file (with no file path set)
+    :param args: Arguments object
+    :param relative_path: The path of the file relative to the owners files
+    :param actions: The filter actions for the file
+    :param ledger: QuicklinkLedger or None
+    :param event: dict.  The file id, share and pronto results are added as soon as they are known.
+    :param settings: dict of settings (see read_config)
+    :param datalog: Optional list.  If given the datalog row is added to the list instead of being written to the
+                    datalog (batch workers pass their rows to a single writer).
+    :param sinkinitializer: Optional callable run first in each sink's thread (see SinkRunner)
+    :return:
+    """
+    thiscloud.file_path = relative_path
+    event['fileid'] = thiscloud.file_id
+    if args.create_public_share or 'publicshare' in actions:
+        thiscloud.optionally_create_public_share = True
+    if args.public_keyword is not None:
+        thiscloud.public_share_keyword = args.public_keyword
+    if 'privateonly' in actions:
+        thiscloud.private_share_only = True
+    if args.reuse_folder_share or settings['reusefoldershare']:
+        thiscloud.reuse_folder_share = True
+    thiscloud.quicklink_ledger = ledger
+    thiscloud.lock_directory = settings['lockdir']
+    event['shareurl'] = thiscloud.share_url
+    event['shareid'] = thiscloud.public_share_id
+    event['sharecreated'] = thiscloud.public_share_created
+    event['movedfrom'] = thiscloud.moved_from
+    SinkRunner(file_sinks(args, actions, settings, datalog), initializer=sinkinitializer).run(thiscloud, event)
+    quicklink_lag(thiscloud, event, settings)
+
+
+def quicklink_lag(thiscloud, event, settings):
+    """
+    How long after the file was saved its quicklink was registered in pronto (or, without pronto, the file was
+    processed).  The modification time is the one the event came with (poll), the local file's under
+    nextcloudroot, or if lagslo is set and there is no local file, nextcloud's (one request).  The lag is
+    recorded as the quicklink_lag metric, and a lag over the owner's lagslo target is logged as a warning and
+    recorded as a lag_slo_breach metric.
+    :param thiscloud: NxtCld with the file processed
+    :param event: dict.  Updated with lag.
+    :param settings: dict of settings (see read_config)
+    :return: dict of modified, received and registered (seconds since the epoch), seconds (the lag, None if
+             the modification time is not known), slo (the owner's target or None) and breach
+    """
+    owner = thiscloud.user
+    modified = event.get('modified')
+    if modified is None:
+        try:
+            modified = os.stat(os.path.join(settings['nextcloudroot'], owner, 'files',
+                                            thiscloud.file_path.lstrip("/"))).st_mtime
+        except OSError:
+            modified = None
+    if modified is None and len(settings['lagslo']) > 0:
+        try:
+            modified = thiscloud.file_modified
+        except onxtcld.NxtCld.NxtCldError as e:
+            applog.warning("Quicklink lag not known: {}".format(str(e)))
+    registered = event.get('registered', time.time())
+    slo = settings['lagslo'].get(owner, settings['lagslo'].get('*'))
+    lag = {'modified': modified,
+           'received': event.get('received'),
+           'registered': round(registered, 3),
+           'seconds': round(max(0.0, registered - modified), 3) if modified is not None else None,
+           'slo': slo,
+           'breach': False}
+    if lag['seconds'] is not None:
+        appmetrics.record('quicklink_lag', lag['seconds'], owner=owner)
+        if slo is not None and lag['seconds'] > slo:
+            lag['breach'] = True
+            applog.warning("Quicklink lag {:.1f} seconds for {} {} is over the target of {} seconds".format(
+                lag['seconds'], owner, thiscloud.file_path, slo))
+            appmetrics.record('lag_slo_breach', lag['seconds'], owner=owner, slo=slo)
+    event['lag'] = lag
+    return lag
+
+
+def file_sinks(args, actions, settings, datalog=None):
+    """
+    The sinks the result of a file is sent to (see SinkRunner).  The datalog and pronto are required, the
+    webhook and jsonlog are not (a failure is logged and the file is still processed).
+    :param args: Arguments object
+    :param actions: The filter actions for the file
+    :param settings: dict of settings (see read_config)
+    :param datalog: Optional list for the datalog rows (see process_file)
+    :return: list of Sink
+    """
+    timeouts = settings['sinktimeouts']
+    sinks = []
+    if settings['datalog'] is not None:
+        sinks.append(DatalogSink(settings['datalog'], rows=datalog, timeout=timeouts['datalog']))
+    if settings['prontourl'] is not None and 'skippronto' not in actions:
+        sinks.append(ProntoSink(settings['prontourl'], settings['prontoapiwebresource'], settings['prontoapiuser'],
+                                settings['prontoapipassword'], force=args.force, timeout=timeouts['pronto']))
+    if settings['webhook'] is not None:
+        sinks.append(WebhookSink(settings['webhook'], timeout=timeouts['webhook']))
+    if settings['jsonlog'] is not None:
+        sinks.append(JsonlSink(settings['jsonlog'], timeout=timeouts['jsonl']))
+    return sinks
+
+
+def process_batch(args, profiler):
+    """
+    Process every file in the batch file (--batch).  Each line is owner|file where file is either the
+    full path (as passed to --file) or the path relative to the owners files.
+
+    Each owner is connected to once and the connection is reused for all of their files, and the file ids
+    are read a folder at a time (see FolderCache), so a large backfill makes far fewer requests than
+    running the program once per file.  Files in the same folder should be together in the batch file (as
+    they are in a listing).  The batch file is read a line at a time so any size of batch can be processed.
+    A file that fails is logged and the batch carries on.
+    :param args: Arguments object
+    :param profiler: SlowEventProfiler (each file is profiled as a separate event)
+    :return: dict of the number of files processed, skipped and in error
+    """
+    counts = {'processed': 0, 'skipped': 0, 'errors': 0}
+    totals = ResourceTotals()
+    ledger = QuicklinkLedger(global_ledger) if global_ledger is not None else None
+    if args.forget and ledger is None:
+        raise ValueError("--forget requires a ledger in the configuration file")
+    if args.workers > 1:
+        process_batch_workers(args, profiler, counts, totals)
+        applog.info("Batch {}".format(totals.format_summary()))
+        return counts
+    foldercache = FolderCache()
+    lookupcache = lookup_cache(global_settings)
+    adaptive = concurrency_limiter(global_settings)
+    # owner -> connected NxtCld, or the connection error as a string
+    connections = {}
+    with HostLimiter(global_lockdir, global_maxconcurrent, global_maxwait) as limiter, \
+            open(args.batch, 'r') as batchfile:
+        applog.info("Batch waited {:.3f} seconds for a processing slot".format(limiter.wait_time))
+        for line in batchfile:
+            outcome = batch_line(args, line, connections, foldercache, ledger, profiler, global_settings,
+                                 limiter=adaptive, lookupcache=lookupcache)
+            if outcome is not None:
+                counts[outcome[0]] += 1
+                totals.add(outcome[1])
+                write_result(outcome[1])
+    applog.info("Batch folder cache {}".format(foldercache.stats))
+    applog.info("Batch {}".format(totals.format_summary()))
+    if lookupcache is not None:
+        cache_metrics(lookupcache)
+    if adaptive is not None:
+        applog.info("Batch concurrency limits {}".format(adaptive.limits))
+    return counts
+
+
+def batch_line(args, line, connections, foldercache, ledger, profiler, settings, datalog=None, limiter=None,
+               modified=None, lookupcache=None):
+    """
+    Process one line of a batch file
+    :param args: Arguments object
+    :param line: owner|file
+    :param connections: dict of owner -> connected NxtCld, or the connection error as a string.  Updated.
+    :param foldercache: FolderCache
+    :param ledger: QuicklinkLedger or None
+    :param profiler: SlowEventProfiler
+    :param settings: dict of settings (see read_config)
+    :param datalog: Optional list for the datalog rows (see process_file)
+    :param limiter: Optional AdaptiveLimiter given to new connections
+    :param modified: Optional modification time of the file, if already known (see quicklink_lag)
+    :param lookupcache: Optional LRUCache given to new connections
+    :return: (processed, skipped or errors, result record), or None for a blank, comment or invalid line
+    """
+    if len(line.strip()) == 0 or line.startswith('#'):
+        return None
+    owner, _, filename = line.strip().partition("|")
+    if len(owner) == 0 or len(filename) == 0:
+        applog.warning("Invalid batch line ignored: {}".format(line.strip()))
+        return None
+    relative_path = event_path(owner, filename, settings['nextcloudroot'])
+    event = {'path': relative_path, 'received': time.time()}
+    if modified is not None:
+        event['modified'] = modified
+    error = None
+    outcome = 'processed'
+    profiler.start()
+    meter = ResourceMeter()
+    started = time.perf_counter()
+    try:
+        if args.forget:
+            ledger.invalidate(owner=owner, filename=relative_path)
+            event['status'] = 'forgotten'
+        else:
+            rule, actions = settings['eventfilter'].evaluate(owner, relative_path)
+            blocked = open_breaker(circuit_breakers(settings), actions) if 'skip' not in actions else None
+            if 'skip' in actions:
+                applog.info('{} skipped by filter rule {}'.format(relative_path, rule))
+                event['status'] = 'skipped'
+                outcome = 'skipped'
+            elif blocked is not None:
+                defer(settings, owner, filename, args, blocked, event['received'])
+                event['status'] = 'deferred'
+                outcome = 'skipped'
+            else:
+                thiscloud = batch_connection(owner, connections, foldercache, settings, limiter, lookupcache)
+                event['thiscloud'] = thiscloud
+                process_file(thiscloud, args, relative_path, actions, ledger, event, settings, datalog)
+    except Exception as e:
+        error = str(e)
+        outcome = 'errors'
+        applog.error("Error processing {} {}: {}".format(owner, relative_path, error))
+        print("Error processing {} {}: {}".format(owner, relative_path, error))
+    finally:
+        if 'abandoned' in event and connections.get(owner) is event.get('thiscloud'):
+            # a sink still running is using the connection, so the next file gets a new one
+            applog.warning("Connection for {} dropped (sinks {} still running)".format(
+                owner, ", ".join(event['abandoned'])))
+            del connections[owner]
+        elapsed = time.perf_counter() - started
+        event['resources'] = meter.stop(event.get('thiscloud'))
+        if 'thiscloud' in event:
+            timings_to_log(event, owner, elapsed)
+        profiler.stop(tags={'owner': owner, 'file': relative_path, 'fileid': event.get('fileid')},
+                      timings=event_timings(event))
+    return outcome, result_record(owner, event, elapsed, error)
+
+
+def batch_connection(owner, connections, foldercache, settings, limiter=None, lookupcache=None):
+    """
+    The connection for the owner, connecting if this is the owner's first file.  It keeps one http session
+    (keep_alive) as it is used for many files.
+    :param owner: The owner of the file
+    :param connections: dict of owner -> connected NxtCld, or the connection error as a string.  Updated.
+    :param foldercache: FolderCache given to new connections
+    :param settings: dict of settings (see read_config)
+    :param limiter: Optional AdaptiveLimiter given to new connections
+    :param lookupcache: Optional LRUCache given to new connections
+    :return: NxtCld ready for the next file
+    """
+    thiscloud = connections.get(owner)
+    if isinstance(thiscloud, str):
+        # don't try to connect again for every file
+        raise ConnectionError(thiscloud)
+    if thiscloud is None:
+        try:
+            thiscloud = onxtcld.NxtCld(settings['url'], owner, ownerpassword(owner, settings['users']),
+                                       keep_alive=True, negative_cache=negative_cache(settings),
+                                       circuit_breakers=circuit_breakers(settings))
+        except Exception as e:
+            connections[owner] = str(e)
+            raise
+        thiscloud.folder_cache = foldercache
+        thiscloud.lookup_cache = lookupcache
+        thiscloud.concurrency_limiter = limiter
+        thiscloud.filecache_resolver = filecache_resolver(settings)
+        connections[owner] = thiscloud
+    else:
+        thiscloud._initialise_internal_variables()
+    return thiscloud
+
+
+def process_batch_workers(args, profiler, counts, totals):
+    """
+    Process the batch file with --workers processes.
+
+    Lines are shared out by owner (every file of an owner goes to the same worker) so each worker keeps the
+    connection and folder cache for its owners, and the work is spread across the cores rather than held up
+    by one python interpreter.  The workers do not write to the datalog, the results or the applog
+    themselves: the rows, result records and log lines are sent back to this process, which is the only
+    writer, so lines from different workers are never mixed up.  Relies on fork (Linux).
+    :param args: Arguments object
+    :param profiler: SlowEventProfiler (each worker profiles its own files)
+    :param counts: dict of the number of files processed, skipped and in error.  Updated.
+    :param totals: ResourceTotals of the files.  Updated.
+    :return: counts
+    """
+    context = multiprocessing.get_context('fork')
+    # one set of limits shared by all the workers
+    adaptive = concurrency_limiter(global_settings, context)
+    logqueue = context.Queue()
+    resultqueue = context.Queue()
+    workqueues = [context.Queue(maxsize=1000) for _ in range(args.workers)]
+    workers = [context.Process(target=batch_worker, name='batch{}'.format(i),
+                               args=(args, workqueues[i], resultqueue, logqueue, profiler, adaptive))
+               for i in range(args.workers)]
+    loglistener = QueueListener(logqueue, *applog.handlers, respect_handler_level=True)
+    writer = threading.Thread(target=batch_writer, args=(resultqueue, counts, totals), name='batchwriter')
+    with HostLimiter(global_lockdir, global_maxconcurrent, global_maxwait) as limiter, \
+            open(args.batch, 'r') as batchfile:
+        applog.info("Batch waited {:.3f} seconds for a processing slot".format(limiter.wait_time))
+        applog.info("Batch shared across {} workers by owner".format(args.workers))
+        loglistener.start()
+        for worker in workers:
+            worker.start()
+        writer.start()
+        reclaimed = set()
+        try:
+            for line in batchfile:
+                owner = line.partition("|")[0].strip()
+                shard = zlib.crc32(owner.encode()) % args.workers
+                while True:
+                    if not workers[shard].is_alive():
+                        raise ChildProcessError("Batch worker {} stopped".format(shard))
+                    try:
+                        workqueues[shard].put(line, timeout=1)
+                        break
+                    except queue.Full:
+                        reclaim_slots(workers, adaptive, reclaimed)
+        finally:
+            for worker, workqueue in zip(workers, workqueues):
+                # a worker that has stopped will never empty its queue, so never wait on it
+                while worker.is_alive():
+                    try:
+                        workqueue.put(None, timeout=1)
+                        break
+                    except queue.Full:
+                        reclaim_slots(workers, adaptive, reclaimed)
+            for worker in workers:
+                while worker.is_alive():
+                    reclaim_slots(workers, adaptive, reclaimed)
+                    worker.join(timeout=1)
+            # everything the workers sent is in the queue ahead of this
+            resultqueue.put(None)
+            writer.join()
+            loglistener.stop()
+    if adaptive is not None:
+        applog.info("Batch concurrency limits {}".format(adaptive.limits))
+    for i, worker in enumerate(workers):
+        if worker.exitcode != 0:
+            raise ChildProcessError("Batch worker {} failed (exit code {})".format(i, worker.exitcode))
+    return counts
+
+
+def reclaim_slots(workers, limiter, reclaimed):
+    """
+    Give back the concurrency slots of workers that died holding them, so the others do not wait for them
+    :param workers: list of multiprocessing.Process
+    :param limiter: The shared AdaptiveLimiter (or None)
+    :param reclaimed: set of the pids already reclaimed.  Updated.
+    """
+    if limiter is None:
+        return
+    for worker in workers:
+        if worker.exitcode not in (None, 0) and worker.pid not in reclaimed:
+            reclaimed.add(worker.pid)
+            limiter.reclaim(worker.pid)
+
+
+def batch_worker(args, workqueue, resultqueue, logqueue, profiler, limiter):
+    """
+    One --workers process.  Processes the lines it is given until it is sent None.
+    """
+    # log lines go back to the parent to be written
+    for handler in list(applog.handlers):
+        applog.removeHandler(handler)
+    applog.addHandler(QueueHandler(logqueue))
+    ledger = QuicklinkLedger(global_ledger) if global_ledger is not None else None
+    foldercache = FolderCache()
+    lookupcache = lookup_cache(global_settings)
+    connections = {}
+    while True:
+        line = workqueue.get()
+        if line is None:
+            break
+        datalog = []
+        outcome = batch_line(args, line, connections, foldercache, ledger, profiler, global_settings, datalog,
+                             limiter, lookupcache=lookupcache)
+        if outcome is not None:
+            resultqueue.put((outcome[0], outcome[1], datalog))
+    applog.info("Batch worker folder cache {}".format(foldercache.stats))
+    if lookupcache is not None:
+        cache_metrics(lookupcache, worker=multiprocessing.current_process().name)
+
+
+def batch_writer(resultqueue, counts, totals):
+    """
+    The single writer of the datalog and results for the --workers processes.  Runs until it is sent None.
+    """
+    while True:
+        item = resultqueue.get()
+        if item is None:
+            break
+        outcome, record, datalog = item
+        counts[outcome] += 1
+        totals.add(record)
+        try:
+            if len(datalog) > 0:
+                onxtcld.NxtCld.append_to_csv_file(global_datalog, datalog)
+            write_result(record)
+        except Exception as e:
+            applog.error("Error writing the result for {} {}: {}".format(record['owner'], record['path'], str(e)))
+
+
+def digest_notifier(settings):
+    """
+    The DigestNotifier for the configuration (or None if digestdb is not set)
+    :param settings: dict of settings (see read_config)
+    :return: DigestNotifier or None
+    """
+    if settings['digestdb'] is None or len(settings['digestto']) == 0:
+        return None
+    return DigestNotifier(settings['digestdb'], settings['digestto'], settings['digestinterval'],
+                          settings['digesterrors'], settings['digestslow'], settings['smtphost'])
+
+
+def concurrency_limiter(settings, context=None):
+    """
+    The AdaptiveLimiter for the configuration (or None if adaptivemax is not set)
+    :param settings: dict of settings (see read_config)
+    :param context: Optional multiprocessing context to share the limits between processes
+    :return: AdaptiveLimiter or None
+    """
+    if settings['adaptivemax'] == 0:
+        return None
+    return AdaptiveLimiter(maximum=settings['adaptivemax'], latencytarget=settings['latencytarget'],
+                           context=context, maxwait=settings['maxwait'])
+
+
+def filecache_resolver(settings):
+    """
+    The FileCacheResolver for the configuration (or None if filecachedb is not set)
+    :param settings: dict of settings (see read_config)
+    :return: FileCacheResolver or None
+    """
+    if settings['filecachedb'] is None:
+        return None
+    return FileCacheResolver(settings['filecachedb'], settings['filecachepassword'], settings['filecacheprefix'])
+
+
+def negative_cache(settings):
+    """
+    The NegativeCache for the configuration (or None if negativecache is not set)
+    :param settings: dict of settings (see read_config)
+    :return: NegativeCache or None
+    """
+    if settings['negativecache'] is None:
+        return None
+    return NegativeCache(settings['negativecache'], settings['negativettl'])
+
+
+def lookup_cache(settings):
+    """
+    The LRUCache of nextcloud lookups for a process handling many files (or None if lookupcachebytes is 0)
+    :param settings: dict of settings (see read_config)
+    :return: LRUCache or None
+    """
+    if settings['lookupcachebytes'] == 0:
+        return None
+    return LRUCache(settings['lookupcachebytes'], settings['lookupcachettl'])
+
+
+def cache_metrics(cache, **tags):
+    """
+    Log the stats of a lookup cache and record them as lookup_cache_<stat> metrics (so the cache can be sized)
+    :param cache: LRUCache
+    :param tags: Tags added to the metrics e.g. tenant='bathurst'
+    """
+    stats = cache.stats
+    applog.info("Lookup cache {}{}".format(stats, "".join(" {}={}".format(k, v) for k, v in sorted(tags.items()))))
+    for name, value in stats.items():
+        appmetrics.record('lookup_cache_' + name, value, **tags)
+
+
+def circuit_breakers(settings):
+    """
+    The circuit breakers for the configuration (or None if breakerdir is not set).  The state is kept in
+    breakerdir, so every process (and every new object) for the configuration shares it.
+    :param settings: dict of settings (see read_config)
+    :return: dict of name (nextcloud, and pronto if prontourl is set) -> CircuitBreaker, or None
+    """
+    if settings['breakerdir'] is None:
+        return None
+    names = ['nextcloud'] + (['pronto'] if settings['prontourl'] is not None else [])
+    return {name: CircuitBreaker(settings['breakerdir'], name, settings['breakerfailures'], settings['breakerreset'])
+            for name in names}
+
+
+def open_breaker(breakers, actions):
+    """
+    The endpoint whose breaker stops the event, if any.  Call this once per event: when a breaker is half open
+    the event it lets through is its probe.
+    :param breakers: dict of CircuitBreaker (see circuit_breakers) or None
+    :param actions: The filter actions for the file (pronto is not needed with skippronto)
+    :return: The name of the open breaker, or None if the event may go ahead
+    """
+    if breakers is None:
+        return None
+    needed = [(name, breaker) for name, breaker in breakers.items()
+              if not (name == 'pronto' and 'skippronto' in actions)]
+    # an open breaker stops the event before a half open one spends its probe on it
+    for name, breaker in needed:
+        if not breaker.ready():
+            return name
+    allowed = []
+    for name, breaker in needed:
+        if not breaker.allow():
+            # another process took the probe meanwhile
+            for other in allowed:
+                other.release()
+            return name
+        allowed.append(breaker)
+    return None
+
+
+def defer(settings, owner, filename, args, blocked, received=None):
+    """
+    Put an event aside in the deferdir until the endpoint is back (see replay)
+    :param settings: dict of settings (see read_config)
+    :param owner: The owner of the file
+    :param filename: The file (as given to the event)
+    :param args: Arguments object (or namespace) holding the event's options
+    :param blocked: The name of the open breaker
+    :param received: When the event first arrived (seconds since the epoch, see quicklink_lag)
+    :return: The name of the deferred event
+    """
+    name = Spool(settings['deferdir']).enqueue({'owner': owner,
+                                                'file': filename,
+                                                'create_public_share': args.create_public_share,
+                                                'public_keyword': args.public_keyword,
+                                                'reuse_folder_share': args.reuse_folder_share,
+                                                'force': args.force,
+                                                'received': received,
+                                                'deferred': blocked})
+    applog.warning("{} {} deferred as the {} circuit breaker is open ({})".format(owner, filename, blocked, name))
+    appmetrics.record('event_deferred', 1, breaker=blocked)
+    return name
+
+
+def event_path(owner, filename, nextcloudroot=None):
+    """
+    The path of the file relative to the owners files.
+    :param owner: The owner of the file
+    :param filename: The full path as passed by Flow (<nextcloudroot>/<owner>/files/<path>) or a relative path
+    :param nextcloudroot: The nextcloud data root (default: from the configuration file)
+    :return: The relative path e.g. /Documents/TESTFLOW/timesheet.json
+    """
+    if nextcloudroot is None:
+        nextcloudroot = global_nextcloudroot
+    if filename.startswith(nextcloudroot):
+        #remove the root
+        prefixlength = len(nextcloudroot) + len(owner) + 1 + 6
+        return filename[prefixlength:]
+    # the same form as a path from Flow, so the datalog, ledger and pronto see the same file name
+    return "/" + filename.strip("/")
+
+
+def event_timings(event):
+    """
+    The stage timings of an event: the time queued in the service and waiting for a processing slot, plus the
+    NxtCld stage timings.
+    :param event: The event dict filled in by process_event
+    :return: dict of stage and seconds
+    """
+    timings = {}
+    if 'queue' in event:
+        # the service: time from the spool to starting (see Service)
+        timings['queue'] = event['queue']
+    if 'wait' in event:
+        timings['wait'] = event['wait']
+    if 'thiscloud' in event:
+        timings.update(event['thiscloud'].timings)
+    for sink, seconds in event.get('sinktimings', {}).items():
+        # pronto is already a stage of its own
+        timings.setdefault(sink, seconds)
+    return timings
+
+
+def result_record(owner, event, elapsed, error=None):
+    """
+    The result of one file as a dict (one line of --output jsonl)
+    :param owner: The owner of the file
+    :param event: The event dict filled in by process_event (or process_batch)
+    :param elapsed: Seconds taken to process the file
+    :param error: The error message if processing failed
+    :return: dict
+    """
+    pronto = event.get('pronto') or {}
+    timings = {'total': round(elapsed, 3)}
+    timings.update(event_timings(event))
+    return {'owner': owner,
+            'path': event.get('path'),
+            'status': 'error' if error is not None else event.get('status', 'processed'),
+            'fileid': event.get('fileid'),
+            'shareurl': event.get('shareurl'),
+            'shareid': event.get('shareid'),
+            'sharecreated': event.get('sharecreated', False),
+            'movedfrom': event.get('movedfrom'),
+            'lag': event.get('lag'),
+            'resources': event.get('resources'),
+            'company': pronto.get('company'),
+            'object': pronto.get('object'),
+            'keys': pronto.get('keys'),
+            'seq': pronto.get('seq'),
+            'timings': timings,
+            'error': error}
+
+
+def write_result(record):
+    """
+    Write a result record to the results stream (--output jsonl) as soon as the file is done, and add it to
+    the digest (if there is one)
+    :return: True if the record is in the digest
+    """
+    reported = notify(global_notifier, record)
+    if global_results is not None:
+        global_results.write(json.dumps(record) + "\n")
+        global_results.flush()
+    return reported
+
+
+def notify(notifier, record):
+    """
+    Add a result record to the digest, which is sent if it is due.  The digest never stops a file being processed.
+    :param notifier: DigestNotifier or None
+    :param record: dict (see result_record)
+    :return: True if the record was added to the digest
+    """
+    if notifier is None:
+        return False
+    try:
+        notifier.add(record)
+        return True
+    except Exception as e:
+        applog.error("Unable to add {} {} to the digest ({})".format(record.get('owner'), record.get('path'), str(e)))
+        return False
+
+
+def timings_to_log(event, owner, elapsed):
+    """
+    Write the stage timings for the event as a single line in the applog (used by log-stats)
+    """
+    timings = event_timings(event)
+    if (event.get('lag') or {}).get('seconds') is not None:
+        # upload to registration, so log-stats reports the lag per owner
+        timings['lag'] = event['lag']['seconds']
+    applog.info('Timings owner={} total={:.3f} {}'.format(
+        owner, elapsed, " ".join(["{}={}".format(k, v) for k, v in timings.items()])))
+    resources = event.get('resources')
+    if resources is not None:
+        # endpoint=requests/bytes sent/bytes received
+        applog.info('Resources owner={} file={} cpuuser={} cpusys={} maxrss={} requests={} bytes={} {}'.format(
+            owner, event.get('path'), resources['cpuuser'], resources['cpusys'], resources['maxrss'],
+            resources['requests'], resources['bytes'],
+            " ".join(["{}={}/{}/{}".format(k, v['requests'], v['sent'], v['received'])
+                      for k, v in resources['endpoints'].items()])))
+
+
+def log_stats(argv):
+    """
+    The log-stats command: report the stage latencies recorded in the application logs.
+    :param argv: The arguments after log-stats
+    :return: exit code
+    """
+    parser = argparse.ArgumentParser(prog="main.py log-stats",
+                                     description="Report stage latencies (p50/p95/p99) from the application logs")
+    parser.add_argument('--configfile', action='store', required=False, default=default_configfile(),
+                        help="Configuration file (the applog and its rotated copies are read)")
+    parser.add_argument('--logfile', action='append', required=False,
+                        help="Log file to read instead (may be repeated, .gz files are read as gzip)")
+    parser.add_argument('--since', action='store', required=False, type=parse_datetime,
+                        help="Only events from this time e.g. 2024-07-01 or '2024-07-01 13:00'")
+    parser.add_argument('--until', action='store', required=False, type=parse_datetime,
+                        help="Only events up to this time")
+    parser.add_argument('--owner', action='store', required=False,
+                        help="Only events for this owner")
+    parser.add_argument('--json', action='store_true', required=False,
+                        help="Print the report as json")
+    args = parser.parse_args(argv)
+    if args.logfile is not None:
+        logfiles = args.logfile
+    else:
+        process_config(args.configfile)
+        if global_applog is None:
+            raise ValueError("There is no applog in the configuration file (use --logfile)")
+        logfiles = LogStats.log_files(global_applog)
+    stats = LogStats(since=args.since, until=args.until, owner=args.owner)
+    for logfile in logfiles:
+        stats.add_file(logfile)
+    if args.json:
+        print(json.dumps({'counts': stats.counts, 'stages': stats.report()}, indent=2))
+    else:
+        print(stats.format_report())
+    return 0
+
+
+def digest(argv):
+    """
+    The digest command: send the digest if it is due (e.g. from cron, so the last results are not left
+    waiting for the next file).
+    :param argv: The arguments after digest
+    :return: exit code
+    """
+    parser = argparse.ArgumentParser(prog="main.py digest", description="Send the digest of processed files")
+    parser.add_argument('--configfile', action='store', required=False, default=default_configfile(),
+                        help="Configuration file (must have a digestdb)")
+    parser.add_argument('--now', action='store_true', required=False,
+                        help="Send the digest now even if it is not yet due")
+    args = parser.parse_args(argv)
+    process_config(args.configfile)
+    establish_logging()
+    set_logging_level(global_loglevel)
+    setup_ok()
+    if global_notifier is None:
+        raise ValueError("digest requires digestdb and digestto in the configuration file")
+    waiting = global_notifier.pending()
+    if global_notifier.flush(force=args.now):
+        print("Digest sent ({})".format(", ".join("{} {}".format(v, k) for k, v in sorted(waiting.items()))))
+    else:
+        print("No digest due ({} files waiting)".format(sum(waiting.values())))
+    return 0
+
+
+def enqueue(argv):
+    """
+    The enqueue command: add a file event to the service spool and return at once (see service.py).
+    :param argv: The arguments after enqueue
+    :return: exit code
+    """
+    parser = argparse.ArgumentParser(prog="main.py enqueue", description="Add a file event to the service spool")
+    parser.add_argument('--spooldir', action='store', required=True,
+                        help="The spool directory the service reads")
+    parser.add_argument('--file', action='store', required=False,
+                        help="The path of the file (as for a single event)")
+    parser.add_argument('--owner', action='store', required=False,
+                        help="The user name of the person who owns the file")
+    parser.add_argument('--batch', action='store', required=False,
+                        help="Queue every line (owner|file) of a batch file instead of one file (lane bulk)")
+    parser.add_argument('--lane', action='store', required=False, choices=['live', 'bulk'],
+                        help="live (a single upload, the default) is processed ahead of bulk (a batch, backfill "
+                             "or replay).  Default: bulk with --batch, otherwise live")
+    parser.add_argument('--tenant', action='store', required=False,
+                        help="The configuration to use (the configuration file name without .ini).  If not given "
+                             "the service picks the configuration from the nextcloudroot of the file")
+    parser.add_argument('--create-public-share', action='store_true', required=False,
+                        help='Create a public share for the file')
+    parser.add_argument('--public-keyword', action='store', required=False,
+                        help='Only create a public share if the public share keyword is found in the path')
+    parser.add_argument('--reuse-folder-share', action='store_true', required=False,
+                        help='Use a public share on a folder above the file rather than creating a new share')
+    parser.add_argument('--force', action='store_true', required=False,
+                        help='Call the pronto api even if the ledger shows the quicklink is already registered')
+    args = parser.parse_args(argv)
+    if (args.batch is None) == (args.file is None or args.owner is None):
+        parser.error("Give either --owner and --file, or --batch")
+    spool = Spool(args.spooldir)
+    event = {'tenant': args.tenant,
+             'lane': args.lane or ('bulk' if args.batch is not None else 'live'),
+             'create_public_share': args.create_public_share,
+             'public_keyword': args.public_keyword,
+             'reuse_folder_share': args.reuse_folder_share,
+             'force': args.force}
+    if args.batch is None:
+        name = spool.enqueue(dict(event, owner=args.owner, file=args.file))
+        print("Queued {}".format(name))
+        return 0
+    count = 0
+    with open(args.batch, 'r') as batchfile:
+        for line in batchfile:
+            if len(line.strip()) == 0 or line.startswith('#'):
+                continue
+            owner, _, filename = line.strip().partition("|")
+            if len(owner) == 0 or len(filename) == 0:
+                print("Invalid batch line ignored: {}".format(line.strip()))
+                continue
+            spool.enqueue(dict(event, owner=owner, file=filename))
+            count += 1
+    print("Queued {} events ({})".format(count, event['lane']))
+    return 0
+
+
+def replay(argv):
+    """
+    The replay command: process the events deferred while nextcloud or pronto was down (see defer), oldest
+    first.  Run it from cron (or by hand once the server is back).  If a breaker is still open the event and
+    the rest are put back as they were (keeping their place) and the replay stops.  Overlapping replays do not
+    share events: each claims into its own work folder and only recovers those of replays that have stopped.
+    :param argv: The arguments after replay
+    :return: exit code
+    """
+    parser = argparse.ArgumentParser(prog="main.py replay", description="Process the deferred file events")
+    parser.add_argument('--configfile', action='store', required=False, default=default_configfile(),
+                        help="Configuration file (must have a deferdir)")
+    parser.add_argument('--spooldir', action='store', required=False,
+                        help="Queue the events for the service (lane bulk) instead of processing them here")
+    parser.add_argument('--limit', action='store', type=int, required=False,
+                        help="The most events replayed")
+    args = parser.parse_args(argv)
+    process_config(args.configfile)
+    establish_logging()
+    set_logging_level(global_loglevel)
+    setup_ok()
+    appmetrics.metrics_file = global_metricslog
+    if global_settings['deferdir'] is None:
+        raise ValueError("replay requires deferdir in the configuration file")
+    deferred = Spool(global_settings['deferdir'])
+    deferred.recover()
+    claimed = deferred.claim(args.limit)
+    counts = {'processed': 0, 'deferred': 0, 'errors': 0}
+    for i, (name, event) in enumerate(claimed):
+        if args.spooldir is not None:
+            Spool(args.spooldir).enqueue(dict(event, lane='bulk'))
+            deferred.done(name)
+            counts['processed'] += 1
+            continue
+        eventargs = argparse.Namespace(owner=event['owner'], file=event['file'], forget=False,
+                                       create_public_share=event.get('create_public_share', False),
+                                       public_keyword=event.get('public_keyword'),
+                                       reuse_folder_share=event.get('reuse_folder_share', False),
+                                       force=event.get('force', False))
+        meter = ResourceMeter()
+        started = time.perf_counter()
+        thisevent = {'received': event.get('received') or Spool.arrived(name), 'replay': True}
+        error = None
+        try:
+            process_event(eventargs, thisevent)
+            if thisevent.get('status') != 'deferred':
+                deferred.done(name)
+        except Exception as e:
+            error = str(e)
+            applog.error("Error replaying {} {}: {}".format(event['owner'], event['file'], error))
+            deferred.failed(name, error)
+        elapsed = time.perf_counter() - started
+        thisevent['resources'] = meter.stop(thisevent.get('thiscloud'))
+        write_result(result_record(event['owner'], thisevent, elapsed, error))
+        if error is not None:
+            counts['errors'] += 1
+        elif thisevent.get('status') == 'deferred':
+            # still down: leave the rest (in order) for the next replay
+            counts['deferred'] += 1
+            for later, _ in claimed[i:]:
+                deferred.release(later)
+            break
+        else:
+            counts['processed'] += 1
+    print("Replay complete: {} {}, {} deferred again, {} errors, {} waiting".format(
+        counts['processed'], 'queued' if args.spooldir is not None else 'processed', counts['deferred'],
+        counts['errors'], len(deferred.pending())))
+    return 1 if counts['errors'] > 0 else 0
+
+
+def poll(argv):
+    """
+    The poll command: process the files the owners have added or changed since the last poll, a batch at a
+    time, instead of one Flow call per file.  Each owner's watermark (the modification time reached) is kept
+    in the watermark file from the configuration and only moves forward once the files before it are done.
+    :param argv: The arguments after poll
+    :return: exit code
+    """
+    global global_results
+    parser = argparse.ArgumentParser(prog="main.py poll",
+                                     description="Process the files modified since the last poll")
+    parser.add_argument('--configfile', action='store', required=False, default=default_configfile(),
+                        help="Configuration file (must have a watermark file)")
+    parser.add_argument('--owner', action='append', required=False,
+                        help="Owner to poll (may be repeated).  Default: every user in the configuration file")
+    parser.add_argument('--folder', action='store', required=False, default="",
+                        help="Only poll this folder of each owner's files (and below)")
+    parser.add_argument('--interval', action='store', type=float, required=False, default=60,
+                        help="Seconds between polls (default 60)")
+    parser.add_argument('--once', action='store_true', required=False,
+                        help="Poll once then exit")
+    parser.add_argument('--batchsize', action='store', type=int, required=False, default=100,
+                        help="Files asked for at a time (default 100)")
+    parser.add_argument('--since', action='store', required=False, type=parse_datetime,
+                        help="Where an owner with no watermark starts e.g. 2024-07-01.  Default: now")
+    parser.add_argument('--create-public-share', action='store_true', required=False,
+                        help='Create a public share for each file')
+    parser.add_argument('--public-keyword', action='store', required=False,
+                        help='Only create a public share if the public share keyword is found in the path')
+    parser.add_argument('--reuse-folder-share', action='store_true', required=False,
+                        help='Use a public share on a folder above the file rather than creating a new share')
+    parser.add_argument('--output', action='store', required=False, default='text', choices=['text', 'jsonl'],
+                        help="jsonl writes one json record per file to stdout")
+    parser.set_defaults(force=False, forget=False)
+    args = parser.parse_args(argv)
+    if args.batchsize < 1:
+        parser.error("--batchsize must be at least 1")
+    if args.output == 'jsonl':
+        global_results = sys.stdout
+        sys.stdout = sys.stderr
+    process_config(args.configfile)
+    establish_logging()
+    set_logging_level(global_loglevel)
+    setup_ok()
+    appmetrics.metrics_file = global_metricslog
+    if global_settings['watermark'] is None:
+        raise ValueError("poll requires a watermark file in the configuration file")
+    owners = args.owner or [u['user'] for u in global_users]
+    start = int(args.since.timestamp()) if args.since is not None else int(time.time())
+    applog.info("Polling owners {} every {} seconds".format(", ".join(owners), args.interval))
+    ledger = QuicklinkLedger(global_ledger) if global_ledger is not None else None
+    foldercache = FolderCache()
+    lookupcache = lookup_cache(global_settings)
+    adaptive = concurrency_limiter(global_settings)
+    profiler = SlowEventProfiler(global_profilethreshold, global_profiledir, global_profilemaxbytes,
+                                 global_profilemode)
+    connections = {}
+    try:
+        while True:
+            counts = {'processed': 0, 'skipped': 0, 'errors': 0}
+            totals = ResourceTotals()
+            try:
+                with HostLimiter(global_lockdir, global_maxconcurrent, global_maxwait):
+                    for owner in owners:
+                        poll_owner(args, owner, start, connections, foldercache, ledger, profiler, adaptive,
+                                   counts, lookupcache, totals)
+                        # a failed connection is tried again at the next poll
+                        if isinstance(connections.get(owner), str):
+                            del connections[owner]
+            except HostLimiter.HostLimiterError as e:
+                # the slots are all held (e.g. by a --batch): the watermarks have not moved, so try at the next poll
+                applog.error("Poll skipped: {}".format(str(e)))
+                appmetrics.record('poll_skipped', 1)
+                counts['errors'] += 1
+            applog.info("Poll complete: {} processed, {} skipped, {} errors".format(
+                counts['processed'], counts['skipped'], counts['errors']))
+            appmetrics.record('poll_files', counts['processed'] + counts['skipped'] + counts['errors'])
+            if totals.summary()['files'] > 0:
+                applog.info("Poll {}".format(totals.format_summary()))
+            if lookupcache is not None:
+                cache_metrics(lookupcache)
+            if args.once:
+                return 1 if counts['errors'] > 0 else 0
+            # the files found are already known to be fresh, so the folder listings are not kept between polls
+            foldercache = FolderCache()
+            for thiscloud in connections.values():
+                thiscloud.folder_cache = foldercache
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        applog.info("Polling stopped")
+        return 0
+
+
+def poll_owner(args, owner, start, connections, foldercache, ledger, profiler, adaptive, counts, lookupcache=None,
+               totals=None):
+    """
+    Process one owner's files modified since their watermark, advancing the watermark after each batch.
+
+    Modification times are whole seconds, so the watermark is the time reached plus the file ids already done
+    at that second; the search asks for files at or after the time and skips those file ids.  A file that
+    fails holds the watermark (it and the files after it are tried again at the next poll) until it has
+    failed POLL_RETRIES times, then it is passed over.
+    :param args: Arguments object
+    :param owner: The owner
+    :param start: Where the owner starts if they have no watermark (seconds since the epoch)
+    :param counts: dict of the number of files processed, skipped and in error.  Updated.
+    :param lookupcache: Optional LRUCache given to new connections
+    :param totals: Optional ResourceTotals of the files.  Updated.
+    """
+    try:
+        thiscloud = batch_connection(owner, connections, foldercache, global_settings, adaptive, lookupcache)
+    except Exception as e:
+        applog.error("Poll of {} failed: {}".format(owner, str(e)))
+        counts['errors'] += 1
+        return
+    mark = read_watermark(global_settings['watermark']).get(owner,
+                                                            {'modified': start, 'seen': [], 'failures': {}})
+    while True:
+        try:
+            files = thiscloud.modified_since(mark['modified'], args.folder, args.batchsize)
+        except Exception as e:
+            applog.error("Poll of {} failed: {}".format(owner, str(e)))
+            counts['errors'] += 1
+            return
+        new = [f for f in files if not (f['modified'] == mark['modified'] and f['fileid'] in mark['seen'])]
+        if len(new) == 0:
+            if len(files) < args.batchsize:
+                return
+            # a whole batch modified in the same second, all done.  Move on to the next second.
+            applog.warning("More than {} files for {} modified at {}".format(args.batchsize, owner,
+                                                                            mark['modified']))
+            mark = {'modified': mark['modified'] + 1, 'seen': [], 'failures': {}}
+            write_watermark(global_settings['watermark'], owner, mark)
+            continue
+        applog.info("Poll found {} files for {}".format(len(new), owner))
+        held = False
+        for f in new:
+            outcome = batch_line(args, "{}|{}".format(owner, f['path']), connections, foldercache, ledger,
+                                 profiler, global_settings, limiter=adaptive, modified=f['modified'],
+                                 lookupcache=lookupcache)
+            counts[outcome[0]] += 1
+            if totals is not None:
+                totals.add(outcome[1])
+            write_result(outcome[1])
+            if outcome[0] == 'errors':
+                failures = mark['failures'].get(str(f['fileid']), 0) + 1
+                if failures < POLL_RETRIES:
+                    mark['failures'][str(f['fileid'])] = failures
+                    held = True
+                    break
+                applog.error("Giving up on {} {} after {} attempts".format(owner, f['path'], failures))
+            if f['modified'] > mark['modified']:
+                mark = {'modified': f['modified'], 'seen': [], 'failures': {}}
+            mark['seen'].append(f['fileid'])
+        write_watermark(global_settings['watermark'], owner, mark)
+        if held or len(files) < args.batchsize:
+            return
+
+
+def read_watermark(filename):
+    """
+    :return: dict of owner -> dict of modified (seconds since the epoch), seen (file ids done at that second)
+             and failures (file id -> attempts)
+    """
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_watermark(filename, owner, mark):
+    """
+    Save an owner's watermark.  The file is written to a temporary name and renamed, so it is always either
+    the old or the new watermark, never half written.  Polls of other owners share the file, so the update is
+    made under an flock on <filename>.lock.
+    """
+    with open(filename + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = read_watermark(filename)
+        state[owner] = mark
+        tmpname = "{}.{}.tmp".format(filename, os.getpid())
+        with open(tmpname, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpname, filename)
+
+
+def parse_datetime(value):
+    """ argparse type for --since and --until """
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("Invalid date/time {} (use YYYY-MM-DD [HH:MM[:SS]])".format(value))
+
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in ('log-stats', 'enqueue', 'poll', 'digest', 'replay'):
+        try:
+            if sys.argv[1] == 'log-stats':
+                sys.exit(log_stats(sys.argv[2:]))
+            if sys.argv[1] == 'poll':
+                sys.exit(poll(sys.argv[2:]))
+            if sys.argv[1] == 'digest':
+                sys.exit(digest(sys.argv[2:]))
+            if sys.argv[1] == 'replay':
+                sys.exit(replay(sys.argv[2:]))
+            sys.exit(enqueue(sys.argv[2:]))
+        except Exception as e:
+            print(str(e))
+            sys.exit(1)
+    reported = False
     try:
-        print("Application Start")
         pgm_args = process_arguments()
+        if pgm_args.output == 'jsonl':
+            # stdout only has the results.  Everything else that is printed goes to stderr.
+            global_results = sys.stdout
+            sys.stdout = sys.stderr
+        print("Application Start")
         print("Arguments Processed")
         process_config(pgm_args.configfile)
         print("Configuration Loaded")
@@ -255,26 +1687,41 @@ if __name__ == '__main__':
         applog.info("App Started")
         if setup_ok():
             set_logging_level(global_loglevel)
+            appmetrics.metrics_file = global_metricslog
             setup_to_log(pgm_args)
-            thiscloud = onxtcld.NxtCld(global_url, pgm_args.owner, ownerpassword(pgm_args.owner))
-            #remove the root
-            prefixlength = len(global_nextcloudroot) + len(pgm_args.owner) + 1 + 6
-            thiscloud.file_path = pgm_args.file[prefixlength:]
-            if pgm_args.create_public_share:
-                thiscloud.optionally_create_public_share = True
-            if pgm_args.public_keyword is not None:
-                thiscloud.public_share_keyword = pgm_args.public_keyword
-            if global_datalog is not None:
-                thiscloud.add_to_csv_file(global_datalog)
-            if global_prontourl is not None:
-                thiscloud.add_pronto_quicklink(global_prontourl, global_prontoapiwebresource,
-                                               global_prontoapiuser, global_prontoapipassword)
-            if isinstance(thiscloud.messages,list):
-                for m in thiscloud.messages:
-                    print(m)
-            else:
-                print("No messages logged from object")
+            profiler = SlowEventProfiler(global_profilethreshold, global_profiledir, global_profilemaxbytes,
+                                         global_profilemode)
+            if pgm_args.batch is not None:
+                batchcounts = process_batch(pgm_args, profiler)
+                print("Batch complete: {} processed, {} skipped, {} errors".format(
+                    batchcounts['processed'], batchcounts['skipped'], batchcounts['errors']))
+                sys.exit(1 if batchcounts['errors'] > 0 else 0)
+            profiler.start()
+            meter = ResourceMeter()
+            started = time.perf_counter()
+            thisevent = {}
+            eventerror = None
+            try:
+                thiscloud = process_event(pgm_args, thisevent)
+            except Exception as e:
+                eventerror = str(e)
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                thisevent['resources'] = meter.stop(thisevent.get('thiscloud'))
+                if 'thiscloud' in thisevent:
+                    timings_to_log(thisevent, pgm_args.owner, elapsed)
+                profiler.stop(tags={'owner': pgm_args.owner, 'file': pgm_args.file,
+                                    'fileid': thisevent.get('fileid')},
+                              timings=event_timings(thisevent))
+                reported = write_result(result_record(pgm_args.owner, thisevent, elapsed, eventerror))
+            if thiscloud is not None:
+                if isinstance(thiscloud.messages,list):
+                    for m in thiscloud.messages:
+                        print(m)
+                else:
+                    print("No messages logged from object")
     except Exception as e:
         applog.error("Error occured: {}".format(str(e)))
         print(str(e))
-        sys.exit(1)
+        sys.exit(1 if reported else EXIT_UNREPORTED)
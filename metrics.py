@@ -0,0 +1,104 @@
+import datetime
+import logging
+import math
+import os
+
+applog = logging.getLogger('applog')
+
+
+class Metrics:
+    '''
+    A very small metrics recorder.
+
+    Each metric is appended to the metrics file as one pipe delimited record, in the style of the datalog:
+
+        date|time|metric|value|tags
+
+    The tags are key=value pairs separated by semicolons.  Each record is a single append, so the processes
+    started by Flow can share the file.  If no metrics file is set the metric is only logged at DEBUG level.
+    The shared instance is appmetrics.
+    '''
+
+    class MetricsError(Exception):
+        pass
+
+    def __init__(self, metrics_file=None):
+        self.__metrics_file = None
+        if metrics_file is not None:
+            self.metrics_file = metrics_file
+
+    @property
+    def metrics_file(self):
+        return self.__metrics_file
+
+    @metrics_file.setter
+    def metrics_file(self, value):
+        if value is not None and (not isinstance(value, str) or len(value) == 0):
+            raise self.MetricsError('Invalid metrics file')
+        self.__metrics_file = value
+
+    def record(self, name, value, **tags):
+        """
+        Record a single metric value.
+        :param name: The name of the metric e.g. limiter_wait
+        :param value: The value (generally a number)
+        :param tags: Any additional identifying information e.g. owner='quicklinks'
+        :return:
+        """
+        tagtext = ";".join(["{}={}".format(k, tags[k]) for k in sorted(tags)])
+        applog.debug("Metric {} {} {}".format(name, value, tagtext))
+        if self.__metrics_file is None:
+            return
+        now = datetime.datetime.now()
+        line = "{}|{}|{}|{}|{}\n".format(now.strftime("%Y-%m-%d"), now.strftime("%H:%M:%S"),
+                                         name, value, tagtext.replace("|", "/").replace("\n", " "))
+        try:
+            fd = os.open(self.__metrics_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode('UTF-8'))
+            finally:
+                os.close(fd)
+        except OSError as e:
+            # metrics must never stop a file being processed.
+            applog.warning("Unable to write metric {} to {} ({})".format(name, self.__metrics_file, str(e)))
+
+    @staticmethod
+    def percentile(values, pct):
+        """
+        Nearest rank percentile: the smallest value with at least pct percent of the values at or below it.
+        :param values: list of numbers (sorted)
+        :param pct: The percentile e.g. 95
+        :return: The value or None if there are no values
+        """
+        if len(values) == 0:
+            return None
+        # pct * n is multiplied first so a whole rank is not pushed up by a rounding error (0.07 * 100)
+        rank = math.ceil(pct * len(values) / 100.0) - 1
+        return values[min(max(rank, 0), len(values) - 1)]
+
+    @staticmethod
+    def read(filename):
+        """
+        Generator returning each metric record in a metrics file as a dictionary.
+        Lines that cannot be parsed are ignored.
+        :param filename: The metrics file
+        :return: dict with date, time, metric, value and tags (a dict)
+        """
+        with open(filename, 'r') as f:
+            for line in f:
+                flds = line.rstrip("\n").split("|")
+                if len(flds) != 5:
+                    continue
+                tags = {}
+                for pair in flds[4].split(";"):
+                    if "=" in pair:
+                        k, v = pair.split("=", 1)
+                        tags[k] = v
+                try:
+                    value = float(flds[3])
+                except ValueError:
+                    value = flds[3]
+                yield {'date': flds[0], 'time': flds[1], 'metric': flds[2], 'value': value, 'tags': tags}
+
+
+appmetrics = Metrics()
@@ -0,0 +1,117 @@
+import contextlib
+import hashlib
+import logging
+import sqlite3
+import time
+
+applog = logging.getLogger('applog')
+
+
+class NegativeCache:
+    '''
+    A short lived record of files that could not be found and logins that nextcloud rejected.
+
+    Each is remembered for ttl seconds, so a retry or duplicate event fails at once without going near
+    nextcloud (and repeated bad logins do not set off its brute force protection).  Logins are keyed on the
+    url, owner and a hash of the password, so a changed password takes effect at once.  Only answers from
+    nextcloud are remembered, never an outage.  The cache is a sqlite database shared by every process.
+
+    Usage:
+        cache = NegativeCache('/home/velocity/vnextcloud/negative.db', ttl=60)
+        reason = cache.lookup('path', url, 'quicklinks', 'Documents/EQ100.pdf')
+        if reason is None:
+            # ask nextcloud, and if it is not found
+            cache.record("not found", 'path', url, 'quicklinks', 'Documents/EQ100.pdf')
+    '''
+
+    class NegativeCacheError(Exception):
+        pass
+
+    KINDS = ('path', 'login')
+
+    def __init__(self, dbfile, ttl=60):
+        """
+        :param dbfile: The sqlite database.  Created if it does not exist.
+        :param ttl: Seconds a failure is remembered
+        """
+        if not isinstance(dbfile, str) or len(dbfile) == 0:
+            raise self.NegativeCacheError('Invalid negative cache file')
+        if ttl <= 0:
+            raise self.NegativeCacheError('ttl must be more than 0')
+        self.__dbfile = dbfile
+        self.__ttl = ttl
+        with self.__transaction() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS negative (
+                            kind TEXT NOT NULL,
+                            key TEXT NOT NULL,
+                            reason TEXT,
+                            expires REAL NOT NULL,
+                            PRIMARY KEY (kind, key))""")
+
+    @property
+    def dbfile(self):
+        return self.__dbfile
+
+    @property
+    def ttl(self):
+        return self.__ttl
+
+    def lookup(self, kind, *parts):
+        """
+        The reason a request failed, if it failed less than ttl seconds ago
+        :param kind: path or login
+        :param parts: What identifies the request (path: url, owner, path.  login: url, owner, password)
+        :return: The reason or None
+        """
+        with self.__transaction() as db:
+            row = db.execute("SELECT reason FROM negative WHERE kind=? AND key=? AND expires>?",
+                             (kind, self.__key(kind, parts), time.time())).fetchone()
+        return row[0] if row is not None else None
+
+    def record(self, reason, kind, *parts):
+        """
+        Remember a failed request for ttl seconds
+        :param reason: The error message
+        """
+        with self.__transaction() as db:
+            now = time.time()
+            db.execute("DELETE FROM negative WHERE expires<=?", (now,))
+            db.execute("INSERT OR REPLACE INTO negative VALUES (?,?,?,?)",
+                       (kind, self.__key(kind, parts), str(reason), now + self.__ttl))
+        applog.debug("Negative cache: {} failure remembered for {} seconds".format(kind, self.__ttl))
+
+    def forget(self, kind, *parts):
+        """
+        Remove the entry for a request (e.g. it has now succeeded)
+        :return: True if there was an entry
+        """
+        with self.__transaction() as db:
+            count = db.execute("DELETE FROM negative WHERE kind=? AND key=?",
+                               (kind, self.__key(kind, parts))).rowcount
+        return count > 0
+
+    # ---------------------------- Private Methods ---------------------------------------
+
+    @contextlib.contextmanager
+    def __transaction(self):
+        """ Open the cache, commit (or roll back on error) and close it again """
+        try:
+            db = sqlite3.connect(self.__dbfile, timeout=30)
+        except sqlite3.Error as e:
+            raise self.NegativeCacheError("Unable to open negative cache {} ({})".format(self.__dbfile, str(e)))
+        try:
+            with db:
+                yield db
+        except sqlite3.Error as e:
+            raise self.NegativeCacheError("Negative cache error {} ({})".format(self.__dbfile, str(e)))
+        finally:
+            db.close()
+
+    def __key(self, kind, parts):
+        if kind not in self.KINDS:
+            raise self.NegativeCacheError("Unknown kind {}".format(kind))
+        key = "|".join(str(p) for p in parts)
+        if kind == 'login':
+            # never store the password
+            key = hashlib.sha256(key.encode('UTF-8')).hexdigest()
+        return key
@@ -1,14 +1,23 @@
 from nextcloud import NextCloud
 from nextcloud import NextCloud
-from nextcloud.codes import ShareType
+from nextcloud.codes import Permission, ShareType
+from nextcloud.exceptions import NextCloudConnectionError
 import os
 import decimal
 import csv
 import datetime
+import functools
 import logging
+import threading
+import time
 import requests
 import xml.etree.ElementTree as ET
 import urllib3
+from urllib.parse import urlencode, unquote, urlsplit
+from email.utils import parsedate_to_datetime
+from xml.sax.saxutils import escape
+from pathlock import PathLock
+from metrics import appmetrics
 
 urllib3.disable_warnings()
 
@@ -19,7 +28,33 @@ class NxtCld:
     class NxtCldError(Exception):
         pass
 
-    def __init__(self, url, user, password, filepath=None):
+    # seconds a pronto request may take
+    PRONTO_TIMEOUT = 60
+    # the errors of a request that got no response (the nextcloud library wraps those of requests)
+    UNREACHABLE = (requests.RequestException, NextCloudConnectionError)
+
+    def __timed(stage):
+        """
+        Decorator to add the time spent in a method to the stage timings (see timings).
+        Time spent in other timed methods called by this one is only counted against those methods.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(self, *args, **kwargs):
+                started = time.perf_counter()
+                outer_child_time = self.__child_time
+                self.__child_time = 0.0
+                try:
+                    return func(self, *args, **kwargs)
+                finally:
+                    elapsed = time.perf_counter() - started
+                    self.__timings[stage] = self.__timings.get(stage, 0.0) + elapsed - self.__child_time
+                    self.__child_time = outer_child_time + elapsed
+            return wrapper
+        return decorator
+
+    def __init__(self, url, user, password, filepath=None, keep_alive=False, negative_cache=None,
+                 circuit_breakers=None):
         """
         The class must be instantiated with a URL to the next Cloud server, a user id to connect with
         and a password for that user.  Optionally a path can be added to the instantiation or set via the setter.
@@ -82,31 +117,78 @@ class NxtCld:
         :param url:  The url of the nexcloud server
         :param user: The name of the user who owns the file
         :param password: The password of the user who owns the file.
+        :param keep_alive: Keep one http session (and its connections) for all requests to nextcloud.  Worthwhile
+                           when the object is reused for many files (batch or service).
+        :param negative_cache: A NegativeCache.  A login that nextcloud rejected, or a file it could not find,
+                               fails at once (without asking nextcloud again) until the cache entry expires.
+        :param circuit_breakers: dict of CircuitBreaker (nextcloud and/or pronto).  The outcome of the connection
+                                 check and of each pronto request is reported to them.  Whether an event may
+                                 start is decided by the caller.
         """
         # todo: validate parameters.
 
         self.__public_share_keyword = None
         self.__optionally_create_public_share = False
+        self.__private_share_only = False
+        self.__reuse_folder_share = False
+        self.__quicklink_ledger = None
+        self.__lock_directory = None
+        self.__folder_cache = None
+        self.__lookup_cache = None
+        self.__pronto_session = None
+        self.__concurrency_limiter = None
+        self.__negative_cache = negative_cache
+        self.__circuit_breakers = circuit_breakers or {}
+        self.__filecache_resolver = None
         self.__log_file = None
         self.__pronto_url = None
         self.__url = None
         self.__user = None
         self.__password = None
+        self.__http_usage = {}
+        self.__http_guard = threading.Lock()
         # Set the following variables using the appropriate setter to ensure validation is done.
         self.url = url
         self.user = user
         self.password = password
         # Establish connection
+        started = time.perf_counter()
         self.__nxc = NextCloud(self.__url, self.__user, self.__password,
-                               session_kwargs={'verify': False}
+                               session_kwargs={'verify': False, 'hooks': {'response': [self.__count_response]}}
                                )
-        ci = self.__nxc.get_connection_issues()  # execution time for this function is VERY Slow
+        if keep_alive:
+            # login only sets up a requests session - it does not make a request.
+            self.__nxc.login()
+        if self.__negative_cache is not None:
+            reason = self.__negative_cache.lookup('login', self.__url, self.__user, self.__password)
+            if reason is not None:
+                applog.error("Failed to Connect : {} (login recently rejected: {})".format(self.__url, reason))
+                raise self.NxtCldError("Failed to Connect : {} (login recently rejected)".format(self.__url))
+        # the same check as get_connection_issues, but a rejected login is told apart from a network error
+        try:
+            resp = self.__nxc.get_user()  # execution time for this function is VERY Slow
+            ci = None if resp.is_ok else resp.meta['message']
+            # status_code is the OCS status - the http status is that of the raw response
+            outage = resp.raw.status_code >= 500
+            # only a wrong password (http 401 or OCS 997), not a proxy or maintenance page during an outage
+            rejected = not resp.is_ok and not outage and (resp.raw.status_code == 401 or resp.status_code == 997)
+        except Exception as e:
+            ci = str(e)
+            rejected = False
+            # a response is reported to the breaker by __count_response, no response is reported here
+            if 'nextcloud' in self.__circuit_breakers:
+                self.__circuit_breakers['nextcloud'].failure(ci)
         if ci is not None:
+            if rejected and self.__negative_cache is not None:
+                self.__negative_cache.record(ci, 'login', self.__url, self.__user, self.__password)
             applog.error("Failed to Connect : {}".format(self.__url))
             raise self.NxtCldError("Failed to Connect : {}".format(self.__url))
         applog.info("Successful Connection to URL")
         # initialise private variables.
+        connect_usage = self.__http_usage
         self._initialise_internal_variables()
+        self.__timings['connect'] = time.perf_counter() - started
+        self.__http_usage = connect_usage
         if filepath is not None:
             # use setter to ensure validation and ALSO PROCESSING.
             self.file_path = filepath
@@ -205,6 +287,134 @@ class NxtCld:
             raise TypeError('Invalid value for this variable (must be true or false')
         self.__optionally_create_public_share = value
 
+    @property
+    def private_share_only(self):
+        return self.__private_share_only
+
+    @private_share_only.setter
+    def private_share_only(self, value):
+        """
+        When set, the private url is always used.  Existing public shares are not looked up and
+        no public share is created (regardless of optionally_create_public_share or the keyword).
+        """
+        if not self.__isbool(value):
+            raise TypeError('Invalid value for this variable (must be true or false')
+        self.__private_share_only = value
+
+    @property
+    def reuse_folder_share(self):
+        return self.__reuse_folder_share
+
+    @reuse_folder_share.setter
+    def reuse_folder_share(self, value):
+        """
+        When set, and a public share would otherwise be created, the folders above the file are checked
+        for a public share first.  If one is found the url of the file is derived from the folder share
+        and no new share is created.
+        """
+        if not self.__isbool(value):
+            raise TypeError('Invalid value for this variable (must be true or false')
+        self.__reuse_folder_share = value
+
+    @property
+    def quicklink_ledger(self):
+        return self.__quicklink_ledger
+
+    @quicklink_ledger.setter
+    def quicklink_ledger(self, value):
+        """
+        A QuicklinkLedger.  If set, add_pronto_quicklink does not call pronto when an identical quicklink
+        has already been registered, and records each successful registration.  A file registered under
+        another name (moved or renamed, see moved_from) keeps its public share and pronto is asked to update
+        the existing quicklink.
+        """
+        self.__quicklink_ledger = value
+
+    @property
+    def lock_directory(self):
+        return self.__lock_directory
+
+    @lock_directory.setter
+    def lock_directory(self, value):
+        """
+        If set, a lock on the file (see PathLock) is held while checking for and creating a public share,
+        so that two events for the same file can't both create a share.
+        """
+        if not self.__isstr(value):
+            raise TypeError('Invalid lock_directory')
+        self.__lock_directory = value
+
+    @property
+    def folder_cache(self):
+        return self.__folder_cache
+
+    @folder_cache.setter
+    def folder_cache(self, value):
+        """
+        A FolderCache.  If set, the file id is looked up in the listing of the file's folder (one request
+        per folder rather than one per file) before asking nextcloud for the file itself.
+        """
+        self.__folder_cache = value
+
+    @property
+    def lookup_cache(self):
+        return self.__lookup_cache
+
+    @lookup_cache.setter
+    def lookup_cache(self, value):
+        """
+        An LRUCache shared by the files a process handles.  The file id of a file and the public shares of
+        files and folders are kept in it (by owner and path), so a file or folder looked up again is not asked
+        of nextcloud.  Creating a share removes the cached shares of its file, and when a share may be created
+        the file's shares are always asked of nextcloud, so a share is never created because the cache is out
+        of date.
+        """
+        self.__lookup_cache = value
+
+    @property
+    def pronto_session(self):
+        return self.__pronto_session
+
+    @pronto_session.setter
+    def pronto_session(self, value):
+        """
+        A requests.Session used for the calls to the pronto api, so the connection is reused across files.
+        If not set each call makes a new connection.
+        """
+        self.__pronto_session = value
+
+    @property
+    def filecache_resolver(self):
+        return self.__filecache_resolver
+
+    @filecache_resolver.setter
+    def filecache_resolver(self, value):
+        """
+        A FileCacheResolver.  If set, the file id is read from nextcloud's database first, and only if it is not
+        found there is nextcloud asked.
+        """
+        self.__filecache_resolver = value
+
+    @property
+    def negative_cache(self):
+        return self.__negative_cache
+
+    @property
+    def circuit_breakers(self):
+        return self.__circuit_breakers
+
+    @property
+    def concurrency_limiter(self):
+        return self.__concurrency_limiter
+
+    @concurrency_limiter.setter
+    def concurrency_limiter(self, value):
+        """
+        An AdaptiveLimiter.  If set, the get shares, create share and vapi-ql calls wait for a slot from the
+        limiter, which adjusts the number in flight to each from the latency and errors it sees.
+        """
+        self.__concurrency_limiter = value
+
     @property
     def public_share_keyword(self):
         return self.__public_share_keyword
@@ -236,10 +446,60 @@ class NxtCld:
             self.__set_fileid_from_path()
         return self.__fileid
 
+    @property
+    def file_modified(self):
+        """
+        The time the file was last modified in nextcloud (seconds since the epoch).  Known without a request if
+        the file id was read from the file itself, otherwise one PROPFIND asking only for the time.
+        """
+        if self.__file_modified is None:
+            self.__set_modified_from_path()
+        return self.__file_modified
+
     @property
     def messages(self):
         return self.__messages
 
+    @property
+    def timings(self):
+        """
+        dict of the seconds spent in each stage of processing the file:
+            connect, fileid, modified, shares, datalog and pronto
+        A stage is only present once it has run.
+        """
+        return {k: round(v, 3) for k, v in self.__timings.items()}
+
+    @property
+    def http_usage(self):
+        """
+        dict of endpoint -> dict of requests, sent and received (bytes of the request and response bodies) for
+        the http requests made for the file.  The endpoints are nc_user, nc_propfind, nc_search, nc_get_shares,
+        nc_create_share, nc_other, pronto_token and pronto_vapiql.  An endpoint is only present once it has
+        been called.
+        """
+        with self.__http_guard:
+            return {k: dict(v) for k, v in self.__http_usage.items()}
+
+    @property
+    def public_share_created(self):
+        """ True if this object created the public share (rather than finding an existing one) """
+        return self.__public_share_created
+
+    @property
+    def pronto_result(self):
+        """ dict of company, object, keys and seq returned by pronto (None until the quicklink is added) """
+        return self.__pronto_result
+
+    @property
+    def moved_from(self):
+        """
+        The path the file was registered under if it has since been moved or renamed (found by its file id in
+        the quicklink ledger), otherwise None
+        """
+        if not self.__shares_processed:
+            self.__process_shares()
+        return self.__moved_from['filename'] if self.__moved_from is not None else None
+
     # @file_id.setter
     # def file_id(self, value):
     #     if self.__fileid is not None:
@@ -315,6 +575,7 @@ class NxtCld:
     #         applog.info('Existing Public Share Returned {}'.format(fps))
     #         return fps
 
+    @__timed('datalog')
     def add_to_csv_file(self, logfile=None):
         if not self.__shares_processed:
             self.__process_shares()
@@ -327,39 +588,67 @@ class NxtCld:
             raise self.NxtCldError("log file not set")
         if self.__file_path is None:
             raise self.NxtCldError("No filepath set to log.")
+        self.append_to_csv_file(self.__log_file, [self.datalog_record()])
+
+    def datalog_record(self):
+        """
+        The datalog row for the file (as written by add_to_csv_file)
+        :return: dict of date, time, file, owner, url, shareid and fileid
+        """
+        if not self.__shares_processed:
+            self.__process_shares()
+        if self.__file_path is None:
+            raise self.NxtCldError("No filepath set to log.")
+        return {
+            'date': datetime.datetime.now().strftime("%Y-%m-%d"),
+            'time': datetime.datetime.now().strftime("%H:%M:%S"),
+            'file': self.__file_path,
+            'owner': self.__user,
+            'url': self.__share_url,
+            'shareid': self.__public_share_id,
+            'fileid': self.__fileid
+        }
+
+    @classmethod
+    def append_to_csv_file(cls, logfile, records):
+        """
+        Append datalog rows (see datalog_record) to the datalog, writing the header if the file is new
+        :param logfile: The datalog
+        :param records: list of dict
+        """
         flds = ['date', 'time', 'file', 'owner', 'url', 'shareid', 'fileid']
         # if not os.path.isfile(self.__log_file):
         try:
-            f = open(self.__log_file, 'a')
+            f = open(logfile, 'a')
             filesize = os.stat(f.fileno()).st_size
             wrtr = csv.DictWriter(f, fieldnames=flds, delimiter="|")
             if filesize == 0:
                 # write the header
                 wrtr.writeheader()
             # add next record here
-            wrtr.writerow({
-                'date': datetime.datetime.now().strftime("%Y-%m-%d"),
-                'time': datetime.datetime.now().strftime("%H:%M:%S"),
-                'file': self.__file_path,
-                'owner': self.__user,
-                'url': self.__share_url,
-                'shareid': self.__public_share_id,
-                'fileid': self.__fileid
-            })
+            wrtr.writerows(records)
             f.close()
         except Exception as e:
             applog.debug("Error adding log entry:{}".format(str(e)))
-            raise self.NxtCldError("Error adding log entry:{}".format(str(e)))
+            raise cls.NxtCldError("Error adding log entry:{}".format(str(e)))
 
-    def add_pronto_quicklink(self, apiurl, apiwebresource, apiuser, apipassword):
+    @__timed('pronto')
+    def add_pronto_quicklink(self, apiurl, apiwebresource, apiuser, apipassword, force=False, timeout=None):
         """
-        Call the pronto api to add a quicklink
+        Call the pronto api to add a quicklink (or, if the file has been moved or renamed, to update the existing
+        quicklink: see moved_from.  previousfilename and previousseq are added to the request, and vapiql.spl
+        answers with previousseq when it has updated that quicklink.  If it answers with another seq it has
+        added a second quicklink: that is logged, and recorded as the quicklink_not_updated metric.)
         :param apiurl:
         :param apiwebresource:
         :param apiuser:
         :param apipassword:
+        :param force: Call the api even if the quicklink ledger shows it has already been registered
+        :param timeout: Optional seconds the requests to pronto may take between them (the token and the api
+                        call).  Default: PRONTO_TIMEOUT for each request.
         :return:
         """
+        self.__pronto_deadline = time.monotonic() + timeout if timeout is not None else None
         # Verify we have the necessary data
         if not self.__shares_processed:
             self.__process_shares()
@@ -370,6 +659,19 @@ class NxtCld:
             raise self.NxtCldError("The owner of the file must be set before calling the pronto api")
         if not self.__isstr(self.share_url):
             raise self.NxtCldError("The public share  must be set before calling the pronto api")
+        if self.__quicklink_ledger is not None and not force:
+            entry = self.__quicklink_ledger.lookup(self.file_path, self.user, self.share_url,
+                                                   self.public_share_id, self.file_id)
+            if entry is not None:
+                applog.info("Quicklink already registered on {} - api not called".format(entry['registered']))
+                self.__pronto_result = {'company': entry['company'], 'object': entry['object'],
+                                        'keys': entry['keys'], 'seq': entry['seq']}
+                self.__messages.append("Quicklink already registered {}".format(entry['registered']))
+                self.__messages.append("Company {}".format(entry['company']))
+                self.__messages.append("Pronto Object {}".format(entry['object']))
+                self.__messages.append("Keys {}".format(entry['keys']))
+                self.__messages.append("Sequence {}".format(entry['seq']))
+                return
         #
         # build the header
         headers = {'Content-Type': 'application/xml',
@@ -388,12 +690,19 @@ class NxtCld:
         if self.file_id != 0:
             ET.SubElement(root, 'fileid').text = str(self.file_id)
             applog.info('API Parameter fileid :{}'.format(self.file_id))
+        if self.__moved_from is not None:
+            # the file was moved or renamed: update the existing quicklink rather than adding another
+            ET.SubElement(root, 'previousfilename').text = self.__moved_from['filename']
+            applog.info('API Parameter previousfilename :{}'.format(self.__moved_from['filename']))
+            if len(self.__moved_from['seq'] or '') > 0:
+                ET.SubElement(root, 'previousseq').text = self.__moved_from['seq']
+                applog.info('API Parameter previousseq :{}'.format(self.__moved_from['seq']))
         body = ET.tostring(root, encoding='UTF-8', xml_declaration=True)
         # set the url for the api call
         url = apiurl + "/pronto/rest/" + apiwebresource + "/api/vapi-ql"
         # call the api
         applog.info('Calling Pronto API')
-        resp = requests.request("POST", url, headers=headers, data=body)
+        resp = self.__limited('vapiql', self.__pronto_request, "POST", url, headers=headers, data=body)
         if resp.status_code != 200:
             applog.error("Call to API Failed ({} - {})".format(resp.status_code, resp.text))
             raise self.NxtCldError("Call to API Failed ({} - {})".format(resp.status_code, resp.text))
@@ -408,17 +717,85 @@ class NxtCld:
             applog.error("API Response Message: {}".format(root.findall("./APIResponseStatus/Message")[0].text))
             raise self.NxtCldError(root.findall('./APIResponseStatus/Message')[0].text)
         else:
-            applog.info("Company {}".format(root.findall("./ResponseFields/company")[0].text))
-            applog.info("Pronto Object : {}".format(root.findall("./ResponseFields/object")[0].text))
-            applog.info("Keys {}".format(root.findall("./ResponseFields/keys")[0].text))
-            applog.info("Sequence {}".format(root.findall("./ResponseFields/seq")[0].text))
-            self.__messages.append("Quicklink Added")
-            self.__messages.append("Company {}".format(root.findall("./ResponseFields/company")[0].text))
-            self.__messages.append("Pronto Object {}".format(root.findall("./ResponseFields/object")[0].text))
-            self.__messages.append("Keys {}".format(root.findall("./ResponseFields/keys")[0].text))
-            self.__messages.append("Sequence {}".format(root.findall("./ResponseFields/seq")[0].text))
+            self.__pronto_result = {'company': root.findall("./ResponseFields/company")[0].text,
+                                    'object': root.findall("./ResponseFields/object")[0].text,
+                                    'keys': root.findall("./ResponseFields/keys")[0].text,
+                                    'seq': root.findall("./ResponseFields/seq")[0].text}
+            applog.info("Company {}".format(self.__pronto_result['company']))
+            applog.info("Pronto Object : {}".format(self.__pronto_result['object']))
+            applog.info("Keys {}".format(self.__pronto_result['keys']))
+            applog.info("Sequence {}".format(self.__pronto_result['seq']))
+            previousseq = self.__moved_from['seq'] if self.__moved_from is not None else None
+            if previousseq and self.__pronto_result['seq'] != previousseq:
+                # the api did not use previousseq: the old quicklink is still there beside the new one
+                applog.warning("Quicklink {} of {} was not updated: {} added as {}".format(
+                    previousseq, self.__moved_from['filename'], self.file_path, self.__pronto_result['seq']))
+                appmetrics.record('quicklink_not_updated', 1, owner=self.user)
+                self.__messages.append("Quicklink {} not updated - added again".format(previousseq))
+            elif self.__moved_from is not None:
+                self.__messages.append("Quicklink Updated")
+            else:
+                self.__messages.append("Quicklink Added")
+            self.__messages.append("Company {}".format(self.__pronto_result['company']))
+            self.__messages.append("Pronto Object {}".format(self.__pronto_result['object']))
+            self.__messages.append("Keys {}".format(self.__pronto_result['keys']))
+            self.__messages.append("Sequence {}".format(self.__pronto_result['seq']))
+            if self.__quicklink_ledger is not None:
+                self.__quicklink_ledger.record(self.file_path, self.user, self.share_url, self.public_share_id,
+                                               self.file_id, self.__pronto_result['company'],
+                                               self.__pronto_result['object'], self.__pronto_result['keys'],
+                                               self.__pronto_result['seq'])
+                if self.__moved_from is not None:
+                    # the old name is no longer registered
+                    self.__quicklink_ledger.invalidate(owner=self.user, filename=self.__moved_from['filename'],
+                                                       fileid=self.file_id)
         applog.info("Quicklinks API Successful")
 
+    def modified_since(self, since, folder="", limit=100):
+        """
+        The files of the user modified at or after a time, oldest first, found with one WebDAV SEARCH.
+        Folders are not returned.
+        :param since: Seconds since the epoch (nextcloud modification times are whole seconds)
+        :param folder: Only search this folder (and below).  Default: all the user's files.
+        :param limit: The most files returned
+        :return: list of dict of path (relative to the user's files, with a leading /), fileid and modified
+        """
+        scope = "/files/{}/{}".format(self.__user, folder.strip("/")).rstrip("/")
+        body = ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<d:searchrequest xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns"><d:basicsearch>'
+                '<d:select><d:prop><oc:fileid/><d:getlastmodified/><d:resourcetype/></d:prop></d:select>'
+                '<d:from><d:scope><d:href>{}</d:href><d:depth>infinity</d:depth></d:scope></d:from>'
+                '<d:where><d:gte><d:prop><d:getlastmodified/></d:prop><d:literal>{}</d:literal></d:gte></d:where>'
+                '<d:orderby><d:order><d:prop><d:getlastmodified/></d:prop><d:ascending/></d:order></d:orderby>'
+                '<d:limit><d:nresults>{}</d:nresults></d:limit>'
+                '</d:basicsearch></d:searchrequest>').format(escape(scope), int(since), int(limit))
+        applog.debug("Searching {} for files modified since {}".format(scope, int(since)))
+        try:
+            resp = self.__nxc.session.request('SEARCH', self.__url.rstrip("/") + '/remote.php/dav/', data=body,
+                                              headers={'Content-Type': 'text/xml; charset=UTF-8'})
+        except Exception as e:
+            self.__unreachable(e)
+            raise self.NxtCldError("Search for modified files failed: {}".format(str(e)))
+        if resp.status_code != 207:
+            raise self.NxtCldError("Search for modified files failed ({} - {})".format(resp.status_code,
+                                                                                      resp.text[:200]))
+        ns = {'d': 'DAV:', 'oc': 'http://owncloud.org/ns'}
+        prefix = '/remote.php/dav/files/{}'.format(self.__user)
+        files = []
+        for node in ET.fromstring(resp.content).findall('d:response', ns):
+            if node.find('.//d:resourcetype/d:collection', ns) is not None:
+                continue
+            href = unquote(node.findtext('d:href', '', ns))
+            modified = node.findtext('.//d:getlastmodified', None, ns)
+            fileid = node.findtext('.//oc:fileid', None, ns)
+            if prefix not in href or modified is None:
+                continue
+            files.append({'path': "/" + href.split(prefix, 1)[1].strip("/"),
+                          'fileid': int(fileid) if fileid is not None else None,
+                          'modified': int(parsedate_to_datetime(modified).timestamp())})
+        files.sort(key=lambda f: f['modified'])
+        return files
+
     # ---------------------------- Private Methods ---------------------------------------
 
     def _initialise_internal_variables(self):
@@ -429,6 +806,7 @@ class NxtCld:
         :return:
         """
         self.__fileid = None
+        self.__file_modified = None
         self.__file_path = None
         self.__log_file = None
         self.__pronto_url = None
@@ -436,9 +814,20 @@ class NxtCld:
         self.__public_share_id = None
         self.__public_share_keyword = None
         self.__optionally_create_public_share = False
+        self.__private_share_only = False
+        self.__reuse_folder_share = False
         self.__shares_processed = False
+        self.__public_share_created = False
+        self.__pronto_result = None
+        self.__moved_from = None
+        self.__pronto_deadline = None
+        self.__timings = {}
+        self.__child_time = 0.0
+        with self.__http_guard:
+            self.__http_usage = {}
         self.__messages = []
 
+    @__timed('shares')
     def __process_shares(self):
         if self.__shares_processed:
             return  # shares already processed.
@@ -446,30 +835,77 @@ class NxtCld:
             raise self.NxtCldError("No File Specified")
         if self.__fileid is None:
             self.__set_fileid_from_path()
-        # If a public share exists then use it.
-        fps = self.__get_first_public_share()
-        if fps is None:
-            # do we need to create one?  If optionally_create_public_share exists or the keyword is in the path
+        if self.__quicklink_ledger is not None:
+            self.__moved_from = self.__quicklink_ledger.moved(self.__user, self.__fileid, self.__file_path)
+            if self.__moved_from is not None:
+                applog.info("File {} was registered as {}".format(self.__file_path, self.__moved_from['filename']))
+                self.__messages.append("File moved from {}".format(self.__moved_from['filename']))
+        if self.__private_share_only:
+            applog.info('Private share only - public shares not checked')
+        elif self.__moved_from is not None and self.__keep_moved_share():
+            pass
+        else:
+            # A share is created if none exists and optionally_create_public_share is set or the keyword is in the path
             if self.__public_share_keyword is not None:
                 if self.__public_share_keyword.upper() in self.__file_path.upper():
                     self.__optionally_create_public_share = True
-            if self.__optionally_create_public_share:
-                self.__create_public_share()
-        else:
-            applog.info('Existing Public Share Returned {}'.format(fps))
+            if self.__optionally_create_public_share and self.__lock_directory is not None:
+                # Another event for the same file waits here, then finds the share this one creates.
+                with PathLock(self.__lock_directory, self.__user, self.__file_path):
+                    self.__get_or_create_public_share()
+            else:
+                self.__get_or_create_public_share()
         # use a private share if no public one is available
         if self.__public_share_id is None:
             self.__share_url = self.__url + '/index.php/f/' + str(self.__fileid)
         self.__shares_processed = True
 
+    def __keep_moved_share(self):
+        """
+        Keep the public share a moved file was registered with (nextcloud keeps the share with the file), if it is
+        still there.  A url derived from a folder share holds the old path so is looked for again.
+        :return: True if the share was kept
+        """
+        if len(self.__moved_from['publicshareid']) == 0 or '/download?' in self.__moved_from['shareurl']:
+            return False
+        # the share may have been removed since (the ledger does not know)
+        for d in self.__public_shares(self.__file_path, cached=False):
+            if str(d['id']) == self.__moved_from['publicshareid']:
+                self.__share_url = d['url']
+                self.__public_share_id = d['id']
+                applog.info('Public share {} kept from {}'.format(self.__public_share_id,
+                                                                  self.__moved_from['filename']))
+                self.__messages.append("Existing public share kept:")
+                self.__messages.append("Share Link Id : {}".format(self.__public_share_id))
+                self.__messages.append("URL: {}".format(self.__share_url))
+                return True
+        applog.info('Public share {} of {} no longer exists'.format(self.__moved_from['publicshareid'],
+                                                                    self.__moved_from['filename']))
+        return False
+
+    def __get_or_create_public_share(self):
+        # If a public share exists then use it.
+        # a cached "no share" may be out of date, so it is never trusted when a share could be created
+        fps = self.__get_first_public_share(cached=not self.__optionally_create_public_share)
+        if fps is None:
+            if self.__optionally_create_public_share:
+                if not self.__reuse_folder_share or self.__get_folder_public_share() is None:
+                    self.__create_public_share()
+        else:
+            applog.info('Existing Public Share Returned {}'.format(fps))
+
     def __create_public_share(self):
         applog.info("New public share required")
         try:
-            lnk = self.__nxc.create_share(self.__file_path, share_type=ShareType.PUBLIC_LINK)
+            lnk = self.__limited('create_share', self.__nxc.create_share, self.__file_path,
+                                 share_type=ShareType.PUBLIC_LINK)
             # self.__messages.append('lnk.data in get_create_public_share {}'.format(lnk.data))
             applog.info('New Public Share Created {}'.format(lnk.data['url']))
             self.__share_url = lnk.data['url']
             self.__public_share_id = lnk.data['id']
+            self.__public_share_created = True
+            if self.__lookup_cache is not None:
+                self.__lookup_cache.invalidate(('shares', self.__user, self.__file_path.strip("/")))
             self.__messages.append("New public share created:")
             self.__messages.append("Share Link Id : {}".format(self.__public_share_id))
             self.__messages.append("URL: {}".format(self.__share_url))
@@ -478,18 +914,18 @@ class NxtCld:
             applog.error("Error in create public share : {} ".format(str(e)))
             self.NxtCldError("Error in create public share : {} ".format(str(e)))
 
-    def __get_first_public_share(self):
+    def __get_first_public_share(self, cached=True):
         """
         Return the url of the first public share for the file path.
         If there are no shares then return None.
+        :param cached: Use the lookup cache (if there is one)
         :return: url of first public share
         """
         applog.debug("Getting First Public Share")
         if len(self.__file_path) == 0:
             applog.error("The file path is blank")
             raise self.NxtCldError("The file path is blank")
-        theseshares = self.__nxc.get_shares_from_path(self.__file_path)
-        for d in theseshares.data:
+        for d in self.__public_shares(self.__file_path, cached):
             if d['share_type'] == ShareType.PUBLIC_LINK:
                 self.__share_url = d['url']
                 self.__public_share_id = d['id']
@@ -502,6 +938,65 @@ class NxtCld:
         applog.debug('No public shares found for file.')
         return None
 
+    def __get_folder_public_share(self):
+        """
+        Look for a public share on the folders above the file, nearest folder first.  If one is
+        found the url of the file is derived from it in the form nextcloud uses for a file within
+        a shared folder:
+            https://server/index.php/s/<token>/download?path=/sub/folder&files=filename.pdf
+        The public share id is the id of the folder share.  A share that can't be read (a file drop) is
+        skipped.  With a folder cache each folder's shares are asked of nextcloud once.
+        :return: derived url or None if no folder above the file has a public share
+        """
+        applog.debug("Checking folders for a public share")
+        parts = [p for p in self.__file_path.split("/") if len(p) > 0]
+        filename = parts[-1]
+        for depth in range(len(parts) - 1, 0, -1):
+            folder = "/".join(parts[:depth])
+            if self.__folder_cache is not None:
+                theseshares = self.__folder_cache.shares(self.__user, folder,
+                                                         functools.partial(self.__public_shares, folder))
+            else:
+                theseshares = self.__public_shares(folder)
+            if not isinstance(theseshares, list):
+                continue
+            for d in theseshares:
+                if d['share_type'] == ShareType.PUBLIC_LINK and d['permissions'] & Permission.READ:
+                    subpath = "/" + "/".join(parts[depth:-1])
+                    self.__share_url = d['url'] + '/download?' + urlencode({'path': subpath, 'files': filename})
+                    self.__public_share_id = d['id']
+                    applog.info('Existing public share found for folder {}'.format(folder))
+                    self.__messages.append("Existing folder public share located:")
+                    self.__messages.append("Folder : {}".format(folder))
+                    self.__messages.append("Share Link Id : {}".format(self.__public_share_id))
+                    self.__messages.append("URL: {}".format(self.__share_url))
+                    return self.__share_url
+        applog.debug('No public shares found for the folders above the file.')
+        return None
+
+    def __public_shares(self, path, cached=True):
+        """
+        The public link shares of a file or folder, from the lookup cache if it has them.  Only the share type,
+        url, id and permissions of each are kept.
+        :param path: The path relative to the owners files
+        :param cached: Use the lookup cache (if there is one).  The answer is cached either way.
+        :return: list of dict, or the response data as is if nextcloud did not return a list
+        """
+        key = ('shares', self.__user, path.strip("/"))
+        if cached and self.__lookup_cache is not None:
+            shares = self.__lookup_cache.get(key)
+            if shares is not None:
+                return shares
+        theseshares = self.__limited('get_shares', self.__nxc.get_shares_from_path, path)
+        if not isinstance(theseshares.data, list):
+            return theseshares.data
+        shares = [{'share_type': d['share_type'], 'url': d['url'], 'id': d['id'],
+                   'permissions': int(d['permissions'])} for d in theseshares.data
+                  if d['share_type'] == ShareType.PUBLIC_LINK]
+        if self.__lookup_cache is not None:
+            self.__lookup_cache.put(key, shares)
+        return shares
+
     def __get_pronto_token(self, apiurl, apiwebresource, apiuser, apipassword):
         # validate
         if None in (apiurl, apiwebresource, apiuser,apipassword):
@@ -518,7 +1013,7 @@ class NxtCld:
         }
         try:
             # call the api to get a token
-            resp = requests.request("POST", url, headers=headers)
+            resp = self.__pronto_request("POST", url, headers=headers)
             if resp.status_code != 200:
                 applog.error('Attempt to get token resulted in a {} response'.format(resp.status_code))
                 applog.error('url was {}'.format(url))
@@ -532,16 +1027,140 @@ class NxtCld:
         except Exception as e:
             raise self.NxtCldError(str(e))
 
+    def __limited(self, endpoint, call, *args, **kwargs):
+        """ Make the call within a slot from the concurrency limiter (if there is one) """
+        try:
+            if self.__concurrency_limiter is None:
+                return call(*args, **kwargs)
+            with self.__concurrency_limiter.slot(endpoint) as slot:
+                resp = call(*args, **kwargs)
+                # nextcloud responses have is_ok, requests responses have ok
+                if not getattr(resp, 'is_ok', getattr(resp, 'ok', True)):
+                    slot.failed()
+                return resp
+        except self.UNREACHABLE as e:
+            self.__unreachable(e)
+            raise
+
+    def __pronto_request(self, method, url, **kwargs):
+        # an appserver that is down must not hold the event for ever
+        kwargs.setdefault('timeout', self.PRONTO_TIMEOUT)
+        if self.__pronto_deadline is not None:
+            remaining = self.__pronto_deadline - time.monotonic()
+            if remaining <= 0:
+                raise self.NxtCldError("No time left for the pronto request {}".format(url))
+            kwargs['timeout'] = min(kwargs['timeout'], remaining)
+        breaker = self.__circuit_breakers.get('pronto')
+        try:
+            kwargs['hooks'] = {'response': [self.__count_response]}
+            if self.__pronto_session is not None:
+                resp = self.__pronto_session.request(method, url, **kwargs)
+            else:
+                resp = requests.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            if breaker is not None:
+                breaker.failure(str(e))
+            raise
+        if breaker is not None:
+            if resp.status_code >= 500:
+                breaker.failure("{} returned {}".format(url, resp.status_code))
+            else:
+                breaker.success()
+        return resp
+
+    def __unreachable(self, e):
+        """ Report a nextcloud request that got no response (see __count_response) to the breaker """
+        if isinstance(e, self.UNREACHABLE) and 'nextcloud' in self.__circuit_breakers:
+            self.__circuit_breakers['nextcloud'].failure(str(e))
+
+    def __count_response(self, resp, *args, **kwargs):
+        """
+        requests response hook: add the request to http_usage, and report each nextcloud response to the
+        nextcloud breaker (the pronto breaker is told by __pronto_request)
+        """
+        path = urlsplit(resp.url).path
+        if '/pronto/rest/' in path:
+            endpoint = 'pronto_token' if path.endswith('/login') else 'pronto_vapiql'
+        elif resp.request.method == 'SEARCH':
+            endpoint = 'nc_search'
+        elif '/remote.php/dav/files/' in path:
+            endpoint = 'nc_propfind'
+        elif '/apps/files_sharing/api/v1/shares' in path:
+            endpoint = 'nc_create_share' if resp.request.method == 'POST' else 'nc_get_shares'
+        elif '/cloud/users/' in path:
+            endpoint = 'nc_user'
+        else:
+            endpoint = 'nc_other'
+        body = resp.request.body or b''
+        sent = len(body.encode('utf-8') if isinstance(body, str) else body)
+        with self.__http_guard:
+            usage = self.__http_usage.setdefault(endpoint, {'requests': 0, 'sent': 0, 'received': 0})
+            usage['requests'] += 1
+            usage['sent'] += sent
+            usage['received'] += len(resp.content)
+        if endpoint.startswith('nc_') and 'nextcloud' in self.__circuit_breakers:
+            if resp.status_code >= 500:
+                self.__circuit_breakers['nextcloud'].failure("{} returned {}".format(path, resp.status_code))
+            else:
+                self.__circuit_breakers['nextcloud'].success()
+
+    @__timed('fileid')
     def __set_fileid_from_path(self):
         if self.__fileid is not None:
             raise self.NxtCldError("file Id already set")
         try:
-            thisfile = self.__nxc.get_file(self.__file_path)
-            if thisfile is None:
-                applog.error(
-                    "Could not determine File id.  get_file returned None for path {}".format(self.__file_path))
-                raise self.NxtCldError(
-                    "Could not determine File id.  get_file returned None for path {}".format(self.__file_path))
+            if self.__filecache_resolver is not None:
+                fileid = self.__filecache_resolver.fileid(self.__user, self.__file_path)
+                if fileid is not None:
+                    self.__fileid = fileid
+                    return
+            if self.__lookup_cache is not None:
+                cached = self.__lookup_cache.get(('file', self.__user, self.__file_path.strip("/")))
+                if cached is not None:
+                    self.__fileid, self.__file_modified = cached
+                    return
+            if self.__folder_cache is not None:
+                fileid = self.__folder_cache.fileid(self.__nxc, self.__user, self.__file_path)
+                if fileid is not None:
+                    self.__fileid = fileid
+                    return
+            if self.__negative_cache is not None and \
+                    self.__negative_cache.lookup('path', self.__url, self.__user, self.__file_path) is not None:
+                applog.error("Could not determine File id.  Path {} recently not found".format(self.__file_path))
+                raise self.NxtCldError("Could not determine File id.  Path {} recently not found".format(
+                    self.__file_path))
+            # get_file answers None for any failure - only a 404 says the file is not there
+            resp = self.__nxc.list_folders(self.__file_path, depth=0)
+            if not resp.is_ok or not resp.data:
+                status = resp.raw.status_code
+                applog.error("Could not determine File id.  PROPFIND returned {} for path {}".format(
+                    status, self.__file_path))
+                if status == 404 and self.__negative_cache is not None:
+                    self.__negative_cache.record("not found", 'path', self.__url, self.__user, self.__file_path)
+                raise self.NxtCldError("Could not determine File id.  PROPFIND returned {} for path {}".format(
+                    status, self.__file_path))
+            thisfile = resp.data[0]
             self.__fileid = thisfile['file_id']
+            if thisfile.last_modified is not None:
+                # read with the file id, so file_modified needs no request of its own
+                self.__file_modified = int(parsedate_to_datetime(thisfile.last_modified).timestamp())
+            if self.__lookup_cache is not None:
+                self.__lookup_cache.put(('file', self.__user, self.__file_path.strip("/")),
+                                        (self.__fileid, self.__file_modified))
         except Exception as e:
+            self.__unreachable(e)
             raise self.NxtCldError("Could not determine file id: {}".format(e))
+
+    @__timed('modified')
+    def __set_modified_from_path(self):
+        if self.__file_path is None:
+            raise self.NxtCldError("No File Specified")
+        try:
+            resp = self.__nxc.list_folders(self.__file_path, depth=0, fields=['last_modified'])
+        except Exception as e:
+            self.__unreachable(e)
+            raise self.NxtCldError("Could not determine the modification time: {}".format(e))
+        if not resp.is_ok or not resp.data or resp.data[0].last_modified is None:
+            raise self.NxtCldError("Could not determine the modification time of {} ({})".format(
+                self.__file_path, resp.status_code))
+        self.__file_modified = int(parsedate_to_datetime(resp.data[0].last_modified).timestamp())
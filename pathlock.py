@@ -0,0 +1,111 @@
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+import time
+
+applog = logging.getLogger('applog')
+
+
+class PathLock:
+    '''
+    An exclusive lock on one file (owner and path) in nextcloud.
+
+    Used around the "is there a public share? - no - create one" sequence so two events for the same file
+    cannot both create a share.  The lock is a threading lock (for threads in this process) and an flock on
+    <lockdir>/paths/<hash of owner and path>.lock (for other processes).  The lock file is removed as the lock
+    is released, so a waiter that locked the removed file tries again on a new one.
+
+    Usage:
+        with PathLock('/tmp/vnextcloud', 'quicklinks', 'Documents/EQ100.pdf'):
+            # check and create the share
+    '''
+
+    class PathLockError(Exception):
+        pass
+
+    __threadlocks = {}
+    __threadlocks_guard = threading.Lock()
+
+    def __init__(self, lockdir, owner, path, timeout=120, pollinterval=0.1):
+        """
+        :param lockdir: Directory to hold the lock files
+        :param owner: The owner of the file
+        :param path: The path of the file
+        :param timeout: Seconds to wait for the lock before raising PathLockError
+        :param pollinterval: Seconds between attempts to get the file lock
+        """
+        if not isinstance(lockdir, str) or len(lockdir) == 0:
+            raise self.PathLockError('A lock directory is required')
+        self.__key = hashlib.sha1("{}\n{}".format(owner, path.strip("/")).encode('UTF-8')).hexdigest()
+        self.__lockfile = os.path.join(lockdir, 'paths', self.__key + '.lock')
+        self.__description = "{}:{}".format(owner, path)
+        self.__timeout = timeout
+        self.__pollinterval = pollinterval
+        self.__fd = None
+        self.__threadlock = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def acquire(self):
+        start = time.monotonic()
+        with PathLock.__threadlocks_guard:
+            entry = PathLock.__threadlocks.setdefault(self.__key, [threading.Lock(), 0])
+            entry[1] += 1
+        self.__threadlock = entry
+        if not entry[0].acquire(timeout=self.__timeout):
+            self.__forget_threadlock()
+            raise self.PathLockError("Timed out waiting for lock on {}".format(self.__description))
+        try:
+            os.makedirs(os.path.dirname(self.__lockfile), exist_ok=True)
+            while True:
+                fd = os.open(self.__lockfile, os.O_RDWR | os.O_CREAT, 0o666)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    # the holder before us removes the lock file as it releases it: only the file still at
+                    # the path is the lock
+                    if os.path.samestat(os.fstat(fd), os.stat(self.__lockfile)):
+                        break
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    if time.monotonic() - start > self.__timeout:
+                        os.close(fd)
+                        raise self.PathLockError("Timed out waiting for lock on {}".format(self.__description))
+                    time.sleep(self.__pollinterval)
+                os.close(fd)
+        except Exception:
+            entry[0].release()
+            self.__forget_threadlock()
+            raise
+        self.__fd = fd
+        applog.debug("Lock on {} acquired after {:.3f} seconds".format(self.__description, time.monotonic() - start))
+
+    def release(self):
+        if self.__fd is None:
+            return
+        # removed while still locked, so nobody can lock it after it has gone
+        try:
+            os.remove(self.__lockfile)
+        except FileNotFoundError:
+            pass
+        fcntl.flock(self.__fd, fcntl.LOCK_UN)
+        os.close(self.__fd)
+        self.__fd = None
+        self.__threadlock[0].release()
+        self.__forget_threadlock()
+        applog.debug("Lock on {} released".format(self.__description))
+
+    def __forget_threadlock(self):
+        # drop the threading lock once nobody is using it, so long running processes don't accumulate them.
+        with PathLock.__threadlocks_guard:
+            self.__threadlock[1] -= 1
+            if self.__threadlock[1] == 0:
+                del PathLock.__threadlocks[self.__key]
+        self.__threadlock = None
@@ -4,6 +4,9 @@
 
 SRCDIR=/root/PycharmProjects/vnextcloud
 TARFILE=/tmp/vnextcloud.tar
+BUNDLE=/tmp/vnextcloud.pyz
+# The bundle's bytecode must be compiled by the same python version that runs it at PHS
+PYTHONEXEC=${PYTHONEXEC:-/usr/local/bin/python3.10}
 
 cd $SRCDIR
 
@@ -14,4 +17,12 @@ tar -rvf $TARFILE REQUIREMENTS.txt
 tar -rvf $TARFILE README.rst
 tar -rvf $TARFILE README.pdf
 
+# The single file bundle (see bundle.py).  Pass --coldstart 5 to compare its start up time with loose files.
+$PYTHONEXEC bundle.py --output $BUNDLE --requirements REQUIREMENTS.txt "$@"
+if [ $? -ne 0 ] ; then
+	echo "Bundle not built"
+	exit 1
+fi
+tar -rvf $TARFILE -C /tmp vnextcloud.pyz
+
 echo "$TARFILE created"
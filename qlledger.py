@@ -0,0 +1,130 @@
+import contextlib
+import datetime
+import logging
+import sqlite3
+
+applog = logging.getLogger('applog')
+
+
+class QuicklinkLedger:
+    '''
+    A local record of the quicklinks that pronto has successfully registered.
+
+    Each registration is keyed by filename, owner, shareurl, publicshareid and fileid, and keeps what pronto
+    returned (company, object, keys and sequence), so an identical registration can skip the api call.  moved
+    finds a file seen before under another name (nextcloud keeps the file id), so its share can be reused.  The
+    ledger is a sqlite database shared by every process.
+
+    Usage:
+        ledger = QuicklinkLedger('/home/velocity/vnextcloud/quicklinks.db')
+        entry = ledger.lookup(filename, owner, shareurl, publicshareid, fileid)
+        if entry is None:
+            # call the api, then
+            ledger.record(filename, owner, shareurl, publicshareid, fileid, company, pobject, keys, seq)
+        previous = ledger.moved(owner, fileid, filename)
+        # remove entries so that the next call registers the file again
+        ledger.invalidate(owner='quicklinks', filename='Documents/EQ100.pdf')
+    '''
+
+    class QuicklinkLedgerError(Exception):
+        pass
+
+    def __init__(self, dbfile):
+        if not isinstance(dbfile, str) or len(dbfile) == 0:
+            raise self.QuicklinkLedgerError('Invalid ledger file')
+        self.__dbfile = dbfile
+        with self.__transaction() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS quicklinks (
+                            filename TEXT NOT NULL,
+                            owner TEXT NOT NULL,
+                            shareurl TEXT NOT NULL,
+                            publicshareid TEXT NOT NULL,
+                            fileid TEXT NOT NULL,
+                            company TEXT,
+                            object TEXT,
+                            keys TEXT,
+                            seq TEXT,
+                            registered TEXT,
+                            PRIMARY KEY (filename, owner, shareurl, publicshareid, fileid))""")
+            db.execute("CREATE INDEX IF NOT EXISTS quicklinks_fileid ON quicklinks (owner, fileid)")
+
+    @property
+    def dbfile(self):
+        return self.__dbfile
+
+    def lookup(self, filename, owner, shareurl, publicshareid, fileid):
+        """
+        Return the ledger entry for an identical registration or None if there isn't one.
+        :return: dict of the ledger entry
+        """
+        with self.__transaction() as db:
+            row = db.execute("SELECT * FROM quicklinks WHERE filename=? AND owner=? AND shareurl=? "
+                             "AND publicshareid=? AND fileid=?",
+                             self.__key(filename, owner, shareurl, publicshareid, fileid)).fetchone()
+        return dict(row) if row is not None else None
+
+    def moved(self, owner, fileid, filename):
+        """
+        The latest registration of the file under another name, if the file (by its file id) has been moved or
+        renamed since it was registered.
+        :return: dict of the ledger entry or None
+        """
+        filename, owner, _, _, fileid = self.__key(filename, owner, None, None, fileid)
+        if len(fileid) == 0:
+            return None
+        with self.__transaction() as db:
+            row = db.execute("SELECT * FROM quicklinks WHERE owner=? AND fileid=? AND filename<>? "
+                             "ORDER BY registered DESC, rowid DESC LIMIT 1", (owner, fileid, filename)).fetchone()
+        return dict(row) if row is not None else None
+
+    def record(self, filename, owner, shareurl, publicshareid, fileid, company, pobject, keys, seq):
+        """
+        Record a successful registration (replacing any identical one)
+        """
+        with self.__transaction() as db:
+            db.execute("INSERT OR REPLACE INTO quicklinks VALUES (?,?,?,?,?,?,?,?,?,?)",
+                       self.__key(filename, owner, shareurl, publicshareid, fileid) +
+                       (company, pobject, keys, seq, datetime.datetime.now().isoformat(timespec='seconds')))
+        applog.debug('Quicklink recorded in ledger {}'.format(self.__dbfile))
+
+    def invalidate(self, owner=None, filename=None, fileid=None):
+        """
+        Remove ledger entries so that they are registered with pronto again.
+        Entries matching all of the given values are removed.  At least one value must be given.
+        :return: The number of entries removed
+        """
+        where = []
+        values = []
+        for column, value in (('owner', owner), ('filename', filename), ('fileid', fileid)):
+            if value is not None:
+                where.append("{}=?".format(column))
+                values.append(str(value))
+        if len(where) == 0:
+            raise self.QuicklinkLedgerError('An owner, filename or fileid is required to invalidate entries')
+        with self.__transaction() as db:
+            count = db.execute("DELETE FROM quicklinks WHERE " + " AND ".join(where), values).rowcount
+        applog.info('{} entries removed from ledger {}'.format(count, self.__dbfile))
+        return count
+
+    # ---------------------------- Private Methods ---------------------------------------
+
+    @contextlib.contextmanager
+    def __transaction(self):
+        """ Open the ledger, commit (or roll back on error) and close it again """
+        try:
+            db = sqlite3.connect(self.__dbfile, timeout=30)
+        except sqlite3.Error as e:
+            raise self.QuicklinkLedgerError("Unable to open ledger {} ({})".format(self.__dbfile, str(e)))
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        except sqlite3.Error as e:
+            raise self.QuicklinkLedgerError("Ledger error {} ({})".format(self.__dbfile, str(e)))
+        finally:
+            db.close()
+
+    @staticmethod
+    def __key(filename, owner, shareurl, publicshareid, fileid):
+        # None and 0 are both "no value" to the pronto api.  Store them as blank so they compare equal.
+        return tuple('' if v is None or v == 0 else str(v) for v in (filename, owner, shareurl, publicshareid, fileid))
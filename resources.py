@@ -0,0 +1,104 @@
+import resource
+
+# the cpu time of the calling thread only (the service processes several events at once).  Linux only.
+RUSAGE_EVENT = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+
+
+class ResourceMeter:
+    '''
+    What one event cost: the cpu time (user and system) of the thread processing it, how much the peak memory
+    (max RSS) of the process grew while it ran, and the http requests made to nextcloud and pronto (the number
+    and bytes sent and received per endpoint, counted by NxtCld, see NxtCld.http_usage).
+
+    The cpu time does not include the sink threads (pronto, webhook...), which spend their time waiting for
+    the server.  The peak memory only grows, so a delta of 0 means the event fitted in memory the process
+    already had; a file whose delta is large is one to look at.
+
+    Usage:
+        meter = ResourceMeter()
+        # process the file
+        event['resources'] = meter.stop(thiscloud)
+    '''
+
+    def __init__(self):
+        self.__started = resource.getrusage(RUSAGE_EVENT)
+        self.__maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def stop(self, thiscloud=None):
+        """
+        :param thiscloud: The NxtCld used for the event (or None if it never connected)
+        :return: dict of cpuuser and cpusys (seconds), maxrss (kilobytes the peak grew by), requests, bytes
+                 (sent and received, all endpoints) and endpoints (dict of endpoint -> requests, sent, received)
+        """
+        ended = resource.getrusage(RUSAGE_EVENT)
+        endpoints = thiscloud.http_usage if thiscloud is not None else {}
+        return {'cpuuser': round(ended.ru_utime - self.__started.ru_utime, 3),
+                'cpusys': round(ended.ru_stime - self.__started.ru_stime, 3),
+                'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - self.__maxrss,
+                'requests': sum(e['requests'] for e in endpoints.values()),
+                'bytes': sum(e['sent'] + e['received'] for e in endpoints.values()),
+                'endpoints': endpoints}
+
+
+class ResourceTotals:
+    '''
+    The resources of many events added up (for the --batch and poll summaries): the total and the largest
+    per file of each figure, the file it was largest for, and the requests and bytes per endpoint.
+
+    Usage:
+        totals = ResourceTotals()
+        totals.add(main.result_record(owner, event, elapsed))
+        applog.info(totals.format_summary())
+    '''
+
+    FIGURES = ('cpuuser', 'cpusys', 'maxrss', 'requests', 'bytes')
+
+    def __init__(self):
+        self.__files = 0
+        self.__totals = {f: 0 for f in self.FIGURES}
+        self.__largest = {}
+        self.__endpoints = {}
+
+    def add(self, record):
+        """
+        :param record: dict (see main.result_record).  Records without resources are ignored.
+        """
+        resources = record.get('resources')
+        if not resources:
+            return
+        self.__files += 1
+        for figure in self.FIGURES:
+            value = resources[figure]
+            self.__totals[figure] += value
+            if figure not in self.__largest or value > self.__largest[figure][0]:
+                self.__largest[figure] = (value, "{} {}".format(record.get('owner'), record.get('path')))
+        for endpoint, usage in resources['endpoints'].items():
+            totals = self.__endpoints.setdefault(endpoint, {'requests': 0, 'sent': 0, 'received': 0})
+            for k in totals:
+                totals[k] += usage[k]
+
+    def summary(self):
+        """
+        :return: dict of files, totals (dict of figure -> total), largest (dict of figure -> (value, file)) and
+                 endpoints (dict of endpoint -> requests, sent, received)
+        """
+        return {'files': self.__files,
+                'totals': {k: round(v, 3) for k, v in self.__totals.items()},
+                'largest': dict(self.__largest),
+                'endpoints': {k: dict(v) for k, v in sorted(self.__endpoints.items())}}
+
+    def format_summary(self):
+        """ The summary as printable text """
+        summary = self.summary()
+        if summary['files'] == 0:
+            return "resources: no files"
+        totals = summary['totals']
+        lines = ["resources for {} files: cpu {:.3f}s user {:.3f}s system, {} requests, {} bytes".format(
+            summary['files'], totals['cpuuser'], totals['cpusys'], totals['requests'], totals['bytes'])]
+        for figure in self.FIGURES:
+            value, largest = summary['largest'][figure]
+            lines.append("    most {:<9}{:>14} {}".format(figure, round(value, 3), largest))
+        for endpoint, usage in summary['endpoints'].items():
+            lines.append("    {:<16}{:>8} requests {:>12} bytes sent {:>12} bytes received".format(
+                endpoint, usage['requests'], usage['sent'], usage['received']))
+        return "\n".join(lines)
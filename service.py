@@ -0,0 +1,572 @@
+import argparse
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import types
+from logging.handlers import RotatingFileHandler
+
+import requests
+
+import main
+import onxtcld
+from foldercache import FolderCache
+from hostlimiter import HostLimiter
+from metrics import appmetrics
+from qlledger import QuicklinkLedger
+from resources import ResourceMeter
+from slowprofile import SlowEventProfiler
+from spool import Spool
+
+applog = logging.getLogger('applog')
+
+# live: a single file event (Flow).  bulk: batches, backfills and replays.
+LANES = ('live', 'bulk')
+
+
+class Tenant:
+    '''
+    One configuration file (one nextcloud and pronto pair) inside the service.
+
+    It holds everything belonging to the configuration: the settings and passwords, filter rules, ledger,
+    caches, a pool of connected NxtCld objects per owner, the pronto session, rate and concurrency limits and
+    circuit breakers.  The tenant name is the configuration file name without .ini (e.g. bathurst).
+
+    Usage:
+        tenant = Tenant('/home/velocity/vnextcloud/bathurst.ini')
+        thiscloud = tenant.checkout('velocity')
+        # process a file
+        tenant.checkin('velocity', thiscloud)
+    '''
+
+    class TenantError(Exception):
+        pass
+
+    __local = threading.local()
+
+    def __init__(self, configfile, name=None):
+        """
+        :param configfile: The configuration file
+        :param name: The tenant name (default: the file name without .ini)
+        """
+        if not os.path.isfile(configfile):
+            raise self.TenantError("Configuration file {} not found".format(configfile))
+        self.__name = name or os.path.splitext(os.path.basename(configfile))[0]
+        self.__configfile = configfile
+        self.__settings = main.read_config(configfile)
+        main.check_settings(self.__settings)
+        self.__ledger = QuicklinkLedger(self.__settings['ledger']) if self.__settings['ledger'] is not None else None
+        self.__foldercache = FolderCache(ttl=self.__settings['lookupcachettl'])
+        self.__lookupcache = main.lookup_cache(self.__settings)
+        self.__pronto_session = requests.Session()
+        self.__limiter = main.concurrency_limiter(self.__settings)
+        self.__negative_cache = main.negative_cache(self.__settings)
+        self.__filecache_resolver = main.filecache_resolver(self.__settings)
+        self.__notifier = main.digest_notifier(self.__settings)
+        self.__breakers = main.circuit_breakers(self.__settings)
+        self.__idle = {}
+        self.__guard = threading.Lock()
+        self.__tokens = max(1.0, self.__settings['ratelimit'])
+        self.__refilled = time.monotonic()
+        self.__handler = None
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def settings(self):
+        return self.__settings
+
+    @property
+    def ledger(self):
+        return self.__ledger
+
+    @property
+    def notifier(self):
+        """ The tenant's DigestNotifier (or None) """
+        return self.__notifier
+
+    @property
+    def lookup_cache(self):
+        """ The tenant's LRUCache of nextcloud lookups (or None, see main.lookup_cache) """
+        return self.__lookupcache
+
+    @property
+    def breakers(self):
+        """ The tenant's circuit breakers (or None, see main.circuit_breakers) """
+        return self.__breakers
+
+    @classmethod
+    def current(cls):
+        """ The tenant whose event the calling thread is processing (or None) """
+        return getattr(cls.__local, 'tenant', None)
+
+    def activate(self):
+        """ Mark the calling thread as working for this tenant (so its log lines go to this tenant's applog) """
+        Tenant.__local.tenant = self
+
+    @staticmethod
+    def deactivate():
+        Tenant.__local.tenant = None
+
+    def log_handler(self):
+        """
+        A handler writing this tenant's log lines to its applog (or None if it has no applog).
+        Only lines written while a thread is working for this tenant are written.
+        """
+        if self.__handler is None and self.__settings['applog'] is not None:
+            self.__handler = RotatingFileHandler(filename=self.__settings['applog'], maxBytes=1000000, backupCount=3)
+            self.__handler.setFormatter(logging.Formatter(
+                '%(asctime)s|%(filename)s|%(funcName)s|%(levelname)s|%(message)s', '%Y-%m-%d|%H:%M:%S'))
+            self.__handler.setLevel(self.__settings['loglevel'])
+            self.__handler.addFilter(lambda record: Tenant.current() is self)
+        return self.__handler
+
+    def owns(self, filename):
+        """ True if the file is under this tenant's nextcloudroot """
+        return filename.startswith(self.__settings['nextcloudroot'].rstrip("/") + "/")
+
+    def take_token(self):
+        """
+        Take one event from the rate limit.
+        :return: True if the event may start now
+        """
+        if self.__settings['ratelimit'] <= 0:
+            return True
+        with self.__guard:
+            now = time.monotonic()
+            rate = self.__settings['ratelimit']
+            self.__tokens = min(max(1.0, rate), self.__tokens + (now - self.__refilled) * rate)
+            self.__refilled = now
+            if self.__tokens < 1.0:
+                return False
+            self.__tokens -= 1.0
+            return True
+
+    def checkout(self, owner):
+        """
+        A connected NxtCld for the owner, from the pool if one is free.  Return it with checkin when done.
+        """
+        with self.__guard:
+            idle = self.__idle.get(owner)
+            thiscloud = idle.pop() if idle else None
+        if thiscloud is None:
+            thiscloud = onxtcld.NxtCld(self.__settings['url'], owner,
+                                       main.ownerpassword(owner, self.__settings['users']), keep_alive=True,
+                                       negative_cache=self.__negative_cache, circuit_breakers=self.__breakers)
+            thiscloud.folder_cache = self.__foldercache
+            thiscloud.lookup_cache = self.__lookupcache
+            thiscloud.pronto_session = self.__pronto_session
+            thiscloud.concurrency_limiter = self.__limiter
+            thiscloud.filecache_resolver = self.__filecache_resolver
+        else:
+            thiscloud._initialise_internal_variables()
+        return thiscloud
+
+    def checkin(self, owner, thiscloud):
+        """ Return a NxtCld to the pool """
+        with self.__guard:
+            self.__idle.setdefault(owner, []).append(thiscloud)
+
+
+class Service:
+    '''
+    One long running process serving several configurations (tenants).
+
+    Events are claimed from the spool (see Spool) and routed to a tenant by their tenant name or nextcloudroot.
+    Tenants are served in turn, each with at most tenantworkers events in progress and no faster than its
+    ratelimit.  Live events go ahead of bulk ones (strictly with strictlanes, otherwise one bulk event for every
+    liveweight live events), and owners take turns within a lane.  The queue_depth and queue_wait metrics are
+    recorded, and cache stats every STATS_INTERVAL seconds.  While a tenant's breaker is open its events are
+    deferred.
+
+    Usage:
+        service = Service([Tenant('vnextcloud.ini'), Tenant('bathurst.ini')], Spool('/var/spool/vnextcloud'))
+        service.run()           # until stop() is called (e.g. SIGTERM)
+        # or
+        service.drain()         # process everything in the spool then return
+    '''
+
+    class ServiceError(Exception):
+        pass
+
+    # seconds between logging the lookup cache stats
+    STATS_INTERVAL = 60
+    # events claimed from the spool ahead of each worker.  A large backfill stays in the spool rather than in
+    # memory, and the tenants and owners take turns within the events claimed.
+    INTAKE_PER_WORKER = 250
+
+    def __init__(self, tenants, spool, workers=4, tenantworkers=2, pollinterval=1.0, results=None, liveweight=8,
+                 strictlanes=False):
+        """
+        :param tenants: list of Tenant
+        :param spool: Spool
+        :param workers: The number of events processed at once (all tenants)
+        :param tenantworkers: The number of events processed at once for any one tenant
+        :param pollinterval: Seconds between checks of the spool for new events
+        :param results: Optional file object.  A json result record (see main.result_record) is written per event.
+        :param liveweight: The live events started for each bulk event when both are waiting
+        :param strictlanes: If True bulk events only start when no live event can
+        """
+        if len(tenants) == 0:
+            raise self.ServiceError('At least one tenant is required')
+        names = [t.name for t in tenants]
+        if len(set(names)) != len(names):
+            raise self.ServiceError('Tenant names must be unique ({})'.format(", ".join(names)))
+        if workers < 1 or tenantworkers < 1:
+            raise self.ServiceError('workers and tenantworkers must be at least 1')
+        if liveweight < 1:
+            raise self.ServiceError('liveweight must be at least 1')
+        self.__tenants = tenants
+        self.__spool = spool
+        self.__workers = workers
+        self.__tenantworkers = tenantworkers
+        self.__pollinterval = pollinterval
+        self.__results = results
+        self.__resultsguard = threading.Lock()
+        self.__liveweight = liveweight
+        self.__strictlanes = strictlanes
+        self.__queues = collections.OrderedDict((t.name, _LaneQueue()) for t in tenants)
+        self.__active = {t.name: 0 for t in tenants}
+        self.__next = 0
+        self.__livestreak = 0
+        self.__changed = threading.Condition()
+        self.__stop = threading.Event()
+
+    def route(self, event):
+        """
+        The tenant for an event
+        :param event: dict from the spool
+        :return: Tenant
+        """
+        if event.get('tenant'):
+            for tenant in self.__tenants:
+                if tenant.name == event['tenant']:
+                    return tenant
+            raise self.ServiceError("Unknown tenant {}".format(event['tenant']))
+        owners = [t for t in self.__tenants if t.owns(event['file'])]
+        if len(owners) == 0:
+            raise self.ServiceError("No tenant has a nextcloudroot for {}".format(event['file']))
+        if len(owners) > 1:
+            raise self.ServiceError("More than one tenant has a nextcloudroot for {} ({}).  Use --tenant".format(
+                event['file'], ", ".join(t.name for t in owners)))
+        return owners[0]
+
+    @staticmethod
+    def lane(event):
+        """
+        The lane of an event
+        :param event: dict from the spool
+        :return: live or bulk
+        """
+        lane = event.get('lane') or 'live'
+        if lane not in LANES:
+            raise Service.ServiceError("Unknown lane {} ({})".format(lane, ", ".join(LANES)))
+        return lane
+
+    def stop(self):
+        """ Stop taking new events.  Events in progress are finished. """
+        self.__stop.set()
+        with self.__changed:
+            self.__changed.notify_all()
+
+    def run(self):
+        """ Process events until stop is called """
+        self.__spool.recover()
+        self.__loop(drain=False)
+
+    def drain(self):
+        """ Process the events in the spool (and any that arrive meanwhile) then return """
+        self.__loop(drain=True)
+
+    # ---------------------------- Private Methods ---------------------------------------
+
+    def __loop(self, drain):
+        applog.info("Service started with tenants {}".format(", ".join(t.name for t in self.__tenants)))
+        lastpoll = 0.0
+        laststats = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.__workers,
+                                                   thread_name_prefix='vnextcloud') as pool:
+            while not self.__stop.is_set():
+                if time.monotonic() - lastpoll >= self.__pollinterval or self.__queued() < self.__workers:
+                    self.__intake()
+                    lastpoll = time.monotonic()
+                if time.monotonic() - laststats >= self.STATS_INTERVAL:
+                    self.__cache_stats()
+                    laststats = time.monotonic()
+                started = self.__dispatch(pool)
+                if drain and self.__queued() == 0 and sum(self.__active.values()) == 0 \
+                        and len(self.__spool.pending()) == 0:
+                    break
+                if not started:
+                    with self.__changed:
+                        self.__changed.wait(timeout=min(self.__pollinterval, 0.1) if self.__queued() else
+                                            self.__pollinterval)
+        # anything not started goes back to the spool for next time
+        for queue in self.__queues.values():
+            for name, event in queue.clear():
+                self.__spool.release(name)
+        self.__cache_stats()
+        applog.info("Service stopped")
+
+    def __cache_stats(self):
+        for tenant in self.__tenants:
+            if tenant.lookup_cache is not None:
+                main.cache_metrics(tenant.lookup_cache, tenant=tenant.name)
+
+    def __queued(self):
+        return sum(len(q) for q in self.__queues.values())
+
+    def __intake(self):
+        room = self.__workers * self.INTAKE_PER_WORKER - self.__queued()
+        if room <= 0:
+            return
+        claimed = self.__spool.claim(room)
+        for name, event in claimed:
+            try:
+                tenant = self.route(event)
+                lane = self.lane(event)
+            except self.ServiceError as e:
+                applog.error("Event {} not routed: {}".format(name, str(e)))
+                self.__spool.failed(name, str(e))
+                continue
+            self.__queues[tenant.name].append(lane, event['owner'], (name, event))
+        if len(claimed) == 0:
+            return
+        now = time.time()
+        for tenantname, queue in self.__queues.items():
+            depths = []
+            for lane in LANES:
+                depth = queue.depth(lane)
+                appmetrics.record('queue_depth', depth, tenant=tenantname, lane=lane)
+                if depth > 0:
+                    depths.append("{}={} (oldest {:.1f}s)".format(lane, depth, now - Spool.arrived(queue.oldest(lane))))
+            if len(depths) > 0:
+                applog.info("Queued for {}: {}".format(tenantname, " ".join(depths)))
+
+    def __dispatch(self, pool):
+        """
+        Start as many events as there are free workers, live events first, taking the tenants in turn
+        :return: True if any event was started
+        """
+        started = False
+        while sum(self.__active.values()) < self.__workers:
+            for lane in self.__lane_order():
+                tenant = self.__next_tenant(lane)
+                if tenant is not None:
+                    break
+            else:
+                break
+            self.__livestreak = self.__livestreak + 1 if lane == 'live' else 0
+            name, event = self.__queues[tenant.name].popleft(lane)
+            wait = max(0.0, time.time() - Spool.arrived(name))
+            appmetrics.record('queue_wait', round(wait, 3), tenant=tenant.name, lane=lane)
+            with self.__changed:
+                self.__active[tenant.name] += 1
+            pool.submit(self.__process, tenant, name, event, lane, wait)
+            started = True
+        return started
+
+    def __lane_order(self):
+        """ The lanes in the order they are tried for the next event """
+        if not self.__strictlanes and self.__livestreak >= self.__liveweight:
+            return tuple(reversed(LANES))
+        return LANES
+
+    def __next_tenant(self, lane):
+        """
+        The next tenant (round robin) with an event queued in the lane, a free worker and room in its rate limit
+        """
+        for i in range(len(self.__tenants)):
+            tenant = self.__tenants[(self.__next + i) % len(self.__tenants)]
+            if self.__queues[tenant.name].depth(lane) == 0 or self.__active[tenant.name] >= self.__tenantworkers:
+                continue
+            if not tenant.take_token():
+                continue
+            self.__next = (self.__next + i + 1) % len(self.__tenants)
+            return tenant
+        return None
+
+    def __process(self, tenant, name, event, lane, wait):
+        tenant.activate()
+        owner = event['owner']
+        relative_path = main.event_path(owner, event['file'], tenant.settings['nextcloudroot'])
+        thisevent = {'path': relative_path, 'queue': round(wait, 3),
+                     'received': event.get('received') or Spool.arrived(name)}
+        error = None
+        meter = ResourceMeter()
+        profiler = self.__profiler(tenant)
+        profiler.start()
+        started = time.perf_counter()
+        try:
+            applog.info("Event {} tenant {} lane {} owner {} file {}".format(name, tenant.name, lane, owner,
+                                                                             relative_path))
+            rule, actions = tenant.settings['eventfilter'].evaluate(owner, relative_path)
+            args = types.SimpleNamespace(create_public_share=event.get('create_public_share', False),
+                                         public_keyword=event.get('public_keyword'),
+                                         reuse_folder_share=event.get('reuse_folder_share', False),
+                                         force=event.get('force', False))
+            blocked = main.open_breaker(tenant.breakers, actions) if 'skip' not in actions else None
+            if 'skip' in actions:
+                applog.info('{} skipped by filter rule {}'.format(relative_path, rule))
+                thisevent['status'] = 'skipped'
+            elif blocked is not None:
+                main.defer(tenant.settings, owner, event['file'], args, blocked, thisevent['received'])
+                thisevent['status'] = 'deferred'
+            else:
+                settings = tenant.settings
+                with HostLimiter(settings['lockdir'], settings['maxconcurrent'], settings['maxwait']) as limiter:
+                    thisevent['wait'] = round(limiter.wait_time, 3)
+                    thiscloud = tenant.checkout(owner)
+                    thisevent['thiscloud'] = thiscloud
+                    main.process_file(thiscloud, args, relative_path, actions, tenant.ledger, thisevent, settings,
+                                      sinkinitializer=tenant.activate)
+                # only a connection that worked (and that no abandoned sink is still using) goes back in the pool
+                if 'abandoned' not in thisevent:
+                    tenant.checkin(owner, thiscloud)
+            self.__spool.done(name)
+        except Exception as e:
+            error = str(e)
+            applog.error("Error occured: {}".format(error))
+            self.__spool.failed(name, error)
+        finally:
+            elapsed = time.perf_counter() - started
+            thisevent['resources'] = meter.stop(thisevent.get('thiscloud'))
+            # skipped, forgotten and deferred events did no work: leave them out of the log-stats timings
+            if 'thiscloud' in thisevent:
+                main.timings_to_log(thisevent, owner, elapsed)
+            profiler.stop(tags={'tenant': tenant.name, 'owner': owner, 'file': relative_path,
+                                'fileid': thisevent.get('fileid')}, timings=main.event_timings(thisevent))
+            self.__write_result(tenant, lane, main.result_record(owner, thisevent, elapsed, error))
+            Tenant.deactivate()
+            with self.__changed:
+                self.__active[tenant.name] -= 1
+                self.__changed.notify_all()
+
+    @staticmethod
+    def __profiler(tenant):
+        """ A SlowEventProfiler for one event (a profiler follows one thread, and the workers share the tenant) """
+        settings = tenant.settings
+        return SlowEventProfiler(settings['profilethreshold'], settings['profiledir'], settings['profilemaxbytes'],
+                                 settings['profilemode'])
+
+    def __write_result(self, tenant, lane, record):
+        main.notify(tenant.notifier, record)
+        if self.__results is None:
+            return
+        record['tenant'] = tenant.name
+        record['lane'] = lane
+        with self.__resultsguard:
+            self.__results.write(json.dumps(record) + "\n")
+            self.__results.flush()
+
+
+class _LaneQueue:
+    """ The events waiting for one tenant: a queue per lane, each taking its owners in turn (see Service) """
+
+    def __init__(self):
+        self.__lanes = {lane: collections.OrderedDict() for lane in LANES}
+
+    def append(self, lane, owner, item):
+        self.__lanes[lane].setdefault(owner, collections.deque()).append(item)
+
+    def popleft(self, lane):
+        """ The first event of the next owner in the lane.  The owner then goes to the back. """
+        owners = self.__lanes[lane]
+        owner, items = next(iter(owners.items()))
+        item = items.popleft()
+        del owners[owner]
+        if items:
+            owners[owner] = items
+        return item
+
+    def depth(self, lane):
+        return sum(len(items) for items in self.__lanes[lane].values())
+
+    def oldest(self, lane):
+        """ The name of the oldest event in the lane """
+        return min(items[0][0] for items in self.__lanes[lane].values())
+
+    def clear(self):
+        """ Remove every event.  :return: list of the events removed """
+        items = [item for lane in LANES for owner in self.__lanes[lane].values() for item in owner]
+        for lane in LANES:
+            self.__lanes[lane].clear()
+        return items
+
+    def __len__(self):
+        return sum(self.depth(lane) for lane in LANES)
+
+
+def process_arguments():
+    parser = argparse.ArgumentParser(description="Process vnextcloud file events for several configurations")
+    parser.add_argument('--configfile', action='append', required=True,
+                        help="Configuration file for a tenant (repeat for each tenant)")
+    parser.add_argument('--spooldir', action='store', required=True,
+                        help="The spool directory (see main.py enqueue)")
+    parser.add_argument('--workers', action='store', type=int, required=False, default=4,
+                        help="Events processed at once across all tenants (default 4)")
+    parser.add_argument('--tenantworkers', action='store', type=int, required=False, default=2,
+                        help="Events processed at once for any one tenant (default 2)")
+    parser.add_argument('--pollinterval', action='store', type=float, required=False, default=1.0,
+                        help="Seconds between checks of the spool (default 1)")
+    parser.add_argument('--results', action='store', required=False,
+                        help="File to append a json result record to for each event")
+    parser.add_argument('--liveweight', action='store', type=int, required=False, default=8,
+                        help="Live events started for each bulk event when both are waiting (default 8)")
+    parser.add_argument('--strict-lanes', action='store_true', required=False,
+                        help="Only start bulk events when no live event can be started")
+    parser.add_argument('--logfile', action='store', required=False,
+                        help="Service log (default stderr).  Each tenant also logs to its own applog.")
+    parser.add_argument('--loglevel', action='store', required=False, default='INFO',
+                        help="Service log level (default INFO)")
+    parser.add_argument('--metricslog', action='store', required=False,
+                        help="Metrics file")
+    parser.add_argument('--once', action='store_true', required=False,
+                        help="Process the events in the spool then exit")
+    return parser.parse_args()
+
+
+def establish_logging(args, tenants):
+    if args.logfile is None:
+        loghandler = logging.StreamHandler()
+    else:
+        loghandler = RotatingFileHandler(filename=args.logfile, maxBytes=1000000, backupCount=3)
+    loghandler.setFormatter(logging.Formatter('%(asctime)s|%(threadName)s|%(filename)s|%(funcName)s|'
+                                              '%(levelname)s|%(message)s', '%Y-%m-%d|%H:%M:%S'))
+    loghandler.setLevel(args.loglevel.upper())
+    applog.addHandler(loghandler)
+    levels = [loghandler.level]
+    for tenant in tenants:
+        handler = tenant.log_handler()
+        if handler is not None:
+            applog.addHandler(handler)
+            levels.append(handler.level)
+    applog.setLevel(min(levels))
+
+
+if __name__ == '__main__':
+    try:
+        pgm_args = process_arguments()
+        thesetenants = [Tenant(c) for c in pgm_args.configfile]
+        establish_logging(pgm_args, thesetenants)
+        appmetrics.metrics_file = pgm_args.metricslog
+        resultsfile = open(pgm_args.results, 'a') if pgm_args.results is not None else None
+        service = Service(thesetenants, Spool(pgm_args.spooldir), pgm_args.workers, pgm_args.tenantworkers,
+                          pgm_args.pollinterval, resultsfile, pgm_args.liveweight, pgm_args.strict_lanes)
+        signal.signal(signal.SIGTERM, lambda signum, frame: service.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: service.stop())
+        if pgm_args.once:
+            service.drain()
+        else:
+            service.run()
+    except Exception as e:
+        applog.error("Error occured: {}".format(str(e)))
+        print(str(e))
+        sys.exit(1)
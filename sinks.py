@@ -0,0 +1,226 @@
+import concurrent.futures
+import json
+import logging
+import os
+import time
+
+import requests
+
+from onxtcld import NxtCld
+
+applog = logging.getLogger('applog')
+
+
+class Sink:
+    '''
+    Somewhere the result of a file is sent once its share is known (the datalog, pronto, a webhook...).
+
+    Each sink has a name, a timeout in seconds and whether it is required (a required sink that fails fails
+    the file).  Subclasses implement send.
+    '''
+
+    class SinkError(Exception):
+        pass
+
+    name = 'sink'
+
+    def __init__(self, timeout=10, required=True):
+        """
+        :param timeout: Seconds the sink is given before it is abandoned
+        :param required: If True a failure of this sink fails the file
+        """
+        if timeout <= 0:
+            raise self.SinkError('The timeout of sink {} must be more than 0'.format(self.name))
+        self.timeout = timeout
+        self.required = required
+
+    def send(self, thiscloud, event):
+        """
+        Send the result of the file
+        :param thiscloud: NxtCld with the file path set and the shares processed
+        :param event: The event dict (see main.process_file)
+        """
+        raise NotImplementedError
+
+
+class DatalogSink(Sink):
+    ''' One line per file in the pipe delimited datalog '''
+
+    name = 'datalog'
+
+    def __init__(self, datalog, rows=None, timeout=10, required=True):
+        """
+        :param datalog: The datalog file
+        :param rows: Optional list.  The row is added to it instead of being written (see main.process_file).
+        """
+        super().__init__(timeout, required)
+        self.datalog = datalog
+        self.rows = rows
+
+    def send(self, thiscloud, event):
+        applog.debug('Adding file to data log.')
+        record = thiscloud.datalog_record()
+        if self.rows is not None:
+            self.rows.append(record)
+        else:
+            NxtCld.append_to_csv_file(self.datalog, [record])
+
+
+class ProntoSink(Sink):
+    ''' The pronto quicklink api (see NxtCld.add_pronto_quicklink) '''
+
+    name = 'pronto'
+
+    def __init__(self, apiurl, apiwebresource, apiuser, apipassword, force=False, timeout=60, required=True):
+        super().__init__(timeout, required)
+        self.apiurl = apiurl
+        self.apiwebresource = apiwebresource
+        self.apiuser = apiuser
+        self.apipassword = apipassword
+        self.force = force
+
+    def send(self, thiscloud, event):
+        # the requests share the sink's timeout (less a little), so they give up before the sink is abandoned
+        thiscloud.add_pronto_quicklink(self.apiurl, self.apiwebresource, self.apiuser, self.apipassword,
+                                       force=self.force, timeout=self.timeout - min(1.0, self.timeout / 10))
+        event['pronto'] = thiscloud.pronto_result
+        # when the quicklink appeared in pronto (see main.quicklink_lag)
+        event['registered'] = time.time()
+
+
+class WebhookSink(Sink):
+    ''' A json POST of the file's details to any url '''
+
+    name = 'webhook'
+
+    def __init__(self, url, session=None, timeout=10, required=False):
+        """
+        :param url: The url posted to
+        :param session: Optional requests.Session (so the connection is reused)
+        """
+        super().__init__(timeout, required)
+        self.url = url
+        self.session = session
+
+    def send(self, thiscloud, event):
+        resp = (self.session or requests).post(self.url, json=file_details(thiscloud), timeout=self.timeout)
+        if resp.status_code >= 300:
+            raise self.SinkError("Webhook {} failed ({} - {})".format(self.url, resp.status_code, resp.text[:200]))
+
+
+class JsonlSink(Sink):
+    ''' One json line per file in a local file '''
+
+    name = 'jsonl'
+
+    def __init__(self, filename, timeout=10, required=False):
+        super().__init__(timeout, required)
+        self.filename = filename
+
+    def send(self, thiscloud, event):
+        line = json.dumps(file_details(thiscloud)) + "\n"
+        # a single write to a file opened for append, so lines from other processes are never mixed in
+        fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('UTF-8'))
+        finally:
+            os.close(fd)
+
+
+def file_details(thiscloud):
+    """ The details of the file sent to the webhook and jsonl sinks """
+    return {'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'owner': thiscloud.user,
+            'path': thiscloud.file_path,
+            'fileid': thiscloud.file_id,
+            'shareurl': thiscloud.share_url,
+            'shareid': thiscloud.public_share_id,
+            'sharecreated': thiscloud.public_share_created}
+
+
+class SinkRunner:
+    '''
+    Send the result of a file to all its sinks at once.
+
+    The sinks run side by side, so one failing does not stop the others.  A sink still running after its
+    timeout is abandoned, counted as failed and named in event['abandoned']; it is still using the NxtCld, so
+    the caller must not reuse it.  The failures of the required sinks are raised together as one
+    SinkRunnerError.  Each sink's time is added to event['sinktimings'].  initializer is run first in each
+    sink's thread.
+
+    Usage:
+        runner = SinkRunner([DatalogSink('/home/velocity/vnextcloud/datalog.txt'),
+                             ProntoSink(url, webresource, user, password)])
+        runner.run(thiscloud, event)
+    '''
+
+    class SinkRunnerError(Exception):
+        pass
+
+    def __init__(self, sinks, initializer=None):
+        """
+        :param sinks: list of Sink
+        :param initializer: Optional callable run first in each sink's thread
+        """
+        self.__sinks = sinks
+        self.__initializer = initializer
+
+    @property
+    def sinks(self):
+        return self.__sinks
+
+    def run(self, thiscloud, event):
+        """
+        :param thiscloud: NxtCld with the file path set and the shares processed
+        :param event: The event dict (see main.process_file)
+        """
+        timings = event.setdefault('sinktimings', {})
+        if len(self.__sinks) == 0:
+            return
+        if len(self.__sinks) == 1:
+            # nothing to run alongside
+            self.__finish(self.__sinks, {self.__sinks[0]: self.__send(self.__sinks[0], thiscloud, event)}, timings)
+            return
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.__sinks), thread_name_prefix='sink',
+                                                     initializer=self.__initializer)
+        try:
+            futures = {sink: pool.submit(self.__send, sink, thiscloud, event) for sink in self.__sinks}
+            started = time.monotonic()
+            outcomes = {}
+            for sink, future in futures.items():
+                try:
+                    outcomes[sink] = future.result(timeout=max(0.0, sink.timeout - (time.monotonic() - started)))
+                except concurrent.futures.TimeoutError:
+                    outcomes[sink] = (sink.timeout, "timed out after {} seconds".format(sink.timeout))
+                    event.setdefault('abandoned', []).append(sink.name)
+        finally:
+            # a sink that timed out is not waited for
+            pool.shutdown(wait=False)
+        self.__finish(self.__sinks, outcomes, timings)
+
+    # ---------------------------- Private Methods ---------------------------------------
+
+    @staticmethod
+    def __send(sink, thiscloud, event):
+        """ :return: (seconds, error message or None) """
+        started = time.perf_counter()
+        try:
+            sink.send(thiscloud, event)
+            return time.perf_counter() - started, None
+        except Exception as e:
+            return time.perf_counter() - started, str(e)
+
+    def __finish(self, sinks, outcomes, timings):
+        errors = []
+        for sink in sinks:
+            seconds, error = outcomes[sink]
+            timings[sink.name] = round(seconds, 3)
+            if error is None:
+                continue
+            if sink.required:
+                applog.error("Sink {} failed: {}".format(sink.name, error))
+                errors.append("{}: {}".format(sink.name, error))
+            else:
+                applog.warning("Sink {} failed (not required): {}".format(sink.name, error))
+        if len(errors) > 0:
+            raise self.SinkRunnerError("; ".join(errors))
@@ -0,0 +1,163 @@
+import cProfile
+import datetime
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+
+from metrics import appmetrics
+
+applog = logging.getLogger('applog')
+
+
+class SlowEventProfiler:
+    '''
+    Capture a profile of any event that takes longer than a threshold (0, the default, switches it off).
+
+    Every event is profiled and the profile kept only if the event was slow:
+        cprofile  cProfile for the whole event: a .prof file plus a .txt of the tags, the stage timings and the
+                  top functions by cumulative time.
+        sample    The event's stack is sampled every sampleinterval seconds: a .txt of the tags, the stage
+                  timings and the stacks in the "folded" flamegraph format.  Much cheaper than cprofile.
+
+    Dumps are named slow_<date>_<time>_<pid>_<thread>.* and the oldest are removed to keep them under maxbytes.
+
+    Usage:
+        profiler = SlowEventProfiler(30, '/var/log/vnextcloud/profiles')
+        profiler.start()
+        # process the event
+        profiler.stop(tags={'owner': owner, 'file': path, 'fileid': fileid}, timings=thiscloud.timings)
+    '''
+
+    class SlowEventProfilerError(Exception):
+        pass
+
+    MODES = ('cprofile', 'sample')
+
+    def __init__(self, threshold=0, dumpdir=None, maxbytes=10000000, mode='cprofile', sampleinterval=0.01):
+        """
+        :param threshold: Seconds.  Events that take longer than this are dumped.  0 switches profiling off.
+        :param dumpdir: The directory for the dump files.  Required if threshold is not 0.
+        :param maxbytes: The maximum total size of the dump files
+        :param mode: cprofile or sample
+        :param sampleinterval: Seconds between stack samples (sample mode only)
+        """
+        if threshold is None or threshold < 0:
+            raise self.SlowEventProfilerError('The profile threshold must be 0 or more')
+        if mode not in self.MODES:
+            raise self.SlowEventProfilerError('Invalid profile mode {} (must be one of {})'.format(
+                mode, ", ".join(self.MODES)))
+        if threshold > 0 and (not isinstance(dumpdir, str) or len(dumpdir) == 0):
+            raise self.SlowEventProfilerError('A directory for the profile dumps is required')
+        self.__threshold = threshold
+        self.__dumpdir = dumpdir
+        self.__maxbytes = maxbytes
+        self.__mode = mode
+        self.__sampleinterval = sampleinterval
+        self.__started = None
+        self.__profile = None
+        self.__sampler = None
+        self.__samples = None
+        self.__stopsampling = None
+
+    @property
+    def enabled(self):
+        return self.__threshold > 0
+
+    def start(self):
+        """ Start timing (and if enabled, profiling) the current thread """
+        self.__started = time.perf_counter()
+        if not self.enabled:
+            return
+        if self.__mode == 'cprofile':
+            self.__profile = cProfile.Profile()
+            self.__profile.enable()
+        else:
+            self.__samples = {}
+            self.__stopsampling = threading.Event()
+            self.__sampler = threading.Thread(target=self.__sample, args=(threading.get_ident(),),
+                                              name='profilesampler', daemon=True)
+            self.__sampler.start()
+
+    def stop(self, tags=None, timings=None):
+        """
+        Stop profiling.  If the event took longer than the threshold write the dump.
+        :param tags: dict identifying the event (e.g. owner, file, fileid)
+        :param timings: dict of stage timings
+        :return: The name of the dump file written or None
+        """
+        if self.__started is None:
+            return None
+        elapsed = time.perf_counter() - self.__started
+        self.__started = None
+        if not self.enabled:
+            return None
+        if self.__profile is not None:
+            self.__profile.disable()
+        if self.__sampler is not None:
+            self.__stopsampling.set()
+            self.__sampler.join()
+        dumpfile = None
+        try:
+            if elapsed > self.__threshold:
+                dumpfile = self.__dump(elapsed, tags or {}, timings or {})
+        except OSError as e:
+            # a failed dump must never fail the event.
+            applog.warning("Unable to write profile dump ({})".format(str(e)))
+        self.__profile = None
+        self.__sampler = None
+        self.__samples = None
+        return dumpfile
+
+    # ---------------------------- Private Methods ---------------------------------------
+
+    def __sample(self, thread_id):
+        while not self.__stopsampling.wait(self.__sampleinterval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            stack = ";".join(["{}:{}".format(os.path.basename(f.filename), f.name)
+                              for f in traceback.extract_stack(frame)])
+            self.__samples[stack] = self.__samples.get(stack, 0) + 1
+
+    def __dump(self, elapsed, tags, timings):
+        os.makedirs(self.__dumpdir, exist_ok=True)
+        basename = os.path.join(self.__dumpdir, "slow_{}_{}_{}".format(
+            datetime.datetime.now().strftime("%Y%m%d_%H%M%S"), os.getpid(), threading.get_ident()))
+        with open(basename + '.txt', 'w') as f:
+            f.write("Elapsed: {:.3f} seconds (threshold {})\n".format(elapsed, self.__threshold))
+            for k in sorted(tags):
+                f.write("{}: {}\n".format(k, tags[k]))
+            f.write("Timings: {}\n\n".format(" ".join(["{}={}".format(k, v) for k, v in timings.items()])))
+            if self.__profile is not None:
+                self.__profile.dump_stats(basename + '.prof')
+                text = io.StringIO()
+                pstats.Stats(self.__profile, stream=text).sort_stats('cumulative').print_stats(40)
+                f.write(text.getvalue())
+            else:
+                for stack, count in sorted(self.__samples.items(), key=lambda i: -i[1]):
+                    f.write("{} {}\n".format(stack, count))
+        applog.warning("Slow event ({:.3f} seconds) profile written to {}.txt".format(elapsed, basename))
+        appmetrics.record('slow_event', round(elapsed, 3), **tags)
+        self.__rotate()
+        return basename + '.txt'
+
+    def __rotate(self):
+        dumps = []
+        for name in os.listdir(self.__dumpdir):
+            if name.startswith('slow_'):
+                st = os.stat(os.path.join(self.__dumpdir, name))
+                dumps.append((st.st_mtime, name, st.st_size))
+        total = sum(d[2] for d in dumps)
+        for mtime, name, size in sorted(dumps):
+            if total <= self.__maxbytes:
+                break
+            try:
+                os.remove(os.path.join(self.__dumpdir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,230 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+applog = logging.getLogger('applog')
+
+
+class Spool:
+    '''
+    A directory of file events waiting for the service.
+
+    Each event is a small json file named <time>.<pid>.json (<time>.<pid>.bulk.json for lane bulk), written to a
+    temporary name and renamed.  The service claims events by moving them into its own work folder (work/<pid>,
+    flock'd while the process runs), removes them when done and moves failures to the failed folder with a
+    .error file.  Bulk events are claimed after the others.  recover only puts back the events of processes that
+    have stopped.
+
+    Usage:
+        spool = Spool('/var/spool/vnextcloud')
+        spool.enqueue({'owner': 'quicklinks', 'file': '/var/www/html/nextcloud/data/quicklinks/files/EQ100.pdf'})
+        for name, event in spool.claim():
+            # process the event then
+            spool.done(name)
+    '''
+
+    class SpoolError(Exception):
+        pass
+
+    # work folder -> (pid, open lock file) of the work folders held by this process
+    __held = {}
+    __heldguard = threading.Lock()
+
+    def __init__(self, spooldir):
+        if not isinstance(spooldir, str) or len(spooldir) == 0:
+            raise self.SpoolError('A spool directory is required')
+        self.__spooldir = spooldir
+        self.__workroot = os.path.realpath(os.path.join(spooldir, 'work'))
+        self.__faileddir = os.path.join(spooldir, 'failed')
+        for d in (self.__spooldir, self.__workroot, self.__faileddir):
+            os.makedirs(d, exist_ok=True)
+
+    @property
+    def spooldir(self):
+        return self.__spooldir
+
+    def enqueue(self, event):
+        """
+        Add an event to the spool.
+        :param event: dict (must contain owner and file)
+        :return: The name of the event file
+        """
+        if not event.get('owner') or not event.get('file'):
+            raise self.SpoolError('An event must have an owner and a file')
+        name = "{:020d}.{}{}.json".format(time.time_ns(), os.getpid(), '.bulk' if event.get('lane') == 'bulk' else '')
+        tmpname = os.path.join(self.__spooldir, '.' + name + '.tmp')
+        with open(tmpname, 'w') as f:
+            json.dump(event, f)
+        os.replace(tmpname, os.path.join(self.__spooldir, name))
+        applog.debug("Event {} added to spool {}".format(name, self.__spooldir))
+        return name
+
+    @staticmethod
+    def arrived(name):
+        """ The time (seconds since the epoch) an event arrived in the spool, from its name """
+        try:
+            return int(name.split('.')[0]) / 1e9
+        except ValueError:
+            return time.time()
+
+    def pending(self):
+        """ The names of the events waiting in the spool, oldest first """
+        return sorted(n for n in os.listdir(self.__spooldir) if n.endswith('.json') and not n.startswith('.'))
+
+    def claim(self, limit=None):
+        """
+        Claim the waiting events (oldest first, bulk events after the others).  Events that cannot be read are
+        moved to the failed folder.
+        :param limit: The maximum number of events to claim
+        :return: list of (name, event dict)
+        """
+        claimed = []
+        for name in sorted(self.pending(), key=lambda n: n.endswith('.bulk.json')):
+            if limit is not None and len(claimed) >= limit:
+                break
+            try:
+                os.rename(os.path.join(self.__spooldir, name), os.path.join(self.__workdir, name))
+            except FileNotFoundError:
+                # another service claimed it first
+                continue
+            try:
+                with open(os.path.join(self.__workdir, name), 'r') as f:
+                    claimed.append((name, json.load(f)))
+            except (OSError, ValueError) as e:
+                self.failed(name, "Unreadable event ({})".format(str(e)))
+        return claimed
+
+    def done(self, name):
+        """ Remove a claimed event once it has been processed """
+        try:
+            os.remove(os.path.join(self.__workdir, name))
+        except FileNotFoundError:
+            pass
+
+    def failed(self, name, error):
+        """ Move a claimed event to the failed folder with the reason """
+        try:
+            os.replace(os.path.join(self.__workdir, name), os.path.join(self.__faileddir, name))
+            with open(os.path.join(self.__faileddir, name[:-len('.json')] + '.error'), 'w') as f:
+                f.write(str(error) + "\n")
+        except OSError as e:
+            applog.error("Unable to move event {} to the failed folder ({})".format(name, str(e)))
+
+    def release(self, name):
+        """ Put a claimed event back in the spool (e.g. when the service stops before processing it) """
+        try:
+            os.replace(os.path.join(self.__workdir, name), os.path.join(self.__spooldir, name))
+        except FileNotFoundError:
+            pass
+
+    def recover(self):
+        """
+        Put back any events left in the work folders of services (or replays) that stopped without finishing
+        them.  The events of a process that is still running are left alone.
+        :return: The number of events put back
+        """
+        recovered = 0
+        # one recovery at a time
+        with open(os.path.join(self.__workroot, '.recover.lock'), 'a') as guard:
+            fcntl.flock(guard, fcntl.LOCK_EX)
+            for entry in sorted(os.listdir(self.__workroot)):
+                workdir = os.path.join(self.__workroot, entry)
+                if entry.startswith('.'):
+                    # .recover.lock, or a work folder being set up (see __workdir)
+                    if entry.endswith('.tmp'):
+                        self.__remove_abandoned(workdir)
+                    continue
+                if entry.endswith('.json'):
+                    # left by a version without a work folder per process
+                    os.replace(workdir, os.path.join(self.__spooldir, entry))
+                    recovered += 1
+                    continue
+                if not os.path.isdir(workdir) or workdir == self.__held_workdir():
+                    continue
+                with open(os.path.join(workdir, '.lock'), 'a') as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        # its process is still running
+                        continue
+                    recovered += self.__empty(workdir)
+        if recovered > 0:
+            applog.warning("{} unfinished events returned to spool {}".format(recovered, self.__spooldir))
+        return recovered
+
+    # ---------------------------- Private Methods ---------------------------------------
+
+    @property
+    def __workdir(self):
+        """
+        This process's work folder, created and locked the first time it is used.  It is set up under a
+        temporary name and renamed into place once locked, so recover never finds it unlocked.
+        """
+        workdir = os.path.join(self.__workroot, str(os.getpid()))
+        with Spool.__heldguard:
+            held = Spool.__held.get(workdir)
+            if held is None or held[0] != os.getpid():
+                tmpdir = os.path.join(self.__workroot, '.{}.tmp'.format(os.getpid()))
+                os.makedirs(tmpdir, exist_ok=True)
+                lock = open(os.path.join(tmpdir, '.lock'), 'a')
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    os.rename(tmpdir, workdir)
+                except OSError:
+                    # left by a stopped process that had the same pid
+                    with open(os.path.join(self.__workroot, '.recover.lock'), 'a') as guard:
+                        fcntl.flock(guard, fcntl.LOCK_EX)
+                        if os.path.isdir(workdir):
+                            self.__empty(workdir)
+                    os.rename(tmpdir, workdir)
+                Spool.__held[workdir] = (os.getpid(), lock)
+        return workdir
+
+    def __empty(self, workdir):
+        """ Put the events of a stopped process's work folder back in the spool and remove the folder """
+        recovered = 0
+        for name in [n for n in os.listdir(workdir) if n.endswith('.json')]:
+            try:
+                os.replace(os.path.join(workdir, name), os.path.join(self.__spooldir, name))
+                recovered += 1
+            except FileNotFoundError:
+                pass
+        try:
+            os.remove(os.path.join(workdir, '.lock'))
+            os.rmdir(workdir)
+        except OSError as e:
+            applog.warning("Unable to remove work folder {} ({})".format(workdir, str(e)))
+        return recovered
+
+    @staticmethod
+    def __remove_abandoned(tmpdir):
+        """
+        Remove a work folder whose process stopped while setting it up (it never holds events).  Its lock may not
+        be taken yet, so the process (.<pid>.tmp) is checked instead.
+        """
+        try:
+            os.kill(int(os.path.basename(tmpdir).split('.')[1]), 0)
+            return
+        except (ValueError, IndexError, ProcessLookupError):
+            pass
+        except PermissionError:
+            # running as another user
+            return
+        try:
+            os.remove(os.path.join(tmpdir, '.lock'))
+        except FileNotFoundError:
+            pass
+        try:
+            os.rmdir(tmpdir)
+        except OSError as e:
+            applog.warning("Unable to remove work folder {} ({})".format(tmpdir, str(e)))
+
+    def __held_workdir(self):
+        """ This process's work folder if it holds one, otherwise None """
+        workdir = os.path.join(self.__workroot, str(os.getpid()))
+        with Spool.__heldguard:
+            held = Spool.__held.get(workdir)
+        return workdir if held is not None and held[0] == os.getpid() else None
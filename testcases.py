@@ -1,9 +1,13 @@
+import argparse
 import base64
 import unittest
+import unittest.mock
 import xml.etree.ElementTree as ET
 from pprint import pprint
 import logging
+import multiprocessing
 import configparser
+import fcntl
 import os
 from logging.handlers import RotatingFileHandler
 import inspect
@@ -14,6 +18,38 @@ import main
 from onxtcld import NxtCld
 
 from prontoencryption import ProntoEncryption
+from hostlimiter import HostLimiter
+from metrics import Metrics, appmetrics
+from eventfilter import EventFilter
+from qlledger import QuicklinkLedger
+from pathlock import PathLock
+from slowprofile import SlowEventProfiler
+from loadgen import LoadGenerator, StandInServer
+from logstats import LogStats
+from foldercache import FolderCache
+from adaptive import AdaptiveLimiter
+from negcache import NegativeCache
+from filecache import FileCacheResolver
+from spool import Spool
+from sinks import Sink, SinkRunner
+from digest import DigestNotifier
+from breaker import CircuitBreaker
+from lrucache import LRUCache
+from resources import ResourceMeter, ResourceTotals
+from bundle import BundleBuilder
+from service import Service, Tenant
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import tempfile
+import zipfile
 
 
 from nextcloud import NextCloud
@@ -72,6 +108,9 @@ class RegressionSet(unittest.TestCase):
             '/Documents/PythonAppTestCases/CompleteCrap.pdf'
         cls.FOLDER_DOES_NOT_EXIST = \
             '/Documents/CompleteCrap/No Shares.pdf'
+        # The folder "Shared Folder" must have a public share.  The file must not have a share of its own.
+        cls.FILE_IN_PUBLIC_FOLDER = \
+            '/Documents/PythonAppTestCases/Shared Folder/Sub/In Shared Folder.pdf'
 
     def setUp(self) -> None:
         self.NXC._initialise_internal_variables()
@@ -169,6 +208,17 @@ class RegressionSet(unittest.TestCase):
         self.NXC.file_path = self.FILE_WITH_NO_PUBLIC_SHARE
         self.assertNotEqual(self.NXC.public_share_id, 0, "Public share not created")
 
+    def test013(self):
+        """Test reusing the public share of a folder above the file"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__,inspect.stack()[0][3]))
+        print("test013 File: {}".format(self.FILE_IN_PUBLIC_FOLDER))
+        self.NXC.optionally_create_public_share = True
+        self.NXC.reuse_folder_share = True
+        self.NXC.file_path = self.FILE_IN_PUBLIC_FOLDER
+        self.assertRegex(self.NXC.share_url,
+                         r"https://nextcloud189.velocityglobal.co.nz/index.php/s/\w+/download\?path=%2FSub&files=",
+                         "Url not derived from folder share")
+
     def test020(self):
         """Test calling pronto API - create public share via Flag"""
         # Test cases for the api require the automatic quicklinks shares to have the following parameters:
@@ -289,6 +339,1547 @@ class temptests(unittest.TestCase):
         self.assertEqual(clear_text, "Grate4848Piezzo##", "Decryption Failed.")
 
 
+class LimiterSet(unittest.TestCase):
+    """
+    Tests for the host wide concurrency limiter and the metrics file.  These need no servers.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test001(self):
+        """ Test a second process waits and then times out when the only slot is taken"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        with HostLimiter(self.tmpdir.name, 1, 5) as first:
+            self.assertEqual(first.slot, 0, "First limiter did not get slot 0")
+            second = HostLimiter(self.tmpdir.name, 1, 0.5, pollinterval=0.05)
+            with self.assertRaises(HostLimiter.HostLimiterError):
+                second.acquire()
+            self.assertGreaterEqual(second.wait_time, 0.5, "Did not wait for maxwait")
+        # the slot is free again
+        with HostLimiter(self.tmpdir.name, 1, 0.5) as third:
+            self.assertEqual(third.slot, 0, "Slot not released")
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir.name, 'queue')), [], "Queue ticket left behind")
+
+    def test002(self):
+        """ Test a disabled limiter never waits"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        with HostLimiter(None, 0) as limiter:
+            self.assertIsNone(limiter.slot, "Disabled limiter took a slot")
+            self.assertEqual(limiter.wait_time, 0.0, "Disabled limiter waited")
+
+    def test003(self):
+        """ Test metrics are written to and read from the metrics file"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        metricsfile = os.path.join(self.tmpdir.name, 'metrics.log')
+        m = Metrics(metricsfile)
+        m.record('limiter_wait', 1.5, slot=2)
+        records = list(Metrics.read(metricsfile))
+        self.assertEqual(len(records), 1, "Metric not written")
+        self.assertEqual(records[0]['metric'], 'limiter_wait', "Incorrect metric name")
+        self.assertEqual(records[0]['value'], 1.5, "Incorrect metric value")
+        self.assertEqual(records[0]['tags'], {'slot': '2'}, "Incorrect metric tags")
+
+    def test004(self):
+        """ Test nearest rank percentiles"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        values = list(range(1, 11))
+        self.assertEqual([Metrics.percentile(values, p) for p in (50, 90, 95, 99, 100)], [5, 9, 10, 10, 10])
+        values = list(range(1, 101))
+        self.assertEqual([Metrics.percentile(values, p) for p in (1, 7, 50, 95, 99)], [1, 7, 50, 95, 99])
+        self.assertEqual(Metrics.percentile([4.5], 50), 4.5)
+        self.assertIsNone(Metrics.percentile([], 50))
+
+
+class FilterSet(unittest.TestCase):
+    """
+    Tests for the filter rules that are checked before any network call.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        config = configparser.ConfigParser()
+        config.read_string("""
+[FILTER]
+ignoresuffixes = .part, ~
+ignoreprefixes = ~$
+allowextensions = pdf, jpg, png
+
+[RULE no drafts]
+folder = Documents/Drafts*
+action = skip
+
+[RULE stock images]
+owner = quicklinks
+folder = re:Documents/Stock/[0-9]+
+extensions = jpg, png
+action = publicshare, skippronto
+
+[RULE private]
+owner = rayb
+action = privateonly
+""")
+        cls.FILTER = EventFilter.from_config(config)
+
+    def test001(self):
+        """ Test temp, partial and hidden files are skipped"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        self.assertEqual(self.FILTER.evaluate('quicklinks', 'Documents/EQ100.pdf.part'),
+                         ('ignoresuffixes', frozenset(['skip'])))
+        self.assertEqual(self.FILTER.evaluate('quicklinks', 'Documents/~$EQ100.pdf'),
+                         ('ignoreprefixes', frozenset(['skip'])))
+        self.assertEqual(self.FILTER.evaluate('quicklinks', 'Documents/.hidden/EQ100.pdf'),
+                         ('ignorehidden', frozenset(['skip'])))
+        self.assertEqual(self.FILTER.evaluate('quicklinks', 'Documents/EQ100.exe'),
+                         ('allowextensions', frozenset(['skip'])))
+
+    def test002(self):
+        """ Test the first matching rule wins"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        self.assertEqual(self.FILTER.evaluate('rayb', 'Documents/Drafts/2024/EQ100.pdf'),
+                         ('no drafts', frozenset(['skip'])))
+        self.assertEqual(self.FILTER.evaluate('quicklinks', 'Documents/Stock/100/EQ100.JPG'),
+                         ('stock images', frozenset(['publicshare', 'skippronto'])))
+        self.assertEqual(self.FILTER.evaluate('rayb', 'Documents/Stock/100/EQ100.jpg'),
+                         ('private', frozenset(['privateonly'])))
+        self.assertEqual(self.FILTER.evaluate('quicklinks', 'Documents/Stock/abc/EQ100.jpg'),
+                         ('default', frozenset(['process'])))
+
+    def test003(self):
+        """ Test invalid actions and patterns are rejected"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        thisfilter = EventFilter()
+        with self.assertRaises(EventFilter.EventFilterError):
+            thisfilter.add_rule('bad action', action='delete')
+        with self.assertRaises(EventFilter.EventFilterError):
+            thisfilter.add_rule('bad pattern', folder='re:(unclosed', action='skip')
+
+
+class LedgerSet(unittest.TestCase):
+    """
+    Tests for the quicklink ledger.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ledger = QuicklinkLedger(os.path.join(self.tmpdir.name, 'ledger.db'))
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test001(self):
+        """ Test an identical registration is found and a different one is not"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        self.ledger.record('Documents/EQ100.pdf', 'quicklinks', 'https://nc/index.php/s/abc', 12, 2281,
+                           'C0002', 'deb-master', 'EQ100', '3')
+        entry = self.ledger.lookup('Documents/EQ100.pdf', 'quicklinks', 'https://nc/index.php/s/abc', 12, 2281)
+        self.assertIsNotNone(entry, "Registration not found")
+        self.assertEqual(entry['company'], 'C0002', "Incorrect company")
+        self.assertEqual(entry['seq'], '3', "Incorrect sequence")
+        self.assertIsNone(self.ledger.lookup('Documents/EQ100.pdf', 'quicklinks', 'https://nc/index.php/s/xyz',
+                                             12, 2281), "Different share url found")
+
+    def test002(self):
+        """ Test a missing public share id (None or 0) is treated the same"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        self.ledger.record('Documents/EQ100.pdf', 'quicklinks', 'https://nc/index.php/f/2281', None, 2281,
+                           'C0002', 'deb-master', 'EQ100', '3')
+        self.assertIsNotNone(self.ledger.lookup('Documents/EQ100.pdf', 'quicklinks', 'https://nc/index.php/f/2281',
+                                                0, 2281), "Registration not found")
+
+    def test003(self):
+        """ Test invalidating entries"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        self.ledger.record('Documents/EQ100.pdf', 'quicklinks', 'url1', None, 1, 'C', 'O', 'K', '1')
+        self.ledger.record('Documents/EQ200.pdf', 'quicklinks', 'url2', None, 2, 'C', 'O', 'K', '1')
+        self.assertEqual(self.ledger.invalidate(owner='quicklinks', filename='Documents/EQ100.pdf'), 1)
+        self.assertIsNone(self.ledger.lookup('Documents/EQ100.pdf', 'quicklinks', 'url1', None, 1))
+        self.assertIsNotNone(self.ledger.lookup('Documents/EQ200.pdf', 'quicklinks', 'url2', None, 2))
+        with self.assertRaises(QuicklinkLedger.QuicklinkLedgerError):
+            self.ledger.invalidate()
+
+    def test004(self):
+        """ Test a file registered under another name is found by its file id"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        self.ledger.record('Documents/EQ100.pdf', 'quicklinks', 'url1', 12, 2281, 'C', 'O', 'K', '7')
+        self.ledger.record('Documents/EQ200.pdf', 'quicklinks', 'url2', 13, 2282, 'C', 'O', 'K', '8')
+        entry = self.ledger.moved('quicklinks', 2281, 'Archive/EQ100.pdf')
+        self.assertEqual(entry['filename'], 'Documents/EQ100.pdf')
+        self.assertEqual(entry['seq'], '7')
+        self.assertIsNone(self.ledger.moved('quicklinks', 2281, 'Documents/EQ100.pdf'), "Unmoved file found")
+        self.assertIsNone(self.ledger.moved('other', 2281, 'Archive/EQ100.pdf'), "Another owner's file found")
+        self.assertIsNone(self.ledger.moved('quicklinks', None, 'Archive/EQ100.pdf'))
+
+    def test005(self):
+        """ Test a moved file keeps its share and its quicklink is updated rather than added"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        with StandInServer() as server:
+            settings = {'datalog': None, 'prontourl': server.url, 'prontoapiwebresource': 'standin',
+                        'prontoapiuser': 'api', 'prontoapipassword': 'api', 'webhook': None, 'jsonlog': None,
+                        'sinktimeouts': dict(main.SINK_TIMEOUTS), 'reusefoldershare': False,
+                        'lockdir': os.path.join(self.tmpdir.name, 'locks'), 'nextcloudroot': '/data', 'lagslo': {}}
+            args = argparse.Namespace(create_public_share=True, public_keyword=None, reuse_folder_share=False,
+                                      force=False)
+            thiscloud = NxtCld(server.url, 'quicklinks', 'password')
+            first = {}
+            main.process_file(thiscloud, args, '/Documents/EQ100.pdf', [], self.ledger, first, settings)
+            self.assertTrue(first['sharecreated'])
+            self.assertIsNone(first['movedfrom'])
+            server.move_file('quicklinks', '/Documents/EQ100.pdf', '/Archive/EQ100-old.pdf')
+            before = dict(server.requests)
+            thiscloud._initialise_internal_variables()
+            moved = {}
+            main.process_file(thiscloud, args, '/Archive/EQ100-old.pdf', [], self.ledger, moved, settings)
+            self.assertEqual(moved['movedfrom'], '/Documents/EQ100.pdf')
+            self.assertEqual(moved['fileid'], first['fileid'])
+            self.assertEqual(moved['shareurl'], first['shareurl'])
+            self.assertFalse(moved['sharecreated'])
+            self.assertEqual(server.requests.get('nc_get_shares'), before.get('nc_get_shares', 0) + 1,
+                             "Kept share not checked")
+            self.assertEqual(server.requests.get('nc_create_share'), before.get('nc_create_share'), "Share created")
+            self.assertEqual(moved['pronto']['seq'], first['pronto']['seq'], "Quicklink added rather than updated")
+            self.assertIsNone(self.ledger.moved('quicklinks', first['fileid'], '/Archive/EQ100-old.pdf'),
+                              "Old name still in the ledger")
+            # moved again after its share was removed, to a pronto that does not update quicklinks
+            server.move_file('quicklinks', '/Archive/EQ100-old.pdf', '/Archive/EQ100-older.pdf')
+            server.remove_share('quicklinks', '/Archive/EQ100-older.pdf')
+            server.prontoupdates = False
+            thiscloud._initialise_internal_variables()
+            again = {}
+            main.process_file(thiscloud, args, '/Archive/EQ100-older.pdf', [], self.ledger, again, settings)
+            self.assertTrue(again['sharecreated'], "Removed share kept")
+            self.assertNotEqual(again['shareurl'], first['shareurl'])
+            self.assertIn("Quicklink {} not updated - added again".format(first['pronto']['seq']),
+                          thiscloud.messages, "Second quicklink not reported")
+
+
+class PathLockSet(unittest.TestCase):
+    """
+    Tests for the per file lock used around public share creation.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test001(self):
+        """ Test a second thread waits for the first to finish with the same file"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        events = []
+
+        def worker(name):
+            with PathLock(self.tmpdir.name, 'quicklinks', 'Documents/EQ100.pdf'):
+                events.append(name + ' start')
+                time.sleep(0.2)
+                events.append(name + ' end')
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in ('a', 'b')]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(events[0][2:], 'start', "Incorrect order")
+        self.assertEqual(events[1][2:], 'end', "Second worker did not wait")
+        self.assertEqual(events[0][0], events[1][0], "Locks overlapped")
+
+    def test002(self):
+        """ Test a different file is not blocked and a timeout is raised for the same file"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        with PathLock(self.tmpdir.name, 'quicklinks', 'Documents/EQ100.pdf'):
+            with PathLock(self.tmpdir.name, 'quicklinks', 'Documents/EQ200.pdf', timeout=0.5):
+                pass
+            result = []
+
+            def waiter():
+                try:
+                    with PathLock(self.tmpdir.name, 'quicklinks', 'Documents/EQ100.pdf', timeout=0.3):
+                        result.append('locked')
+                except PathLock.PathLockError:
+                    result.append('timeout')
+
+            t = threading.Thread(target=waiter)
+            t.start()
+            t.join()
+            self.assertEqual(result, ['timeout'], "Lock on the same file was not held")
+
+    def test003(self):
+        """ Test the lock file is removed on release and processes still take the lock in turn"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        counter = os.path.join(self.tmpdir.name, 'counter')
+        with open(counter, 'w') as f:
+            f.write('0')
+
+        def worker():
+            for i in range(20):
+                with PathLock(self.tmpdir.name, 'quicklinks', 'Documents/EQ100.pdf', pollinterval=0.001):
+                    with open(counter) as f:
+                        count = int(f.read())
+                    time.sleep(0.001)
+                    with open(counter, 'w') as f:
+                        f.write(str(count + 1))
+        processes = [multiprocessing.get_context('fork').Process(target=worker) for n in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        with open(counter) as f:
+            self.assertEqual(f.read(), '80', "Two processes held the lock at once")
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir.name, 'paths')), [], "Lock file left behind")
+
+
+class ProfilerSet(unittest.TestCase):
+    """
+    Tests for the slow event profiler.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test001(self):
+        """ Test slow events are dumped in both modes and fast events are not"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        for mode in SlowEventProfiler.MODES:
+            profiler = SlowEventProfiler(0.05, self.tmpdir.name, mode=mode, sampleinterval=0.005)
+            profiler.start()
+            self.assertIsNone(profiler.stop(tags={'owner': 'quicklinks'}), "Fast event dumped")
+            profiler.start()
+            time.sleep(0.1)
+            dumpfile = profiler.stop(tags={'owner': 'quicklinks', 'fileid': 2281}, timings={'shares': 0.1})
+            self.assertIsNotNone(dumpfile, "Slow event not dumped ({})".format(mode))
+            with open(dumpfile) as f:
+                text = f.read()
+            self.assertIn("fileid: 2281", text, "Tags not in dump")
+            self.assertIn("shares=0.1", text, "Timings not in dump")
+
+    def test002(self):
+        """ Test dumps are removed once they exceed the size limit and profiling is off by default"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        profiler = SlowEventProfiler(0.01, self.tmpdir.name, maxbytes=1, mode='sample')
+        profiler.start()
+        time.sleep(0.02)
+        profiler.stop()
+        self.assertEqual(os.listdir(self.tmpdir.name), [], "Dumps not rotated")
+        self.assertFalse(SlowEventProfiler().enabled, "Profiling on by default")
+
+
+class LoadGenSet(unittest.TestCase):
+    """
+    Tests for the load generator (against its stand-in servers, so no live servers are needed).
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.datalog = os.path.join(self.tmpdir.name, 'datalog.txt')
+        with open(self.datalog, 'w') as f:
+            f.write("date|time|file|owner|url|shareid|fileid\n")
+            f.write("2024-07-01|10:00:00|Documents/EQ100.pdf|quicklinks|u|1|2\n")
+            f.write("2024-07-01|10:00:04|Documents/EQ200.pdf|quicklinks|u|1|3\n")
+            f.write("2024-07-01|18:00:04|Documents/EQ100.pdf|quicklinks|u|1|2\n")
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test001(self):
+        """ Test the datalog is replayed against the stand-in servers and a report produced"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        events = LoadGenerator.read_datalog(self.datalog)
+        self.assertEqual(len(events), 3, "Datalog events not read")
+        with StandInServer() as server:
+            report = LoadGenerator(events, speed='max', concurrency=2).run(server)
+        self.assertEqual(report['events'], 3, "Not all events replayed")
+        self.assertEqual(report['errors'], 0, "Errors {}".format(report['errormessages']))
+        self.assertEqual(report['requests']['nc_create_share'], 2, "The existing share was not reused")
+        self.assertIn('p95', report['latency'], "No latency percentiles")
+        self.assertIn('Throughput', LoadGenerator.format_report(report), "Report not formatted")
+
+    def test002(self):
+        """ Test the replay schedule at scaled speed with long gaps shortened"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        events = LoadGenerator.read_datalog(self.datalog)
+        offsets = [o for o, e in LoadGenerator(events, speed='2', maxgap=60).schedule()]
+        self.assertEqual(offsets, [0.0, 2.0, 32.0], "Incorrect schedule")
+        offsets = [o for o, e in LoadGenerator(events, speed='max').schedule()]
+        self.assertEqual(offsets, [0.0, 0.0, 0.0], "Max speed should not wait")
+        with self.assertRaises(LoadGenerator.LoadGeneratorError):
+            LoadGenerator(events, speed='fast')
+
+
+class LogStatsSet(unittest.TestCase):
+    """
+    Tests for the log-stats analysis.
+    """
+
+    LOG = ("2024-07-01|10:00:00|main.py|<module>|INFO|App Started\n"
+           "2024-07-01|10:00:00|main.py|setup_to_log|INFO|Parameter Owner:quicklinks\n"
+           "2024-07-01|10:00:02|onxtcld.py|__init__|INFO|Successful Connection to URL\n"
+           "2024-07-01|10:00:03|onxtcld.py|__get_first_public_share|DEBUG|Getting First Public Share\n"
+           "2024-07-01|10:00:05|onxtcld.py|add_pronto_quicklink|INFO|Create Quicklink via API\n"
+           "2024-07-01|10:00:07|onxtcld.py|add_pronto_quicklink|INFO|Quicklinks API Successful\n"
+           "2024-07-02|11:00:00|main.py|<module>|INFO|App Started\n"
+           "2024-07-02|11:00:01|main.py|timings_to_log|INFO|Timings owner=other total=1.250 connect=0.5 shares=0.4\n"
+           "2024-07-02|11:00:01|main.py|<module>|ERROR|Error occured: Failed to Connect\n")
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.applog = os.path.join(self.tmpdir.name, 'vnextcloud.log')
+        with open(self.applog, 'w') as f:
+            f.write(self.LOG)
+        with gzip.open(self.applog + '.1.gz', 'wt') as f:
+            f.write(self.LOG)
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test001(self):
+        """ Test events are rebuilt or read from Timings lines across rotated and gzipped logs"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        files = LogStats.log_files(self.applog)
+        self.assertEqual(files, [self.applog + '.1.gz', self.applog], "Logs not found oldest first")
+        stats = LogStats()
+        for logfile in files:
+            stats.add_file(logfile)
+        self.assertEqual(stats.counts, {'timings': 2, 'rebuilt': 2, 'incomplete': 0, 'errors': 2})
+        report = stats.report()
+        self.assertEqual(report['quicklinks']['total']['p50'], 7.0, "Rebuilt total incorrect")
+        self.assertEqual(report['quicklinks']['shares']['p99'], 2.0, "Rebuilt stage incorrect")
+        self.assertEqual(report['other']['connect']['count'], 2, "Timings line not used")
+        self.assertEqual(report['(all)']['total']['count'], 4, "Owners not combined")
+
+    def test002(self):
+        """ Test the time window and owner selection"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        stats = LogStats(since=datetime.datetime(2024, 7, 2))
+        stats.add_file(self.applog)
+        self.assertEqual(list(stats.report().keys()), ['(all)', 'other'], "Window not applied")
+        stats = LogStats(owner='quicklinks')
+        stats.add_file(self.applog)
+        self.assertEqual(stats.counts['timings'], 0, "Owner not applied")
+        self.assertEqual(stats.counts['rebuilt'], 1, "Owner not applied")
+
+
+class FolderCacheSet(unittest.TestCase):
+    """
+    Tests for resolving file ids a folder at a time (against the load generator's stand-in server).
+    """
+
+    def setUp(self) -> None:
+        self.server = StandInServer()
+        self.server.start()
+        for path in ('Documents/EQ100.pdf', 'Documents/EQ200.pdf', 'Documents/Stock/EQ300.jpg', 'EQ400.pdf'):
+            self.server.add_file('quicklinks', path)
+
+    def tearDown(self) -> None:
+        self.server.stop()
+
+    def test001(self):
+        """ Test one folder listing answers every file in the folder"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        nxc = NextCloud(self.server.url, 'quicklinks', 'password')
+        cache = FolderCache()
+        self.assertEqual(cache.fileid(nxc, 'quicklinks', '/Documents/EQ100.pdf'), 1000)
+        self.assertEqual(cache.fileid(nxc, 'quicklinks', 'Documents/EQ200.pdf'), 1001)
+        self.assertIsNone(cache.fileid(nxc, 'quicklinks', 'Documents/missing.pdf'), "Missing file found")
+        self.assertEqual(cache.fileid(nxc, 'quicklinks', 'EQ400.pdf'), 1003)
+        self.assertEqual(cache.stats, {'hits': 3, 'misses': 1, 'requests': 2, 'sharerequests': 0})
+        cache.invalidate('quicklinks', 'Documents')
+        cache.fileid(nxc, 'quicklinks', 'Documents/EQ100.pdf')
+        self.assertEqual(self.server.requests['nc_propfind'], 3, "Folder not read again after invalidate")
+        cache = FolderCache(ttl=0.2)
+        cache.fileid(nxc, 'quicklinks', 'Documents/EQ100.pdf')
+        cache.fileid(nxc, 'quicklinks', 'Documents/EQ200.pdf')
+        time.sleep(0.25)
+        cache.fileid(nxc, 'quicklinks', 'Documents/EQ100.pdf')
+        self.assertEqual(self.server.requests['nc_propfind'], 5, "Folder not read again after its ttl")
+
+    def test002(self):
+        """ Test NxtCld takes the file id from the folder cache and falls back to the file"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        thiscloud = NxtCld(self.server.url, 'quicklinks', 'password')
+        thiscloud.folder_cache = FolderCache()
+        for path, fileid in (('/Documents/EQ100.pdf', 1000), ('/Documents/EQ200.pdf', 1001)):
+            thiscloud._initialise_internal_variables()
+            thiscloud.file_path = path
+            self.assertEqual(thiscloud.file_id, fileid, "Incorrect file id")
+        self.assertEqual(self.server.requests['nc_propfind'], 1, "File ids not taken from the folder")
+        thiscloud._initialise_internal_variables()
+        thiscloud.file_path = '/Documents/New.pdf'
+        self.assertIsNotNone(thiscloud.file_id, "No fall back for a file missing from the folder")
+        self.assertEqual(self.server.requests['nc_propfind'], 2, "Fall back did not ask for the file")
+
+    def test003(self):
+        """ Test a folder's public shares are asked for once and a file drop share is not reused"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        self.server.add_file('quicklinks', 'Documents/Stock/EQ301.jpg')
+        folderid = self.server.add_share('quicklinks', 'Documents')
+        self.server.add_share('quicklinks', 'Documents/Stock', permissions=4)
+        thiscloud = NxtCld(self.server.url, 'quicklinks', 'password')
+        thiscloud.folder_cache = FolderCache()
+        for filename in ('EQ300.jpg', 'EQ301.jpg'):
+            thiscloud._initialise_internal_variables()
+            thiscloud.optionally_create_public_share = True
+            thiscloud.reuse_folder_share = True
+            thiscloud.file_path = '/Documents/Stock/' + filename
+            self.assertEqual(thiscloud.public_share_id, folderid, "File drop share reused")
+            self.assertTrue(thiscloud.share_url.endswith('/download?path=%2FStock&files=' + filename))
+        self.assertEqual(self.server.requests['nc_get_shares'], 4, "Folder shares not taken from the folder cache")
+        self.assertEqual(thiscloud.folder_cache.stats['sharerequests'], 2)
+        self.assertEqual(self.server.requests.get('nc_create_share', 0), 0, "Share created")
+
+
+class OutputSet(unittest.TestCase):
+    """
+    Tests for the --output jsonl result records.
+    """
+
+    def tearDown(self) -> None:
+        main.global_results = None
+
+    def test001(self):
+        """ Test a result record is written as one json line as soon as it is done"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        main.global_results = io.StringIO()
+        event = {'path': '/Documents/EQ100.pdf', 'fileid': 2281, 'shareurl': 'https://x/s/abc', 'shareid': '77',
+                 'sharecreated': True, 'wait': 0.5,
+                 'pronto': {'company': '1', 'object': 'stock', 'keys': 'EQ100', 'seq': '3'}}
+        main.write_result(main.result_record('quicklinks', event, 1.23456))
+        main.write_result(main.result_record('quicklinks', {'path': '/x.pdf'}, 0.1, 'Failed to Connect'))
+        lines = main.global_results.getvalue().splitlines()
+        self.assertEqual(len(lines), 2, "One line per file expected")
+        first = json.loads(lines[0])
+        self.assertEqual(first['status'], 'processed')
+        self.assertEqual(first['keys'], 'EQ100')
+        self.assertTrue(first['sharecreated'])
+        self.assertEqual(first['timings'], {'total': 1.235, 'wait': 0.5})
+        second = json.loads(lines[1])
+        self.assertEqual((second['status'], second['error'], second['fileid']), ('error', 'Failed to Connect', None))
+
+
+class BatchWorkersSet(unittest.TestCase):
+    """
+    Tests for --batch with --workers (against the load generator's stand-in server).
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.server = StandInServer()
+        self.server.start()
+        self.configfile = os.path.join(self.tmpdir.name, 'batch.ini')
+        with open(self.configfile, 'w') as f:
+            f.write("[SETUP]\nurl = {}\nnextcloudroot = /data\ndatalog = {}\nlockdir = {}\n"
+                    "[USERPASSWORDS]\nu0 = password\nu1 = password\nu2 = password\n".format(
+                        self.server.url, os.path.join(self.tmpdir.name, 'datalog.txt'),
+                        os.path.join(self.tmpdir.name, 'locks')))
+        self.batchfile = os.path.join(self.tmpdir.name, 'batch.txt')
+        with open(self.batchfile, 'w') as f:
+            for owner in ('u0', 'u1', 'u2'):
+                for i in range(5):
+                    f.write("{}|Documents/EQ{}.pdf\n".format(owner, i))
+            f.write("nobody|Documents/EQ0.pdf\n")
+
+    def tearDown(self) -> None:
+        self.server.stop()
+        self.tmpdir.cleanup()
+        main.global_results = None
+
+    def test001(self):
+        """ Test every file is processed once, each owner connects once and one datalog row is written per file"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        main.process_config(self.configfile)
+        main.global_results = io.StringIO()
+        args = argparse.Namespace(batch=self.batchfile, workers=3, forget=False, create_public_share=True,
+                                  public_keyword=None, reuse_folder_share=False, force=False)
+        counts = main.process_batch(args, SlowEventProfiler())
+        self.assertEqual(counts, {'processed': 15, 'skipped': 0, 'errors': 1})
+        records = [json.loads(line) for line in main.global_results.getvalue().splitlines()]
+        self.assertEqual(sorted((r['owner'], r['path']) for r in records if r['status'] == 'processed'),
+                         sorted(('u{}'.format(o), '/Documents/EQ{}.pdf'.format(i)) for o in range(3) for i in range(5)))
+        self.assertEqual(self.server.requests['nc_user'], 3, "An owner was connected to more than once")
+        with open(os.path.join(self.tmpdir.name, 'datalog.txt')) as f:
+            rows = f.read().splitlines()
+        self.assertEqual(rows[0], 'date|time|file|owner|url|shareid|fileid')
+        self.assertEqual(len(rows), 16, "One datalog row per file expected")
+
+
+class AdaptiveSet(unittest.TestCase):
+    """
+    Tests for the adaptive (AIMD) concurrency limiter.
+    """
+
+    def test001(self):
+        """ Test the limit grows with quick successes and is halved once per round trip on failure"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        limiter = AdaptiveLimiter(maximum=8, initial=2, latencytarget=5)
+        for i in range(11):
+            with limiter.slot('create_share'):
+                pass
+        self.assertEqual(limiter.limits['create_share'], 5, "Limit did not grow additively")
+        self.assertEqual(limiter.limits['vapiql'], 2, "Another endpoint's limit changed")
+        # two requests in flight together both fail: only one decrease
+        first = limiter.acquire('create_share')
+        second = limiter.acquire('create_share')
+        limiter.release('create_share', first, failed=True)
+        limiter.release('create_share', second, failed=True)
+        self.assertEqual(limiter.limits['create_share'], 2, "Limit not halved once")
+        with self.assertRaises(ValueError):
+            with limiter.slot('create_share'):
+                raise ValueError('server error')
+        self.assertEqual(limiter.limits['create_share'], 1, "Exception not counted as a failure")
+        with self.assertRaises(AdaptiveLimiter.AdaptiveLimiterError):
+            limiter.slot('unknown').__enter__()
+
+    def test002(self):
+        """ Test no more requests than the limit are in flight and slow requests reduce the limit"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        limiter = AdaptiveLimiter(maximum=2, minimum=1, initial=2, latencytarget=0.05)
+        inflight = []
+        most = []
+        guard = threading.Lock()
+
+        def request():
+            with limiter.slot('get_shares'):
+                with guard:
+                    inflight.append(1)
+                    most.append(len(inflight))
+                time.sleep(0.1)
+                with guard:
+                    inflight.pop()
+
+        threads = [threading.Thread(target=request) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertLessEqual(max(most), 2, "More requests in flight than the limit")
+        self.assertEqual(limiter.limits['get_shares'], 1, "Slow requests did not reduce the limit")
+
+    def test003(self):
+        """ Test a request gives up waiting after maxwait and the slot of a dead process can be given back"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        context = multiprocessing.get_context('fork')
+        limiter = AdaptiveLimiter(maximum=1, initial=1, latencytarget=5, context=context, maxwait=0.3)
+
+        def worker():
+            limiter.acquire('vapiql')
+            # killed mid request
+            os._exit(1)
+        process = context.Process(target=worker)
+        process.start()
+        process.join()
+        started = time.monotonic()
+        with self.assertRaises(AdaptiveLimiter.AdaptiveLimiterError):
+            limiter.acquire('vapiql')
+        self.assertGreaterEqual(time.monotonic() - started, 0.3, "Did not wait for maxwait")
+        self.assertEqual(limiter.reclaim(os.getpid()), 0, "Reclaimed slots of another process")
+        self.assertEqual(limiter.reclaim(process.pid), 1, "Dead process's slot not given back")
+        limiter.release('vapiql', limiter.acquire('vapiql'))
+
+
+class NegativeCacheSet(unittest.TestCase):
+    """
+    Tests for the negative cache of missing files and rejected logins.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = NegativeCache(os.path.join(self.tmpdir.name, 'negative.db'), ttl=60)
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test001(self):
+        """ Test failures are remembered until they expire and passwords are not stored"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        self.cache.record('get_file returned None', 'path', 'https://x', 'quicklinks', '/EQ100.pdf')
+        self.cache.record('Current user is not logged in', 'login', 'https://x', 'quicklinks', 'secret')
+        self.assertEqual(self.cache.lookup('path', 'https://x', 'quicklinks', '/EQ100.pdf'), 'get_file returned None')
+        self.assertIsNone(self.cache.lookup('path', 'https://x', 'quicklinks', '/EQ200.pdf'))
+        self.assertIsNotNone(self.cache.lookup('login', 'https://x', 'quicklinks', 'secret'))
+        self.assertIsNone(self.cache.lookup('login', 'https://x', 'quicklinks', 'newsecret'),
+                          "A new password is still rejected")
+        with open(self.cache.dbfile, 'rb') as f:
+            self.assertNotIn(b'secret', f.read(), "Password stored in the cache")
+        self.assertTrue(self.cache.forget('path', 'https://x', 'quicklinks', '/EQ100.pdf'))
+        self.assertIsNone(self.cache.lookup('path', 'https://x', 'quicklinks', '/EQ100.pdf'))
+        shortcache = NegativeCache(self.cache.dbfile, ttl=0.2)
+        shortcache.record('get_file returned None', 'path', 'https://x', 'quicklinks', '/EQ300.pdf')
+        time.sleep(0.3)
+        self.assertIsNone(shortcache.lookup('path', 'https://x', 'quicklinks', '/EQ300.pdf'), "Entry did not expire")
+
+    def test002(self):
+        """ Test a rejected login and a missing file are not asked for again"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        with StandInServer() as server:
+            server.passwords['quicklinks'] = 'right'
+            server.autocreate = False
+            for i in range(2):
+                with self.assertRaises(NxtCld.NxtCldError):
+                    NxtCld(server.url, 'quicklinks', 'wrong', negative_cache=self.cache)
+            self.assertEqual(server.requests['nc_user'], 1, "Rejected login tried again")
+            for i in range(2):
+                thiscloud = NxtCld(server.url, 'quicklinks', 'right', negative_cache=self.cache)
+                with self.assertRaises(NxtCld.NxtCldError):
+                    thiscloud.file_path = '/Documents/Missing.pdf'
+                    thiscloud.file_id
+            self.assertEqual(server.requests['nc_propfind'], 1, "Missing file asked for again")
+            server.add_file('quicklinks', 'Documents/EQ100.pdf')
+            thiscloud._initialise_internal_variables()
+            thiscloud.file_path = '/Documents/EQ100.pdf'
+            self.assertEqual(thiscloud.file_id, 1000)
+
+    def test003(self):
+        """ Test a server error is not remembered as a rejected login or a missing file"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        with StandInServer() as server:
+            server.autocreate = False
+            thiscloud = NxtCld(server.url, 'quicklinks', 'password', negative_cache=self.cache)
+            server.errorrate = 1.0
+            for i in range(2):
+                with self.assertRaises(NxtCld.NxtCldError):
+                    NxtCld(server.url, 'quicklinks', 'password', negative_cache=self.cache)
+                with self.assertRaises(NxtCld.NxtCldError):
+                    thiscloud._initialise_internal_variables()
+                    thiscloud.file_path = '/Documents/EQ100.pdf'
+                    thiscloud.file_id
+            self.assertEqual((server.requests['nc_user'], server.requests['nc_propfind']), (3, 2),
+                             "A server error was remembered")
+            server.errorrate = 0.0
+            server.add_file('quicklinks', 'Documents/EQ100.pdf')
+            NxtCld(server.url, 'quicklinks', 'password', negative_cache=self.cache)
+            thiscloud._initialise_internal_variables()
+            thiscloud.file_path = '/Documents/EQ100.pdf'
+            self.assertEqual(thiscloud.file_id, 1000)
+
+
+class PollSet(unittest.TestCase):
+    """
+    Tests for the poll command's watermark (against the load generator's stand-in server).
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.server = StandInServer()
+        self.server.start()
+        self.server.autocreate = False
+        self.watermark = os.path.join(self.tmpdir.name, 'watermark.json')
+        configfile = os.path.join(self.tmpdir.name, 'poll.ini')
+        with open(configfile, 'w') as f:
+            f.write("[SETUP]\nurl = {}\nnextcloudroot = /data\nwatermark = {}\nlockdir = {}\n"
+                    "[USERPASSWORDS]\nquicklinks = password\n".format(
+                        self.server.url, self.watermark, os.path.join(self.tmpdir.name, 'locks')))
+        main.process_config(configfile)
+        self.args = argparse.Namespace(folder="", batchsize=2, forget=False, force=False, create_public_share=True,
+                                       public_keyword=None, reuse_folder_share=False)
+
+    def tearDown(self) -> None:
+        self.server.stop()
+        self.tmpdir.cleanup()
+
+    def poll(self, start):
+        counts = {'processed': 0, 'skipped': 0, 'errors': 0}
+        main.poll_owner(self.args, 'quicklinks', start, {}, FolderCache(), None, SlowEventProfiler(), None, counts)
+        return counts['processed']
+
+    def test001(self):
+        """ Test only files modified after the watermark are processed, including files in the same second"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        now = int(time.time())
+        self.server.add_file('quicklinks', 'Documents/Old.pdf', now - 100)
+        for i in range(3):
+            self.server.add_file('quicklinks', 'Documents/EQ{}.pdf'.format(i), now - 50 + i)
+        self.assertEqual(self.poll(now - 60), 3, "New files not processed (in batches of 2)")
+        self.assertEqual(self.poll(now - 60), 0, "Files processed twice")
+        with open(self.watermark) as f:
+            mark = json.load(f)['quicklinks']
+        self.assertEqual((mark['modified'], len(mark['seen'])), (now - 48, 1))
+        # a new file in the same second as the watermark, and a changed file
+        self.server.add_file('quicklinks', 'Documents/EQ9.pdf', now - 48)
+        self.server.add_file('quicklinks', 'Documents/Old.pdf', now)
+        self.assertEqual(self.poll(now - 60), 2, "New or changed files missed")
+        self.assertEqual(self.server.requests['nc_create_share'], 5)
+
+    def test002(self):
+        """ Test polls of different owners writing the watermark at once keep each other's marks"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+
+        def advance(owner):
+            for i in range(50):
+                main.write_watermark(self.watermark, owner, {'modified': i, 'seen': [], 'failures': {}})
+        threads = [threading.Thread(target=advance, args=('owner{}'.format(n),)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual({owner: mark['modified'] for owner, mark in main.read_watermark(self.watermark).items()},
+                         {'owner{}'.format(n): 49 for n in range(4)}, "A watermark was lost")
+
+    def test003(self):
+        """ Test a poll that cannot get a processing slot is skipped rather than stopping the poll"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        lockdir = os.path.join(self.tmpdir.name, 'locks')
+        configfile = os.path.join(self.tmpdir.name, 'busy.ini')
+        with open(configfile, 'w') as f:
+            f.write("[SETUP]\nurl = {}\nnextcloudroot = /data\nwatermark = {}\nlockdir = {}\nmaxconcurrent = 1\n"
+                    "maxwait = 1\napplog = {}\n[USERPASSWORDS]\nquicklinks = password\n".format(
+                        self.server.url, self.watermark, lockdir, os.path.join(self.tmpdir.name, 'applog.log')))
+        handlers, level = list(applog.handlers), applog.level
+        try:
+            with HostLimiter(lockdir, 1, 5):
+                self.assertEqual(main.poll(['--configfile', configfile, '--once']), 1, "Skipped poll not counted")
+        finally:
+            for handler in applog.handlers[:]:
+                if handler not in handlers:
+                    applog.removeHandler(handler)
+                    handler.close()
+            applog.setLevel(level)
+        self.assertEqual(self.server.requests.get('nc_user', 0), 0, "Polled without a slot")
+
+
+class FileCacheSet(unittest.TestCase):
+    """
+    Tests for reading file ids from nextcloud's database (a sqlite copy of the two tables used).
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dbfile = os.path.join(self.tmpdir.name, 'owncloud.db')
+        db = sqlite3.connect(self.dbfile)
+        db.execute("CREATE TABLE oc_storages (numeric_id INTEGER PRIMARY KEY, id TEXT)")
+        db.execute("CREATE TABLE oc_filecache (fileid INTEGER PRIMARY KEY, storage INTEGER, path TEXT, "
+                   "path_hash TEXT, UNIQUE (storage, path_hash))")
+        db.executemany("INSERT INTO oc_storages VALUES (?,?)", [(1, 'home::quicklinks'), (2, 'home::other')])
+        for fileid, storage, path in ((2281, 1, 'files/Documents/EQ100.pdf'), (2282, 2, 'files/Documents/EQ100.pdf')):
+            db.execute("INSERT INTO oc_filecache VALUES (?,?,?,?)",
+                       (fileid, storage, path, hashlib.md5(path.encode('UTF-8')).hexdigest()))
+        db.commit()
+        db.close()
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test001(self):
+        """ Test file ids are found for the right owner and a missing file or database returns None"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        resolver = FileCacheResolver('sqlite:///' + self.dbfile)
+        self.assertEqual(resolver.fileid('quicklinks', '/Documents/EQ100.pdf'), 2281)
+        self.assertEqual(resolver.fileid('other', 'Documents/EQ100.pdf'), 2282)
+        self.assertIsNone(resolver.fileid('quicklinks', '/Documents/Missing.pdf'))
+        self.assertEqual(resolver.stats, {'hits': 2, 'misses': 1, 'errors': 0})
+        broken = FileCacheResolver('sqlite:///' + os.path.join(self.tmpdir.name, 'missing.db'))
+        self.assertIsNone(broken.fileid('quicklinks', '/Documents/EQ100.pdf'))
+        self.assertEqual(broken.stats['errors'], 1)
+        with self.assertRaises(FileCacheResolver.FileCacheResolverError):
+            FileCacheResolver('oracle://localhost/nextcloud')
+
+    def test002(self):
+        """ Test NxtCld takes the file id from the database and falls back to nextcloud"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        with StandInServer() as server:
+            thiscloud = NxtCld(server.url, 'quicklinks', 'password')
+            thiscloud.filecache_resolver = FileCacheResolver('sqlite:///' + self.dbfile)
+            thiscloud.file_path = '/Documents/EQ100.pdf'
+            self.assertEqual(thiscloud.file_id, 2281)
+            self.assertEqual(server.requests.get('nc_propfind', 0), 0, "Nextcloud asked for the file id")
+            thiscloud._initialise_internal_variables()
+            thiscloud.file_path = '/Documents/New.pdf'
+            self.assertIsNotNone(thiscloud.file_id)
+            self.assertEqual(server.requests['nc_propfind'], 1, "No fall back for a file missing from the database")
+
+
+class SinksSet(unittest.TestCase):
+    """
+    Tests for sending the result of a file to its sinks.
+    """
+
+    class Sleeper(Sink):
+        """ A sink that sleeps then optionally fails """
+        name = 'sleeper'
+
+        def __init__(self, name, seconds, fail=False, timeout=10, required=True):
+            super().__init__(timeout, required)
+            self.name = name
+            self.seconds = seconds
+            self.fail = fail
+
+        def send(self, thiscloud, event):
+            time.sleep(self.seconds)
+            if self.fail:
+                raise Sink.SinkError("{} failed".format(self.name))
+            event[self.name] = True
+
+    def test001(self):
+        """ Test the sinks run side by side, each with its own timeout, and only required failures are raised"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        event = {}
+        started = time.monotonic()
+        SinkRunner([self.Sleeper('one', 0.3), self.Sleeper('two', 0.3), self.Sleeper('three', 0.3)]).run(None, event)
+        self.assertLess(time.monotonic() - started, 0.6, "The sinks ran one after the other")
+        self.assertTrue(event['one'] and event['two'] and event['three'])
+        self.assertEqual(sorted(event['sinktimings']), ['one', 'three', 'two'])
+        # an optional sink failing or timing out does not fail the file
+        event = {}
+        SinkRunner([self.Sleeper('ok', 0), self.Sleeper('bad', 0, fail=True, required=False),
+                    self.Sleeper('slow', 1, timeout=0.1, required=False)]).run(None, event)
+        self.assertTrue(event['ok'])
+        self.assertEqual(event['abandoned'], ['slow'], "Abandoned sink not named")
+        # a required sink that times out does, but the other sinks still run
+        event = {}
+        with self.assertRaises(SinkRunner.SinkRunnerError) as raised:
+            SinkRunner([self.Sleeper('slow', 1, timeout=0.1), self.Sleeper('bad', 0, fail=True),
+                        self.Sleeper('ok', 0.2)]).run(None, event)
+        self.assertIn('slow: timed out', str(raised.exception))
+        self.assertIn('bad: bad failed', str(raised.exception))
+        self.assertTrue(event['ok'])
+        with self.assertRaises(Sink.SinkError):
+            self.Sleeper('never', 0, timeout=0)
+
+    def test003(self):
+        """ Test the pronto requests give up within the time given to the pronto sink"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        with StandInServer(prontolatency=0.4) as server:
+            thiscloud = NxtCld(server.url, 'quicklinks', 'password')
+            thiscloud.optionally_create_public_share = True
+            thiscloud.file_path = '/Documents/EQ100.pdf'
+            started = time.monotonic()
+            with self.assertRaises(Exception):
+                thiscloud.add_pronto_quicklink(server.url, 'standin', 'api', 'api', timeout=0.6)
+            self.assertLess(time.monotonic() - started, 0.75, "Pronto requests ran past their time")
+            self.assertIsNone(thiscloud.pronto_result)
+            thiscloud.add_pronto_quicklink(server.url, 'standin', 'api', 'api', timeout=2)
+            self.assertIsNotNone(thiscloud.pronto_result)
+
+    def test002(self):
+        """ Test process_file sends the file to the datalog and jsonlog sinks"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        with tempfile.TemporaryDirectory() as tmpdir, StandInServer() as server:
+            settings = {'datalog': os.path.join(tmpdir, 'datalog.txt'), 'prontourl': None, 'webhook': None,
+                        'jsonlog': os.path.join(tmpdir, 'files.jsonl'), 'sinktimeouts': dict(main.SINK_TIMEOUTS),
+                        'reusefoldershare': False, 'lockdir': os.path.join(tmpdir, 'locks'), 'nextcloudroot': tmpdir,
+                        'lagslo': {}}
+            args = argparse.Namespace(create_public_share=True, public_keyword=None, reuse_folder_share=False,
+                                      force=False)
+            thiscloud = NxtCld(server.url, 'quicklinks', 'password')
+            event = {'thiscloud': thiscloud}
+            main.process_file(thiscloud, args, '/Documents/EQ100.pdf', [], None, event, settings)
+            with open(settings['jsonlog']) as f:
+                record = json.loads(f.readline())
+            self.assertEqual(record['owner'], 'quicklinks')
+            self.assertEqual(record['fileid'], event['fileid'])
+            self.assertEqual(record['shareurl'], event['shareurl'])
+            with open(settings['datalog']) as f:
+                self.assertIn('/Documents/EQ100.pdf', f.read())
+            self.assertIn('jsonl', main.event_timings(event))
+
+
+class BundleSet(unittest.TestCase):
+    """
+    Tests for building the application into a single file.
+    """
+
+    def test001(self):
+        """ Test the bundle is built with bytecode, runs and is timed against loose files"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = os.path.join(tmpdir, 'vnextcloud.pyz')
+            with BundleBuilder(os.path.dirname(os.path.abspath(main.__file__)), output) as builder:
+                result = builder.build()
+                self.assertEqual(result['native'], [])
+                with zipfile.ZipFile(output) as bundle:
+                    names = bundle.namelist()
+                self.assertIn('main.pyc', names)
+                self.assertIn('__main__.py', names)
+                self.assertNotIn('testcases.py', names)
+                run = subprocess.run([sys.executable, output, '--help'], stdout=subprocess.PIPE)
+                self.assertEqual(run.returncode, 0)
+                self.assertIn(b'--configfile', run.stdout)
+                timings = builder.coldstart(runs=1)
+                self.assertEqual(sorted(timings), ['bundle', 'loose', 'loosecached'])
+            with self.assertRaises(BundleBuilder.BundleBuilderError):
+                BundleBuilder(tmpdir, output)
+
+
+class DigestSet(unittest.TestCase):
+    """
+    Tests for the digest of processed files.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dbfile = os.path.join(self.tmpdir.name, 'digest.db')
+        self.sent = []
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    @staticmethod
+    def record(path, status='processed', seconds=1.0, error=None):
+        return {'owner': 'quicklinks', 'path': path, 'status': status, 'error': error, 'timings': {'total': seconds}}
+
+    def test001(self):
+        """ Test results wait for the interval, are summarised in one email and removed once sent"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        notifier = DigestNotifier(self.dbfile, ['support@example.com'], interval=60, errors=0, slow=30,
+                                  mailer=self.sent.append)
+        for i in range(20):
+            self.assertFalse(notifier.add(self.record('/F{}.pdf'.format(i))))
+        notifier.add(self.record('/Slow.pdf', seconds=45.0))
+        notifier.add(self.record('/Bad.pdf', status='error', error='Call to API Failed'))
+        self.assertEqual(self.sent, [], "Sent before the interval")
+        self.assertEqual(notifier.pending(), {'processed': 21, 'error': 1})
+        self.assertTrue(notifier.flush(force=True))
+        self.assertEqual(len(self.sent), 1)
+        body = self.sent[0].get_content()
+        self.assertIn('22 files, 1 errors', self.sent[0]['Subject'])
+        self.assertIn('/Bad.pdf: Call to API Failed', body)
+        self.assertIn('/Slow.pdf', body)
+        self.assertNotIn('/F1.pdf', body)
+        self.assertEqual(notifier.pending(), {})
+        self.assertFalse(notifier.flush(force=True), "Sent an empty digest")
+
+    def test002(self):
+        """ Test a burst of errors sends the digest at once and a failed send keeps the results"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+
+        def broken(message):
+            raise ConnectionRefusedError("no mail server")
+
+        notifier = DigestNotifier(self.dbfile, ['support@example.com'], interval=60, errors=3, mailer=broken)
+        DigestNotifier.MINIMUM_GAP = 0
+        try:
+            notifier.add(self.record('/A.pdf', status='error', error='x'))
+            notifier.add(self.record('/B.pdf', status='error', error='x'))
+            self.assertFalse(notifier.add(self.record('/C.pdf', status='error', error='x')))
+            self.assertEqual(notifier.pending(), {'error': 3}, "Results lost when the digest was not sent")
+            notifier = DigestNotifier(self.dbfile, ['support@example.com'], interval=60, errors=3,
+                                      mailer=self.sent.append)
+            self.assertTrue(notifier.add(self.record('/D.pdf', status='error', error='x')))
+            self.assertIn('4 files, 4 errors', self.sent[0]['Subject'])
+        finally:
+            DigestNotifier.MINIMUM_GAP = 300
+
+
+class BreakerSet(unittest.TestCase):
+    """
+    Tests for the circuit breakers and deferring events while nextcloud or pronto is down.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.breakerdir = os.path.join(self.tmpdir.name, 'breakers')
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test001(self):
+        """ Test the breaker opens after consecutive failures, lets one probe through and closes on success"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        breaker = CircuitBreaker(self.breakerdir, 'pronto', failures=3, reset=0.2)
+        breaker.failure('timed out')
+        breaker.failure('timed out')
+        breaker.success()
+        breaker.failure('timed out')
+        breaker.failure('timed out')
+        self.assertTrue(breaker.allow(), "Opened before failures in a row")
+        breaker.failure('refused')
+        self.assertEqual(breaker.state['state'], CircuitBreaker.OPEN)
+        self.assertEqual(breaker.state['reason'], 'refused')
+        # the state is shared through the breaker directory
+        other = CircuitBreaker(self.breakerdir, 'pronto', failures=3, reset=0.2)
+        self.assertFalse(other.allow(), "Open breaker let an event through")
+        time.sleep(0.25)
+        self.assertTrue(other.allow(), "No probe after the reset")
+        self.assertFalse(breaker.allow(), "Second event let through while probing")
+        breaker.failure('refused')
+        self.assertFalse(breaker.allow(), "Failed probe did not open the breaker again")
+        time.sleep(0.25)
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(other.state['state'], CircuitBreaker.CLOSED)
+        self.assertTrue(other.allow())
+        self.assertTrue(CircuitBreaker(self.breakerdir, 'nextcloud').allow(), "Breakers not separate")
+        with self.assertRaises(CircuitBreaker.CircuitBreakerError):
+            CircuitBreaker(self.breakerdir, 'pronto', failures=0)
+
+    def test002(self):
+        """ Test events are deferred while nextcloud is down and replayed once it is back"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        deferdir = os.path.join(self.tmpdir.name, 'deferred')
+        configfile = os.path.join(self.tmpdir.name, 'breaker.ini')
+        with StandInServer(errorrate=1.0) as server:
+            with open(configfile, 'w') as f:
+                f.write("[SETUP]\nurl = {}\nnextcloudroot = /data\napplog = {}\nlockdir = {}\nbreakerdir = {}\n"
+                        "breakerfailures = 2\nbreakerreset = 0.3\ndeferdir = {}\n"
+                        "[USERPASSWORDS]\nquicklinks = password\n".format(
+                            server.url, os.path.join(self.tmpdir.name, 'applog.log'),
+                            os.path.join(self.tmpdir.name, 'locks'), self.breakerdir, deferdir))
+            main.process_config(configfile)
+            args = argparse.Namespace(forget=False, force=False, create_public_share=True, public_keyword=None,
+                                      reuse_folder_share=False)
+            outcomes = []
+            for i in range(4):
+                outcome, record = main.batch_line(args, 'quicklinks|Documents/EQ{}.pdf'.format(i), {},
+                                                  FolderCache(), None, SlowEventProfiler(), main.global_settings)
+                outcomes.append((outcome, record['status']))
+            self.assertEqual(outcomes, [('errors', 'error'), ('errors', 'error'), ('skipped', 'deferred'),
+                                        ('skipped', 'deferred')])
+            self.assertEqual(server.requests['nc_user'], 2, "Connected while the breaker was open")
+            pending = Spool(deferdir).pending()
+            self.assertEqual(len(pending), 2)
+
+            def replay():
+                handlers, level = list(applog.handlers), applog.level
+                try:
+                    self.assertEqual(main.replay(['--configfile', configfile]), 0)
+                finally:
+                    for handler in applog.handlers[:]:
+                        if handler not in handlers:
+                            applog.removeHandler(handler)
+                            handler.close()
+                    applog.setLevel(level)
+            # still down: the events stay as they were, in order
+            replay()
+            self.assertEqual(Spool(deferdir).pending(), pending, "Deferred again under a new name")
+            server.errorrate = 0.0
+            time.sleep(0.35)
+            replay()
+            self.assertEqual(Spool(deferdir).pending(), [], "Deferred events not replayed")
+            self.assertEqual(server.requests['nc_create_share'], 2)
+            self.assertEqual(CircuitBreaker(self.breakerdir, 'nextcloud').state['state'], CircuitBreaker.CLOSED)
+
+    def test003(self):
+        """ Test an outage that starts after connecting (a reused connection) opens the breaker"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        breaker = CircuitBreaker(self.breakerdir, 'nextcloud', failures=2, reset=60)
+        with StandInServer() as server:
+            thiscloud = NxtCld(server.url, 'quicklinks', 'password', circuit_breakers={'nextcloud': breaker})
+            server.errorrate = 1.0
+            for i in range(2):
+                thiscloud._initialise_internal_variables()
+                with self.assertRaises(NxtCld.NxtCldError):
+                    thiscloud.file_path = '/Documents/EQ{}.pdf'.format(i)
+                    thiscloud.file_id
+        self.assertEqual(breaker.state['state'], CircuitBreaker.OPEN, "Outage of a reused connection not reported")
+        breaker = CircuitBreaker(self.breakerdir, 'unreachable', failures=1, reset=60)
+        with StandInServer() as server:
+            thiscloud = NxtCld(server.url, 'quicklinks', 'password', circuit_breakers={'nextcloud': breaker})
+        # the server has stopped: no response at all
+        with self.assertRaises(NxtCld.NxtCldError):
+            thiscloud.file_path = '/Documents/EQ100.pdf'
+            thiscloud.file_id
+        self.assertEqual(breaker.state['state'], CircuitBreaker.OPEN, "No response not reported")
+
+    def test004(self):
+        """ Test a half open breaker keeps its probe when another breaker stops the event"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        nextcloud = CircuitBreaker(self.breakerdir, 'nextcloud', failures=1, reset=0.2)
+        pronto = CircuitBreaker(self.breakerdir, 'pronto', failures=1, reset=60)
+        nextcloud.failure('down')
+        pronto.failure('down')
+        time.sleep(0.25)
+        breakers = {'nextcloud': nextcloud, 'pronto': pronto}
+        self.assertTrue(nextcloud.ready())
+        for i in range(3):
+            self.assertEqual(main.open_breaker(breakers, []), 'pronto')
+        self.assertEqual(nextcloud.state['state'], CircuitBreaker.OPEN, "Probe spent on a deferred event")
+        self.assertIsNone(main.open_breaker(breakers, ['skippronto']), "Probe not available")
+        self.assertEqual(nextcloud.state['state'], CircuitBreaker.HALFOPEN)
+        self.assertFalse(nextcloud.ready(), "Second probe while the first is in flight")
+        nextcloud.release()
+        self.assertTrue(nextcloud.ready(), "Released probe not available")
+
+
+class LagSet(unittest.TestCase):
+    """
+    Tests for the time from a file being saved to its quicklink being registered.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.server = StandInServer()
+        self.server.start()
+        self.settings = {'datalog': None, 'prontourl': self.server.url, 'prontoapiwebresource': 'standin',
+                         'prontoapiuser': 'api', 'prontoapipassword': 'api', 'webhook': None, 'jsonlog': None,
+                         'sinktimeouts': dict(main.SINK_TIMEOUTS), 'reusefoldershare': False,
+                         'lockdir': os.path.join(self.tmpdir.name, 'locks'), 'nextcloudroot': self.tmpdir.name,
+                         'lagslo': {'*': 300, 'quicklinks': 60}}
+        self.args = argparse.Namespace(create_public_share=True, public_keyword=None, reuse_folder_share=False,
+                                       force=False)
+
+    def tearDown(self) -> None:
+        appmetrics.metrics_file = None
+        self.server.stop()
+        self.tmpdir.cleanup()
+
+    def test001(self):
+        """ Test the lag is measured from the local file and a lag over the owner's target is flagged"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        localfile = os.path.join(self.tmpdir.name, 'quicklinks', 'files', 'Documents', 'EQ100.pdf')
+        os.makedirs(os.path.dirname(localfile))
+        with open(localfile, 'w') as f:
+            f.write('EQ100')
+        saved = time.time() - 120
+        os.utime(localfile, (saved, saved))
+        appmetrics.metrics_file = os.path.join(self.tmpdir.name, 'metrics.txt')
+        thiscloud = NxtCld(self.server.url, 'quicklinks', 'password')
+        event = {'thiscloud': thiscloud, 'received': time.time() - 5}
+        main.process_file(thiscloud, self.args, '/Documents/EQ100.pdf', [], None, event, self.settings)
+        lag = main.result_record('quicklinks', event, 1.0)['lag']
+        self.assertGreaterEqual(lag['seconds'], 120)
+        self.assertLess(lag['seconds'], 130)
+        self.assertEqual((lag['slo'], lag['breach']), (60, True))
+        self.assertLess(lag['received'], lag['registered'])
+        self.assertNotIn('modified', thiscloud.timings, "Asked nextcloud for the time of a local file")
+        metrics = [m['metric'] for m in Metrics.read(appmetrics.metrics_file)]
+        self.assertIn('quicklink_lag', metrics)
+        self.assertIn('lag_slo_breach', metrics)
+
+    def test002(self):
+        """ Test the time is asked of nextcloud only when there is no local file and lagslo is set"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        self.server.add_file('other', 'Documents/EQ200.pdf', int(time.time()) - 30)
+        thiscloud = NxtCld(self.server.url, 'other', 'password')
+        thiscloud.folder_cache = FolderCache()
+        event = {'thiscloud': thiscloud}
+        main.process_file(thiscloud, self.args, '/Documents/EQ200.pdf', [], None, event, self.settings)
+        self.assertGreaterEqual(event['lag']['seconds'], 29)
+        self.assertEqual((event['lag']['slo'], event['lag']['breach']), (300, False))
+        self.assertIn('modified', thiscloud.timings)
+        propfinds = self.server.requests['nc_propfind']
+        self.settings['lagslo'] = {}
+        thiscloud._initialise_internal_variables()
+        event = {'thiscloud': thiscloud}
+        main.process_file(thiscloud, self.args, '/Documents/EQ200.pdf', [], None, event, self.settings)
+        self.assertIsNone(event['lag']['seconds'])
+        self.assertEqual(self.server.requests['nc_propfind'], propfinds, "Asked nextcloud without lagslo")
+
+
+class LRUCacheSet(unittest.TestCase):
+    """
+    Tests for the memory bounded cache of nextcloud lookups.
+    """
+
+    def test001(self):
+        """ Test the cache stays within its bytes, evicts the least recently used and expires entries"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        entry = [{'share_type': 3, 'url': 'https://nextcloud/index.php/s/abc', 'id': '12'}]
+        size = LRUCache.footprint(('shares', 'quicklinks', 'Documents/EQ100.pdf')) + LRUCache.footprint(entry)
+        cache = LRUCache(maxbytes=size * 3 + 10, ttl=0.2)
+        for i in range(3):
+            cache.put(('shares', 'quicklinks', 'Documents/EQ10{}.pdf'.format(i)), entry)
+        self.assertEqual(cache.get(('shares', 'quicklinks', 'Documents/EQ100.pdf')), entry)
+        for i in range(3, 50):
+            cache.put(('shares', 'quicklinks', 'Documents/EQ1{:02d}.pdf'.format(i)), entry)
+        stats = cache.stats
+        self.assertLessEqual(stats['bytes'], cache.maxbytes, "Cache grew past its bytes")
+        self.assertEqual((stats['entries'], stats['evictions']), (3, 47))
+        self.assertIsNone(cache.get(('shares', 'quicklinks', 'Documents/EQ101.pdf')), "Evicted entry returned")
+        cache.invalidate(('shares', 'quicklinks', 'Documents/EQ149.pdf'))
+        self.assertIsNone(cache.get(('shares', 'quicklinks', 'Documents/EQ149.pdf')))
+        cache.put('big', 'x' * cache.maxbytes)
+        self.assertIsNone(cache.get('big'), "Entry bigger than the cache kept")
+        time.sleep(0.25)
+        self.assertIsNone(cache.get(('shares', 'quicklinks', 'Documents/EQ148.pdf')), "Expired entry returned")
+        self.assertEqual((cache.stats['expired'], cache.stats['hits']), (1, 1))
+        with self.assertRaises(LRUCache.LRUCacheError):
+            LRUCache(maxbytes=0)
+
+    def test002(self):
+        """ Test NxtCld answers a file looked up again from the cache and a new share invalidates it"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        with StandInServer() as server:
+            thiscloud = NxtCld(server.url, 'quicklinks', 'password')
+            thiscloud.lookup_cache = LRUCache()
+            for _ in range(3):
+                thiscloud._initialise_internal_variables()
+                thiscloud.file_path = '/Documents/EQ100.pdf'
+                self.assertIsNone(thiscloud.public_share_id)
+            self.assertEqual((server.requests['nc_propfind'], server.requests['nc_get_shares']), (1, 1),
+                             "File looked up again")
+            thiscloud._initialise_internal_variables()
+            thiscloud.optionally_create_public_share = True
+            thiscloud.file_path = '/Documents/EQ100.pdf'
+            shareid = thiscloud.public_share_id
+            self.assertIsNotNone(shareid)
+            self.assertEqual(server.requests['nc_get_shares'], 2, "Cached shares trusted before creating a share")
+            thiscloud._initialise_internal_variables()
+            thiscloud.file_path = '/Documents/EQ100.pdf'
+            self.assertEqual(thiscloud.public_share_id, shareid, "New share not found after invalidation")
+            self.assertEqual(server.requests['nc_get_shares'], 3)
+            self.assertEqual(thiscloud.lookup_cache.stats['hits'], 6)
+
+
+class ResourceSet(unittest.TestCase):
+    """
+    Tests for the cpu, memory and http requests accounted to each file.
+    """
+
+    def test001(self):
+        """ Test every request to nextcloud and pronto is counted against its endpoint, with or without keep alive"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        args = argparse.Namespace(create_public_share=True, public_keyword=None, reuse_folder_share=False,
+                                  force=False)
+        for keep_alive in (False, True):
+            with StandInServer() as server, tempfile.TemporaryDirectory() as tmpdir:
+                settings = {'datalog': None, 'prontourl': server.url, 'prontoapiwebresource': 'standin',
+                            'prontoapiuser': 'api', 'prontoapipassword': 'api', 'webhook': None, 'jsonlog': None,
+                            'sinktimeouts': dict(main.SINK_TIMEOUTS), 'reusefoldershare': False,
+                            'lockdir': os.path.join(tmpdir, 'locks'), 'nextcloudroot': tmpdir, 'lagslo': {}}
+                meter = ResourceMeter()
+                thiscloud = NxtCld(server.url, 'quicklinks', 'password', keep_alive=keep_alive)
+                event = {'thiscloud': thiscloud}
+                main.process_file(thiscloud, args, '/Documents/EQ100.pdf', [], None, event, settings)
+                event['resources'] = meter.stop(thiscloud)
+                usage = {k: v['requests'] for k, v in thiscloud.http_usage.items()}
+                self.assertEqual(usage, server.requests, "Requests miscounted (keep_alive {})".format(keep_alive))
+                for endpoint in ('nc_user', 'nc_propfind', 'nc_create_share', 'pronto_token', 'pronto_vapiql'):
+                    self.assertGreater(thiscloud.http_usage[endpoint]['received'], 0, endpoint)
+                self.assertGreater(thiscloud.http_usage['pronto_vapiql']['sent'], 0)
+                resources = main.result_record('quicklinks', event, 1.0)['resources']
+                self.assertEqual(resources['requests'], sum(server.requests.values()))
+                self.assertGreaterEqual(resources['cpuuser'] + resources['cpusys'], 0)
+                self.assertGreaterEqual(resources['maxrss'], 0)
+                # the next file starts again from nothing
+                thiscloud._initialise_internal_variables()
+                self.assertEqual(thiscloud.http_usage, {})
+
+    def test002(self):
+        """ Test the totals add up the files and name the largest"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        totals = ResourceTotals()
+        for i, requests in enumerate((3, 12, 5)):
+            endpoints = {'nc_propfind': {'requests': requests, 'sent': 100 * requests, 'received': 1000}}
+            totals.add({'owner': 'quicklinks', 'path': 'Documents/EQ10{}.pdf'.format(i),
+                        'resources': {'cpuuser': 0.5, 'cpusys': 0.1, 'maxrss': i * 1024, 'requests': requests,
+                                      'bytes': 100 * requests + 1000, 'endpoints': endpoints}})
+        totals.add({'owner': 'quicklinks', 'path': 'Documents/EQ200.pdf', 'resources': None})
+        summary = totals.summary()
+        self.assertEqual(summary['files'], 3)
+        self.assertEqual(summary['totals']['requests'], 20)
+        self.assertEqual(summary['totals']['cpuuser'], 1.5)
+        self.assertEqual(summary['largest']['requests'], (12, 'quicklinks Documents/EQ101.pdf'))
+        self.assertEqual(summary['largest']['maxrss'], (2048, 'quicklinks Documents/EQ102.pdf'))
+        self.assertEqual(summary['endpoints']['nc_propfind'], {'requests': 20, 'sent': 2000, 'received': 3000})
+        self.assertIn('quicklinks Documents/EQ101.pdf', totals.format_summary())
+        self.assertEqual(ResourceTotals().format_summary(), "resources: no files")
+
+
+class SpoolSet(unittest.TestCase):
+    """
+    Tests for the event spool used by the service.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.spool = Spool(self.tmpdir.name)
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test001(self):
+        """ Test events are claimed oldest first and only once"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        first = self.spool.enqueue({'owner': 'quicklinks', 'file': '/data/quicklinks/files/EQ100.pdf'})
+        second = self.spool.enqueue({'owner': 'quicklinks', 'file': '/data/quicklinks/files/EQ200.pdf'})
+        with self.assertRaises(Spool.SpoolError):
+            self.spool.enqueue({'owner': 'quicklinks'})
+        claimed = self.spool.claim()
+        self.assertEqual([c[0] for c in claimed], [first, second], "Events not claimed in order")
+        self.assertEqual(claimed[1][1]['file'], '/data/quicklinks/files/EQ200.pdf')
+        self.assertEqual(self.spool.claim(), [], "Event claimed twice")
+        self.spool.done(first)
+        self.spool.failed(second, 'Failed to Connect')
+        with open(os.path.join(self.tmpdir.name, 'failed', second[:-len('.json')] + '.error')) as f:
+            self.assertEqual(f.read().strip(), 'Failed to Connect')
+        self.assertEqual([f for _, _, files in os.walk(os.path.join(self.tmpdir.name, 'work')) for f in files
+                          if f.endswith('.json')], [], "Work folder not empty")
+
+    def test002(self):
+        """ Test the unfinished events of a stopped process are returned to the spool, and a running one's are not"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        name = self.spool.enqueue({'owner': 'quicklinks', 'file': '/data/quicklinks/files/EQ100.pdf'})
+        # claimed by another process that then stops without finishing it
+        subprocess.run([sys.executable, '-c', 'from spool import Spool; Spool({!r}).claim()'.format(self.tmpdir.name)],
+                       cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        self.assertEqual(self.spool.pending(), [])
+        mine = self.spool.enqueue({'owner': 'quicklinks', 'file': '/data/quicklinks/files/EQ200.pdf'})
+        self.assertEqual([c[0] for c in self.spool.claim()], [mine])
+        self.assertEqual(Spool(self.tmpdir.name).recover(), 1)
+        self.assertEqual(self.spool.pending(), [name], "Event not returned to the spool")
+        self.assertEqual(self.spool.recover(), 0, "A running process's event returned to the spool")
+
+    def test003(self):
+        """ Test a few events are claimed at a time and bulk events are claimed after live ones"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        bulk = [self.spool.enqueue({'owner': 'quicklinks', 'file': '/data/quicklinks/files/B{}.pdf'.format(i),
+                                    'lane': 'bulk'}) for i in range(3)]
+        live = self.spool.enqueue({'owner': 'quicklinks', 'file': '/data/quicklinks/files/L0.pdf'})
+        self.assertEqual([c[0] for c in self.spool.claim(2)], [live, bulk[0]])
+        self.assertEqual(self.spool.pending(), bulk[1:])
+
+    def test004(self):
+        """ Test a recovery that runs while a process is setting up its work folder leaves the folder alone"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        name = self.spool.enqueue({'owner': 'quicklinks', 'file': '/data/quicklinks/files/EQ100.pdf'})
+        flock = fcntl.flock
+        raced = []
+
+        def racing_flock(f, operation):
+            # another process recovers just before the new work folder is locked
+            if not raced and operation == fcntl.LOCK_EX and getattr(f, 'name', '').endswith('/.lock'):
+                raced.append(f.name)
+                subprocess.run([sys.executable, '-c', 'from spool import Spool; Spool({!r}).recover()'.format(
+                    self.tmpdir.name)], cwd=os.path.dirname(os.path.abspath(__file__)), check=True, timeout=30)
+            return flock(f, operation)
+
+        with unittest.mock.patch('fcntl.flock', racing_flock):
+            claimed = Spool(self.tmpdir.name).claim()
+        self.assertTrue(raced, "Work folder set up before the test")
+        self.assertEqual([c[0] for c in claimed], [name], "Claim lost to the recovery")
+
+
+class ServiceSet(unittest.TestCase):
+    """
+    Tests for the multi-tenant service (two tenants, each against its own stand-in server).
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.servers = {}
+        self.tenants = []
+        for name in ('alpha', 'beta'):
+            server = StandInServer()
+            server.start()
+            self.servers[name] = server
+            configfile = os.path.join(self.tmpdir.name, name + '.ini')
+            with open(configfile, 'w') as f:
+                f.write("[SETUP]\nurl = {}\nnextcloudroot = /data/{}\ndatalog = {}\nlockdir = {}\n"
+                        "[USERPASSWORDS]\nquicklinks = password\nother = password\n".format(
+                            server.url, name, os.path.join(self.tmpdir.name, name + '.csv'),
+                            os.path.join(self.tmpdir.name, 'locks')))
+            self.tenants.append(Tenant(configfile))
+        self.spool = Spool(os.path.join(self.tmpdir.name, 'spool'))
+
+    def tearDown(self) -> None:
+        for server in self.servers.values():
+            server.stop()
+        self.tmpdir.cleanup()
+
+    def test001(self):
+        """ Test events are routed by nextcloudroot or tenant name and unknown tenants fail"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        service = Service(self.tenants, self.spool)
+        self.assertEqual(service.route({'owner': 'quicklinks', 'file': '/data/beta/quicklinks/files/a.pdf'}).name,
+                         'beta')
+        self.assertEqual(service.route({'owner': 'quicklinks', 'file': '/x/a.pdf', 'tenant': 'alpha'}).name,
+                         'alpha')
+        with self.assertRaises(Service.ServiceError):
+            service.route({'owner': 'quicklinks', 'file': '/data/gamma/quicklinks/files/a.pdf'})
+        with self.assertRaises(Service.ServiceError):
+            service.route({'owner': 'quicklinks', 'file': '/x/a.pdf', 'tenant': 'gamma'})
+
+    def test002(self):
+        """ Test a bulk upload for one tenant does not hold up the other tenant"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        for i in range(4):
+            self.spool.enqueue({'owner': 'quicklinks', 'file': '/data/alpha/quicklinks/files/A{}.pdf'.format(i)})
+        for i in range(2):
+            self.spool.enqueue({'owner': 'quicklinks', 'file': '/data/beta/quicklinks/files/B{}.pdf'.format(i)})
+        self.spool.enqueue({'owner': 'quicklinks', 'file': '/data/gamma/quicklinks/files/C0.pdf'})
+        results = io.StringIO()
+        Service(self.tenants, self.spool, workers=1, results=results).drain()
+        records = [json.loads(line) for line in results.getvalue().splitlines()]
+        self.assertEqual([r['tenant'] for r in records], ['alpha', 'beta', 'alpha', 'beta', 'alpha', 'alpha'],
+                         "Tenants not taken in turn")
+        self.assertEqual(set(r['status'] for r in records), {'processed'})
+        self.assertEqual(records[1]['path'], '/B0.pdf')
+        self.assertEqual(self.servers['beta'].requests['nc_get_shares'], 2)
+        self.assertEqual(self.servers['alpha'].requests['nc_user'], 1, "Connected for each event")
+        self.assertEqual(self.spool.pending(), [])
+        self.assertEqual(len(os.listdir(os.path.join(self.tmpdir.name, 'spool', 'failed'))), 2,
+                         "Unrouted event not failed")
+
+    def test003(self):
+        """ Test live events go ahead of bulk ones (strict and weighted) and owners take turns within a lane"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+
+        def enqueue():
+            for i in range(4):
+                self.spool.enqueue({'owner': 'quicklinks', 'file': '/data/alpha/quicklinks/files/B{}.pdf'.format(i),
+                                    'lane': 'bulk'})
+            for i in range(2):
+                self.spool.enqueue({'owner': 'other', 'file': '/data/alpha/other/files/O{}.pdf'.format(i),
+                                    'lane': 'bulk'})
+            for i in range(2):
+                self.spool.enqueue({'owner': 'quicklinks', 'file': '/data/alpha/quicklinks/files/L{}.pdf'.format(i)})
+
+        enqueue()
+        results = io.StringIO()
+        Service(self.tenants, self.spool, workers=1, results=results, strictlanes=True).drain()
+        records = [json.loads(line) for line in results.getvalue().splitlines()]
+        self.assertEqual([r['path'] for r in records],
+                         ['/L0.pdf', '/L1.pdf', '/B0.pdf', '/O0.pdf', '/B1.pdf', '/O1.pdf', '/B2.pdf', '/B3.pdf'])
+        self.assertEqual([r['lane'] for r in records[:3]], ['live', 'live', 'bulk'])
+        self.assertIn('queue', records[0]['timings'])
+        enqueue()
+        results = io.StringIO()
+        Service(self.tenants, self.spool, workers=1, results=results, liveweight=1).drain()
+        records = [json.loads(line) for line in results.getvalue().splitlines()]
+        self.assertEqual([r['path'] for r in records],
+                         ['/L0.pdf', '/B0.pdf', '/L1.pdf', '/O0.pdf', '/B1.pdf', '/O1.pdf', '/B2.pdf', '/B3.pdf'])
+        self.spool.enqueue({'owner': 'quicklinks', 'file': '/data/alpha/quicklinks/files/X.pdf', 'lane': 'urgent'})
+        Service(self.tenants, self.spool, workers=1).drain()
+        self.assertEqual(len(os.listdir(os.path.join(self.tmpdir.name, 'spool', 'failed'))), 2,
+                         "Unknown lane not failed")
+
+    def test004(self):
+        """ Test a deferred event is recorded but leaves no Timings line for log-stats"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        configfile = os.path.join(self.tmpdir.name, 'gamma.ini')
+        breakerdir = os.path.join(self.tmpdir.name, 'breakers')
+        with open(configfile, 'w') as f:
+            f.write("[SETUP]\nurl = {}\nnextcloudroot = /data/gamma\nlockdir = {}\nbreakerdir = {}\n"
+                    "breakerfailures = 1\nbreakerreset = 60\ndeferdir = {}\n"
+                    "[USERPASSWORDS]\nquicklinks = password\n".format(
+                        self.servers['alpha'].url, os.path.join(self.tmpdir.name, 'locks'), breakerdir,
+                        os.path.join(self.tmpdir.name, 'deferred')))
+        CircuitBreaker(breakerdir, 'nextcloud', failures=1).failure('down')
+        self.spool.enqueue({'owner': 'quicklinks', 'file': '/data/gamma/quicklinks/files/D.pdf'})
+        results = io.StringIO()
+        with self.assertLogs(applog, level='INFO') as logged:
+            Service([Tenant(configfile)], self.spool, workers=1, results=results).drain()
+        self.assertEqual([json.loads(line)['status'] for line in results.getvalue().splitlines()], ['deferred'])
+        self.assertFalse([line for line in logged.output if 'Timings' in line], "Timings logged for a deferred event")
+
+    def test005(self):
+        """ Test the service profiles each slow event, including events processed at the same time"""
+        applog.debug('start of Test {}.{}'.format(self.__class__.__name__, inspect.stack()[0][3]))
+        configfile = os.path.join(self.tmpdir.name, 'gamma.ini')
+        profiledir = os.path.join(self.tmpdir.name, 'profiles')
+        with open(configfile, 'w') as f:
+            f.write("[SETUP]\nurl = {}\nnextcloudroot = /data/gamma\nlockdir = {}\nprofilethreshold = 0.000001\n"
+                    "profiledir = {}\n[USERPASSWORDS]\nquicklinks = password\n".format(
+                        self.servers['alpha'].url, os.path.join(self.tmpdir.name, 'locks'), profiledir))
+        for i in range(2):
+            self.spool.enqueue({'owner': 'quicklinks', 'file': '/data/gamma/quicklinks/files/P{}.pdf'.format(i)})
+        Service([Tenant(configfile)], self.spool, workers=2).drain()
+        dumps = [name for name in os.listdir(profiledir) if name.endswith('.txt')]
+        self.assertEqual(len(dumps), 2, "Not a profile per event")
+        files = []
+        for name in dumps:
+            with open(os.path.join(profiledir, name)) as f:
+                text = f.read()
+            self.assertIn('tenant: gamma', text)
+            files += [line.split(': ')[1] for line in text.splitlines() if line.startswith('file: ')]
+        self.assertEqual(sorted(files), ['/P0.pdf', '/P1.pdf'])
+
+
 def establish_logging():
     if global_applog is None:
         loghandler = logging.StreamHandler()
@@ -311,7 +1902,30 @@ if __name__ == '__main__':
     case1 = unittest.TestLoader().loadTestsFromTestCase(RegressionSet)
     # Case 2 test the other miscellaneous features
     case2 = unittest.TestLoader().loadTestsFromTestCase(misc)
+    case3 = unittest.TestLoader().loadTestsFromTestCase(LimiterSet)
+    case4 = unittest.TestLoader().loadTestsFromTestCase(FilterSet)
+    case5 = unittest.TestLoader().loadTestsFromTestCase(LedgerSet)
+    case6 = unittest.TestLoader().loadTestsFromTestCase(PathLockSet)
+    case7 = unittest.TestLoader().loadTestsFromTestCase(ProfilerSet)
+    case8 = unittest.TestLoader().loadTestsFromTestCase(LoadGenSet)
+    case9 = unittest.TestLoader().loadTestsFromTestCase(LogStatsSet)
+    case10 = unittest.TestLoader().loadTestsFromTestCase(FolderCacheSet)
+    case11 = unittest.TestLoader().loadTestsFromTestCase(OutputSet)
+    case12 = unittest.TestLoader().loadTestsFromTestCase(SpoolSet)
+    case13 = unittest.TestLoader().loadTestsFromTestCase(ServiceSet)
+    case14 = unittest.TestLoader().loadTestsFromTestCase(BatchWorkersSet)
+    case15 = unittest.TestLoader().loadTestsFromTestCase(AdaptiveSet)
+    case16 = unittest.TestLoader().loadTestsFromTestCase(NegativeCacheSet)
+    case17 = unittest.TestLoader().loadTestsFromTestCase(PollSet)
+    case18 = unittest.TestLoader().loadTestsFromTestCase(FileCacheSet)
+    case19 = unittest.TestLoader().loadTestsFromTestCase(SinksSet)
+    case20 = unittest.TestLoader().loadTestsFromTestCase(BundleSet)
+    case21 = unittest.TestLoader().loadTestsFromTestCase(DigestSet)
+    case22 = unittest.TestLoader().loadTestsFromTestCase(BreakerSet)
+    case23 = unittest.TestLoader().loadTestsFromTestCase(LagSet)
+    case24 = unittest.TestLoader().loadTestsFromTestCase(LRUCacheSet)
+    case25 = unittest.TestLoader().loadTestsFromTestCase(ResourceSet)
     tempcase = unittest.TestLoader().loadTestsFromTestCase(temptests)
     # thissuite = unittest.TestSuite([case1,case2])
-    thissuite = unittest.TestSuite([case1,case2])
+    thissuite = unittest.TestSuite([case1,case2,case3,case4,case5,case6,case7,case8,case9,case10,case11,case12,case13,case14,case15,case16,case17,case18,case19,case20,case21,case22,case23,case24,case25])
     unittest.TextTestRunner(verbosity=2).run(thissuite)
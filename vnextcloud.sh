@@ -19,44 +19,71 @@ do
     CREATESHARE=1
   fi
 done
+# With a digest (digestdb in the ini file) the application emails a summary of the files, failures
+# included, so only failures the digest does not have are mailed from here (the venv, or an exit code other
+# than 1 - main.py exits 2 when it failed before the result reached the digest), at most one mail every
+# MAILGAP seconds.  Without a digest the output of every call is mailed as before.
+DIGEST=0
+if grep -Eq '^[[:space:]]*digestdb[[:space:]]*=[[:space:]]*[^[:space:]]' $INIFILE 2>/dev/null ; then
+  DIGEST=1
+fi
 THISLOG=/tmp/vnc_$$.log
-# echo -e "$(date)\n$OWNER\n$FILEPATH\n$FILEID" | mail -s "Nextcloud Python Call" ray.burns@velocityglobal.co.nz
+SHELLLOG=$VNXTCLDROOT/shell.log
+MAILSTAMP=$VNXTCLDROOT/shell.mailed
+MAILGAP=900
+
+# mail this call's output to root (with a digest, only if nothing was mailed in the last MAILGAP seconds)
+mailroot() {
+  type mail >/dev/null 2>/dev/null || return
+  if [ $DIGEST -eq 1 ] ; then
+    (
+      flock 8
+      if [ -f $MAILSTAMP ] && [ $(( $(date +%s) - $(stat -c %Y $MAILSTAMP) )) -lt $MAILGAP ] ; then
+        exit 1
+      fi
+      touch $MAILSTAMP
+    ) 8>>$MAILSTAMP.lock || return
+  fi
+  cat $THISLOG | mail -s "$1" root
+}
+
+# keep the output of the call in shell.log, in one piece, and start a new shell.log after 10MB
+finish() {
+  (
+    flock 9
+    if [ $(stat -c %s $SHELLLOG 2>/dev/null || echo 0) -gt 10000000 ] ; then
+      mv -f $SHELLLOG $SHELLLOG.1
+    fi
+    cat $THISLOG >> $SHELLLOG
+  ) 9>>$SHELLLOG.lock
+  rm -f $THISLOG
+}
+trap finish EXIT
+
 echo -e "$(date)\n$OWNER\n$FILEPATH" > $THISLOG
 source $VNXTCLDROOT/venv/bin/activate
 if [ $? -ne 0 ] ; then
-    if type mail >/dev/null 2>/dev/null ; then
-      echo "Failed to locate the venv activate script" | mail -s "Nextcloud Python Venv Error" root
-    else
-      echo "Failed to locate the venv activate script" >> $THISLOG
-    fi
+    echo "Failed to locate the venv activate script" >> $THISLOG
+    mailroot "Nextcloud Python Venv Error"
     exit 1
 fi
-echo "$(date +%T) Venv Activated"
+echo "$(date +%T) Venv Activated" >> $THISLOG
 if [ $CREATESHARE -eq 1 ]; then
-  echo "$(date +%T) Create Share specified"
-  $VNXTCLDROOT/venv/bin/python $VNXTCLDROOT/main.py  --configfile $INIFILE --owner $OWNER --file "$FILEPATH" --create-public-share 2>&1 >> $THISLOG
-  if [ $? -ne 0 ] ; then
-    echo "$(date +%T) Non Zero Exit from python"
-    if type mail >/dev/null 2>/dev/null ; then
-      echo "A problem occurred when updating the quicklink" | mail -s "Nextcloud Python Call Error" root
-    else
-      echo "A problem occurred when updating the quicklink" >> $THISLOG
-    fi
-  fi
+  echo "$(date +%T) Create Share specified" >> $THISLOG
+  $VNXTCLDROOT/venv/bin/python $VNXTCLDROOT/main.py  --configfile $INIFILE --owner $OWNER --file "$FILEPATH" --create-public-share >> $THISLOG 2>&1
 else
   $VNXTCLDROOT/venv/bin/python $VNXTCLDROOT/main.py  --configfile $INIFILE --owner $OWNER --file "$FILEPATH"  >> $THISLOG 2>&1
-  echo "$(date +%T) Non Zero Exit from python"
-  if [ $? -ne 0 ] ; then
-    if type mail >/dev/null 2>/dev/null ; then
-      echo "A problem occurred when updating the quicklink" | mail -s "Nextcloud Python Call Error" root
-    else
-      echo "A problem occurred when updating the quicklink" >> $THISLOG
-    fi
-  fi
 fi
-if type mail >/dev/null 2>/dev/null ; then
-  cat $THISLOG | mail -s "Nextcloud Python Cloud" ray.burns@velocityglobal.co.nz
-else
-  cat $THISLOG >> $VNXTCLDROOT/shell.log
+EXITCODE=$?
+if [ $EXITCODE -ne 0 ] ; then
+  echo "$(date +%T) Non Zero Exit from python ($EXITCODE)" >> $THISLOG
+  echo "A problem occurred when updating the quicklink" >> $THISLOG
+  if [ $DIGEST -eq 0 ] || [ $EXITCODE -ne 1 ] ; then
+    mailroot "Nextcloud Python Call Error"
+  fi
+elif [ $DIGEST -eq 0 ] ; then
+  if type mail >/dev/null 2>/dev/null ; then
+    cat $THISLOG | mail -s "Nextcloud Python Cloud" ray.burns@velocityglobal.co.nz
+  fi
 fi
-rm -f $THISLOG
+exit $EXITCODE
@@ -139,16 +139,21 @@ do
   fi
 done
 
-echo "Running Python:" >> $THISLOG
+# Use the single file bundle (see bundle.py) if it has been installed - it starts much quicker
+APP=$VENVROOT/main.py
+if [ -r $VENVROOT/vnextcloud.pyz ] ; then
+	APP=$VENVROOT/vnextcloud.pyz
+fi
+echo "Running Python: $APP" >> $THISLOG
 if [ $CREATESHARE -eq 1 ]; then
 # Change this to just call python as the version is determined by the venv.
 #  $VENVROOT/venv/bin/python3 $VENVROOT/main.py  --owner $OWNER --file "$FILEPATH" --create-public-share >> $THISLOG 2>&1
-  python $VENVROOT/main.py  --owner $OWNER --file "$FILEPATH" --create-public-share >> $THISLOG 2>&1
+  python $APP  --owner $OWNER --file "$FILEPATH" --create-public-share >> $THISLOG 2>&1
   if [ $? -ne 0 ] ; then
     echo "A problem occurred when updating the quicklink" >> $THISLOG
   fi
 else
-  python $VENVROOT/main.py  --owner $OWNER --file "$FILEPATH"  >> $THISLOG 2>&1
+  python $APP  --owner $OWNER --file "$FILEPATH"  >> $THISLOG 2>&1
   if [ $? -ne 0 ] ; then
     echo "A problem occurred when updating the quicklink" >> $THISLOG
   fi